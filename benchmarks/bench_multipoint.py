@@ -0,0 +1,223 @@
+"""
+Benchmark of the multipoint overhead: the communicator creation, the
+exchanges in obj() and sens() and the derivatives of objCon, on
+synthetic procSets whose user functions cost next to nothing.
+
+Run it under MPI with as many ranks as the layout requires, for
+example 2 sets of 3 members of 1 rank each::
+
+    mpirun -np 6 python bench_multipoint.py --members 3 3 --output new.json
+
+and compare the results with those of an earlier run::
+
+    python bench_multipoint.py --compare new.json --baseline old.json
+
+Only the public calls are timed, so the same benchmark also runs
+against older versions of multiPointSparse to produce a baseline. With
+--profile, the times of the exchanges and of objCon, the bytes sent and
+the peak memory are added from the profile of multiPointSparse. The
+profile adds barriers, so only compare runs made with the same flag.
+"""
+# =============================================================================
+# Imports
+# =============================================================================
+import sys
+import json
+import inspect
+import argparse
+import numpy as np
+from mpi4py import MPI
+from multipoint import multiPointSparse
+from pyoptsparse import Optimization
+
+gcomm = MPI.COMM_WORLD
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, nargs="+", default=[2, 1], help="number of members of each procSet")
+    parser.add_argument("--memberSize", type=int, default=1, help="number of ranks of each member")
+    parser.add_argument("--nFuncs", type=int, default=4, help="number of functionals of each member")
+    parser.add_argument("--funcSize", type=int, default=10, help="number of entries of each functional")
+    parser.add_argument("--nDV", type=int, default=20, help="number of design variables")
+    parser.add_argument("--nCons", type=int, default=2, help="number of constraints computed by objCon")
+    parser.add_argument("--objConTerms", type=int, default=1, help="number of nonlinear terms in objCon")
+    parser.add_argument("--nIter", type=int, default=5, help="number of obj() and sens() calls")
+    parser.add_argument(
+        "--option", nargs="*", default=[], help="multiPointSparse options as key=value, e.g. commMode=buffer"
+    )
+    parser.add_argument("--profile", action="store_true", help="add the profile of multiPointSparse to the results")
+    parser.add_argument("--output", type=str, default=None, help="JSON file to write the results to")
+    parser.add_argument("--compare", type=str, default=None, help="JSON results to compare with --baseline")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown reported as a regression")
+    return parser.parse_args()
+
+
+def parseOption(option):
+    key, value = option.split("=")
+    for convert in [int, float]:
+        try:
+            return key, convert(value)
+        except ValueError:
+            pass
+    return key, {"True": True, "False": False}.get(value, value)
+
+
+def memberFunctions(setName, member, args):
+    """Create the synthetic obj and sens functions of one member"""
+    rng = np.random.RandomState(1000 * len(setName) + member)
+    A = rng.uniform(-1.0, 1.0, (args.nFuncs, args.funcSize, args.nDV))
+    names = ["%s_%d_f%d" % (setName, member, i) for i in range(args.nFuncs)]
+
+    def benchObj(x):
+        return dict((names[i], np.sin(A[i].dot(x["x"]))) for i in range(args.nFuncs))
+
+    def benchSens(x, funcs):
+        return dict((names[i], {"x": np.cos(A[i].dot(x["x"]))[:, None] * A[i]}) for i in range(args.nFuncs))
+
+    return benchObj, benchSens, names
+
+
+def createObjCon(funcNames, args):
+    """Create the synthetic objCon function combining all functionals"""
+
+    def benchObjCon(funcs, printOK):
+        funcs["obj"] = 0.0
+        for key in funcNames:
+            for term in range(args.objConTerms):
+                funcs["obj"] += np.sum(np.tanh((term + 1) * funcs[key]))
+        for iCon in range(args.nCons):
+            funcs["con_%d" % iCon] = sum(np.mean(funcs[key] ** 2) for key in funcNames[iCon :: args.nCons])
+        return funcs
+
+    return benchObjCon
+
+
+def summarize(times):
+    return {"min": float(np.min(times)), "mean": float(np.mean(times)), "max": float(np.max(times))}
+
+
+def timeCall(func, *args):
+    """Time func on every rank and return its result and the largest time"""
+    gcomm.barrier()
+    startTime = MPI.Wtime()
+    res = func(*args)
+    return res, gcomm.allreduce(MPI.Wtime() - startTime, op=MPI.MAX)
+
+
+def runBenchmark(args):
+    options = dict(parseOption(option) for option in args.option)
+    if args.profile:
+        if "profile" not in inspect.signature(multiPointSparse.__init__).parameters:
+            sys.exit("--profile requires a version of multiPointSparse that supports profiling")
+        options["profile"] = True
+    MP = multiPointSparse(gcomm, **options)
+
+    setNames = ["set%d" % i for i in range(len(args.members))]
+    for setName, nMembers in zip(setNames, args.members):
+        MP.addProcessorSet(setName, nMembers, args.memberSize)
+
+    tmp, createTime = timeCall(MP.createCommunicators)
+    ptID = tmp[4]
+
+    funcNames = []
+    for setName, nMembers in zip(setNames, args.members):
+        for member in range(nMembers):
+            benchObj, benchSens, names = memberFunctions(setName, member, args)
+            funcNames.extend(names)
+            if MP.getSetName() == setName and member == ptID:
+                MP.setProcSetObjFunc(setName, benchObj)
+                MP.setProcSetSensFunc(setName, benchSens)
+
+    optProb = Optimization("multipoint benchmark", MP.obj)
+    optProb.addVarGroup("x", args.nDV, value=0.1)
+    optProb.addObj("obj")
+    for iCon in range(args.nCons):
+        optProb.addCon("con_%d" % iCon, upper=1.0)
+    MP.setObjCon(createObjCon(funcNames, args))
+    MP.setOptProb(optProb)
+
+    objTimes = []
+    sensTimes = []
+    for it in range(args.nIter):
+        x = {"x": np.linspace(0.0, 1.0, args.nDV) * (1.0 + 0.1 * it)}
+        (funcs, fail), objTime = timeCall(MP.obj, x)
+        (gcon, fail), sensTime = timeCall(MP.sens, x, funcs)
+        objTimes.append(objTime)
+        sensTimes.append(sensTime)
+
+    report = MP.getProfile() if args.profile else None
+    if gcomm.rank != 0:
+        return None
+
+    results = {
+        "createCommunicators": createTime,
+        "obj": summarize(objTimes),
+        "sens": summarize(sensTimes),
+    }
+    if report is not None:
+        results["phases"] = dict((name, report["phases"][name]) for name in ["exchange", "objCon", "objConSens"])
+        results["bytes"] = dict((funcType, sum(report["bytes"][funcType].values())) for funcType in report["bytes"])
+        maxrss = [rank["maxrss"] for rank in report["ranks"] if rank["maxrss"] is not None]
+        if len(maxrss) > 0:
+            results["maxrss"] = max(maxrss)
+    config = dict((key, val) for key, val in vars(args).items() if key not in ["output", "compare", "baseline"])
+
+    return {"config": config, "nProc": gcomm.size, "results": results}
+
+
+def flatten(results, prefix=""):
+    """Flatten the nested timings into a dictionary of name: value"""
+    flat = {}
+    for key in sorted(results.keys()):
+        if isinstance(results[key], dict):
+            flat.update(flatten(results[key], prefix + key + "."))
+        else:
+            flat[prefix + key] = results[key]
+    return flat
+
+
+def compareResults(new, baseline, tolerance):
+    """
+    Print the ratio of every timing of new to baseline and return the
+    names of the ones that got slower by more than tolerance.
+    """
+    if new["config"] != baseline["config"] or new["nProc"] != baseline["nProc"]:
+        print("Warning: the results were obtained with different configurations")
+
+    newFlat = flatten(new["results"])
+    baseFlat = flatten(baseline["results"])
+    regressions = []
+    print("%-40s %12s %12s %8s" % ("metric", "baseline", "new", "ratio"))
+    for key in sorted(newFlat.keys()):
+        if key not in baseFlat:
+            continue
+        ratio = newFlat[key] / baseFlat[key] if baseFlat[key] > 0 else float("nan")
+        flag = ""
+        if ratio > 1.0 + tolerance:
+            flag = " <-- regression"
+            regressions.append(key)
+        print("%-40s %12.4g %12.4g %8.3f%s" % (key, baseFlat[key], newFlat[key], ratio, flag))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parseArgs()
+    if args.compare is not None:
+        if args.baseline is None:
+            sys.exit("--compare requires --baseline")
+        with open(args.compare) as f:
+            new = json.load(f)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compareResults(new, baseline, args.tolerance)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    results = runBenchmark(args)
+    if results is not None:
+        print(json.dumps(results["results"], indent=1))
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=1)
@@ -4,5 +4,6 @@ __version__ = "1.3.0"
 from .multiPointSparse import multiPointSparse
 from .utils import createGroups
 from .utils import redirectIO
+from .memberlog import MemberLog, readMemberLog
 
-__all__ = ["multiPointSparse", "createGroups", "redirectIO"]
+__all__ = ["multiPointSparse", "createGroups", "redirectIO", "MemberLog", "readMemberLog"]
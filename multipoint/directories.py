@@ -0,0 +1,135 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import os
+import shutil
+import threading
+from mpi4py import MPI
+
+
+class DirectoryManager(object):
+    """
+    Creates the output directories of the members and optionally
+    stages them in node-local scratch. Every processor only creates
+    the directories it is given, so the members create their trees in
+    parallel instead of a single processor creating all of them.
+
+    When a scratch directory is used, the members write their output
+    to node-local scratch and flush() copies it back to rootDir in a
+    background thread. Only the files that changed since the last
+    flush are copied. Which files were copied is kept in memory, so
+    unchanged files cost no metadata operations on the shared file
+    system.
+
+    Parameters
+    ----------
+    rootDir : str
+        Root path of the directories on the shared file system
+    scratchDir : str
+        Optional root path of the node-local staging directories
+    """
+
+    def __init__(self, rootDir, scratchDir=None):
+        self.rootDir = rootDir
+        self.scratchDir = scratchDir
+        self.staged = []
+        self.flushed = {}
+        self.destDirs = set()
+        self.flusher = None
+        self.thread = None
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def create(self, dirNames):
+        """Create the directories dirNames in rootDir and return their paths"""
+        paths = [os.path.join(self.rootDir, dirName) for dirName in dirNames]
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+        return paths
+
+    def stage(self, stageName, dirNames):
+        """
+        Create the directories dirNames in the node-local staging
+        directory stageName and return their paths. The contents of
+        each of them are copied to the directory of the same name in
+        rootDir by flush().
+        """
+        stageDir = os.path.join(self.scratchDir, stageName)
+        paths = [os.path.join(stageDir, dirName) for dirName in dirNames]
+        for path in paths:
+            os.makedirs(path, exist_ok=True)
+        if stageDir not in self.staged:
+            self.staged.append(stageDir)
+        return paths
+
+    def flush(self, comm, wait=False):
+        """
+        Start copying the staging directories back to rootDir in a
+        background thread. Only the first processor of comm on every
+        node copies, since the processors of a node share its
+        scratch. If a copy is still running, another pass is made once
+        it is done. This is a collective call on comm the first time it
+        is called.
+
+        Parameters
+        ----------
+        comm : MPI.Intracomm
+            Communicator of the member
+        wait : bool
+            Flag to wait until all the files are copied
+        """
+        if self.scratchDir is None:
+            return
+        if self.flusher is None:
+            nodeComm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+            self.flusher = nodeComm.rank == 0
+            nodeComm.Free()
+        if not self.flusher:
+            return
+
+        with self.lock:
+            self.pending = True
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._flushLoop)
+                self.thread.start()
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """Wait until the background copy is done"""
+        if self.thread is not None:
+            self.thread.join()
+
+    def _flushLoop(self):
+        """Copy the staging directories until no flush is pending"""
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                self.pending = False
+            for stageDir in self.staged:
+                self._copyTree(stageDir)
+
+    def _copyTree(self, stageDir):
+        """Copy the files of stageDir that changed to rootDir"""
+        for dirPath, dirNames, fileNames in os.walk(stageDir):
+            destDir = os.path.normpath(os.path.join(self.rootDir, os.path.relpath(dirPath, stageDir)))
+            for fileName in fileNames:
+                src = os.path.join(dirPath, fileName)
+                try:
+                    stat = os.stat(src)
+                except OSError:
+                    # The file was removed while walking the tree
+                    continue
+                state = (stat.st_mtime_ns, stat.st_size)
+                if self.flushed.get(src) == state:
+                    continue
+                if destDir not in self.destDirs:
+                    os.makedirs(destDir, exist_ok=True)
+                    self.destDirs.add(destDir)
+                dest = os.path.join(destDir, fileName)
+                # Write to a temporary file first so that the file in
+                # rootDir is always complete
+                shutil.copy2(src, dest + ".tmp")
+                os.replace(dest + ".tmp", dest)
+                self.flushed[src] = state
@@ -0,0 +1,387 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+from .utils import _nEntries
+
+
+class DualArray(NDArrayOperatorsMixin):
+    """
+    A minimal forward mode automatic differentiation array. A
+    DualArray carries a value of shape S and the derivatives of that
+    value with respect to nSeed seeds, stored as an array of shape
+    S + (nSeed,). All the seeds are propagated in a single pass
+    through the user objCon function.
+
+    Only the NumPy operations listed in _UNARY, _BINARY and
+    _FUNCTIONS are supported. Anything else raises a TypeError.
+
+    Parameters
+    ----------
+    value : array_like
+        The value of the array
+    deriv : array_like
+        The derivatives of the value, with one extra trailing axis
+    """
+
+    def __init__(self, value, deriv):
+        self.value = np.asarray(value)
+        self.deriv = np.asarray(deriv)
+
+    # -------------------------------------------------------------------------
+    # Array attributes
+    # -------------------------------------------------------------------------
+    @property
+    def shape(self):
+        return self.value.shape
+
+    @property
+    def ndim(self):
+        return self.value.ndim
+
+    @property
+    def size(self):
+        return self.value.size
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __len__(self):
+        return len(self.value)
+
+    def __repr__(self):
+        return "DualArray(%r)" % (self.value,)
+
+    def __float__(self):
+        raise TypeError("A DualArray cannot be converted to a float without losing its derivatives.")
+
+    def __getitem__(self, idx):
+        return DualArray(self.value[idx], self.deriv[_derivIndex(idx)])
+
+    def __setitem__(self, idx, other):
+        other = _asDual(other, self.deriv.shape[-1])
+        self.value[idx] = other.value
+        self.deriv[_derivIndex(idx)] = other.deriv
+
+    def copy(self):
+        return DualArray(self.value.copy(), self.deriv.copy())
+
+    def reshape(self, *shape):
+        if len(shape) == 1 and not np.isscalar(shape[0]):
+            shape = tuple(shape[0])
+        value = self.value.reshape(shape)
+        return DualArray(value, self.deriv.reshape(value.shape + self.deriv.shape[-1:]))
+
+    def flatten(self):
+        return self.reshape(-1)
+
+    def ravel(self):
+        return self.reshape(-1)
+
+    def squeeze(self, axis=None):
+        value = self.value.squeeze(axis)
+        return DualArray(value, self.deriv.reshape(value.shape + self.deriv.shape[-1:]))
+
+    def transpose(self, *axes):
+        if len(axes) == 0:
+            axes = tuple(range(self.ndim))[::-1]
+        elif len(axes) == 1 and not np.isscalar(axes[0]):
+            axes = tuple(axes[0])
+        return DualArray(self.value.transpose(axes), self.deriv.transpose(tuple(axes) + (self.ndim,)))
+
+    def sum(self, axis=None, keepdims=False):
+        return _sum(self, axis=axis, keepdims=keepdims)
+
+    def mean(self, axis=None, keepdims=False):
+        return _mean(self, axis=axis, keepdims=keepdims)
+
+    def dot(self, other):
+        return _dot(self, other)
+
+    def max(self, axis=None):
+        return _extremum(self, np.argmax, axis)
+
+    def min(self, axis=None):
+        return _extremum(self, np.argmin, axis)
+
+    # -------------------------------------------------------------------------
+    # NumPy protocols
+    # -------------------------------------------------------------------------
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != "__call__" or "out" in kwargs:
+            return NotImplemented
+
+        nSeed = self.deriv.shape[-1]
+        if ufunc in _UNARY:
+            x = inputs[0]
+            dfdx = np.asarray(_UNARY[ufunc](x.value))
+            return DualArray(ufunc(x.value), dfdx[..., np.newaxis] * x.deriv)
+        elif ufunc in _BINARY:
+            return _BINARY[ufunc](inputs[0], inputs[1], nSeed)
+        elif ufunc is np.matmul:
+            return _dot(inputs[0], inputs[1])
+        elif ufunc in _COMPARISON:
+            # Comparisons only act on the values
+            return ufunc(*[_value(i) for i in inputs], **kwargs)
+
+        return NotImplemented
+
+    def __array_function__(self, func, types, args, kwargs):
+        if func not in _FUNCTIONS:
+            return NotImplemented
+        return _FUNCTIONS[func](*args, **kwargs)
+
+
+# =============================================================================
+# Helper functions
+# =============================================================================
+def _value(x):
+    """Return the value of a DualArray or the input itself"""
+    return x.value if isinstance(x, DualArray) else x
+
+
+def _asDual(x, nSeed):
+    """Return x as a DualArray, with zero derivatives if it is a constant"""
+    if isinstance(x, DualArray):
+        return x
+    x = np.asarray(x)
+    return DualArray(x, np.zeros(x.shape + (nSeed,), np.result_type(x, float)))
+
+
+def _derivIndex(idx):
+    """Translate an index of the value into an index of the derivatives"""
+    if not isinstance(idx, tuple):
+        idx = (idx,)
+    if any(i is Ellipsis for i in idx):
+        return idx + (slice(None),)
+    return idx
+
+
+def _axes(x, axis):
+    """Return the axes to reduce of the derivatives of x as a tuple"""
+    if axis is None:
+        return tuple(range(x.ndim))
+    axis = np.atleast_1d(axis)
+    return tuple(int(a) % x.ndim for a in axis)
+
+
+def _sum(a, axis=None, dtype=None, out=None, keepdims=False):
+    axes = _axes(a, axis)
+    return DualArray(np.sum(a.value, axis=axes, keepdims=keepdims), np.sum(a.deriv, axis=axes, keepdims=keepdims))
+
+
+def _mean(a, axis=None, dtype=None, out=None, keepdims=False):
+    axes = _axes(a, axis)
+    count = np.prod([a.shape[i] for i in axes], dtype=int)
+    return _sum(a, axis=axes, keepdims=keepdims) / count
+
+
+def _average(a, axis=None, weights=None, returned=False, keepdims=False):
+    if weights is None:
+        avg = _mean(a, axis=axis, keepdims=keepdims)
+        wSum = np.prod([np.shape(a)[i] for i in _axes(a, axis)], dtype=int)
+    else:
+        wSum = np.sum(_value(weights), axis=axis, keepdims=keepdims)
+        if isinstance(a, DualArray):
+            avg = _sum(a * weights, axis=axis, keepdims=keepdims) / wSum
+        else:
+            avg = _sum(weights * a, axis=axis, keepdims=keepdims) / wSum
+    if returned:
+        return avg, wSum
+    return avg
+
+
+def _dot(a, b):
+    if np.ndim(_value(a)) == 0 or np.ndim(_value(b)) == 0:
+        return a * b
+    if np.ndim(_value(b)) > 2:
+        raise TypeError("DualArray only supports dot products with 1D or 2D arrays.")
+
+    value = np.dot(_value(a), _value(b))
+    nSeed = (a if isinstance(a, DualArray) else b).deriv.shape[-1]
+    deriv = np.zeros(np.shape(value) + (nSeed,))
+    if isinstance(a, DualArray):
+        tmp = np.tensordot(a.deriv, _value(b), axes=([-2], [0]))
+        deriv = deriv + np.moveaxis(tmp, a.ndim - 1, -1)
+    if isinstance(b, DualArray):
+        deriv = deriv + np.tensordot(_value(a), b.deriv, axes=([-1], [0]))
+
+    return DualArray(value, deriv)
+
+
+def _extremum(a, argFunc, axis=None):
+    if axis is None:
+        i = argFunc(a.value)
+        return DualArray(a.value.reshape(-1)[i], a.deriv.reshape((-1, a.deriv.shape[-1]))[i])
+    idx = np.expand_dims(argFunc(a.value, axis=axis), axis)
+    value = np.take_along_axis(a.value, idx, axis).squeeze(axis)
+    deriv = np.take_along_axis(a.deriv, idx[..., np.newaxis], axis % a.ndim).squeeze(axis % a.ndim)
+    return DualArray(value, deriv)
+
+
+def _concatenate(arrays, axis=0):
+    nSeed = [x for x in arrays if isinstance(x, DualArray)][0].deriv.shape[-1]
+    arrays = [_asDual(x, nSeed) for x in arrays]
+    axis = axis % arrays[0].ndim
+    return DualArray(np.concatenate([x.value for x in arrays], axis), np.concatenate([x.deriv for x in arrays], axis))
+
+
+def _stack(arrays, axis=0):
+    nSeed = [x for x in arrays if isinstance(x, DualArray)][0].deriv.shape[-1]
+    arrays = [_asDual(x, nSeed) for x in arrays]
+    axis = axis % (arrays[0].ndim + 1)
+    return DualArray(np.stack([x.value for x in arrays], axis), np.stack([x.deriv for x in arrays], axis))
+
+
+def _hstack(arrays):
+    arrays = [_atleast_1d(x) for x in arrays]
+    return _concatenate(arrays, axis=0 if arrays[0].ndim == 1 else 1)
+
+
+def _atleast_1d(a):
+    if isinstance(a, DualArray) and a.ndim == 0:
+        return a.reshape(1)
+    return a if isinstance(a, DualArray) else np.atleast_1d(a)
+
+
+def _atleast_2d(a):
+    a = _atleast_1d(a)
+    if isinstance(a, DualArray) and a.ndim == 1:
+        return a.reshape((1, -1))
+    return a
+
+
+def _where(condition, x, y):
+    nSeed = (x if isinstance(x, DualArray) else y).deriv.shape[-1]
+    x = _asDual(x, nSeed)
+    y = _asDual(y, nSeed)
+    condition = np.asarray(_value(condition))
+    return DualArray(np.where(condition, x.value, y.value), np.where(condition[..., np.newaxis], x.deriv, y.deriv))
+
+
+def _binary(valueFunc, derivFunc):
+    """Create the rule for a binary ufunc from d(f)/d(a) and d(f)/d(b)"""
+
+    def rule(a, b, nSeed):
+        av = _value(a)
+        bv = _value(b)
+        value = valueFunc(av, bv)
+        dfda, dfdb = derivFunc(av, bv, value)
+        deriv = np.zeros(np.shape(value) + (nSeed,), np.result_type(value, float))
+        if isinstance(a, DualArray):
+            deriv = deriv + np.asarray(dfda)[..., np.newaxis] * a.deriv
+        if isinstance(b, DualArray):
+            deriv = deriv + np.asarray(dfdb)[..., np.newaxis] * b.deriv
+        return DualArray(value, deriv)
+
+    return rule
+
+
+def _powerDeriv(a, b, value):
+    dfda = b * np.power(a, b - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dfdb = np.where(np.asarray(a) > 0, value * np.log(np.where(np.asarray(a) > 0, a, 1)), 0.0)
+    return dfda, dfdb
+
+
+_UNARY = {
+    np.negative: lambda x: -np.ones_like(x, dtype=float),
+    np.positive: lambda x: np.ones_like(x, dtype=float),
+    np.absolute: lambda x: np.sign(x),
+    np.sqrt: lambda x: 0.5 / np.sqrt(x),
+    np.cbrt: lambda x: 1.0 / (3.0 * np.cbrt(x) ** 2),
+    np.square: lambda x: 2.0 * x,
+    np.reciprocal: lambda x: -1.0 / x ** 2,
+    np.exp: lambda x: np.exp(x),
+    np.expm1: lambda x: np.exp(x),
+    np.log: lambda x: 1.0 / x,
+    np.log10: lambda x: 1.0 / (x * np.log(10.0)),
+    np.log2: lambda x: 1.0 / (x * np.log(2.0)),
+    np.log1p: lambda x: 1.0 / (1.0 + x),
+    np.sin: lambda x: np.cos(x),
+    np.cos: lambda x: -np.sin(x),
+    np.tan: lambda x: 1.0 / np.cos(x) ** 2,
+    np.arcsin: lambda x: 1.0 / np.sqrt(1.0 - x ** 2),
+    np.arccos: lambda x: -1.0 / np.sqrt(1.0 - x ** 2),
+    np.arctan: lambda x: 1.0 / (1.0 + x ** 2),
+    np.sinh: lambda x: np.cosh(x),
+    np.cosh: lambda x: np.sinh(x),
+    np.tanh: lambda x: 1.0 - np.tanh(x) ** 2,
+}
+
+_BINARY = {
+    np.add: _binary(np.add, lambda a, b, f: (1.0, 1.0)),
+    np.subtract: _binary(np.subtract, lambda a, b, f: (1.0, -1.0)),
+    np.multiply: _binary(np.multiply, lambda a, b, f: (b, a)),
+    np.true_divide: _binary(np.true_divide, lambda a, b, f: (1.0 / b, -a / b ** 2)),
+    np.power: _binary(np.power, _powerDeriv),
+    np.maximum: _binary(np.maximum, lambda a, b, f: (np.asarray(a) >= b, np.asarray(a) < b)),
+    np.minimum: _binary(np.minimum, lambda a, b, f: (np.asarray(a) <= b, np.asarray(a) > b)),
+    np.arctan2: _binary(np.arctan2, lambda a, b, f: (b / (a ** 2 + b ** 2), -a / (a ** 2 + b ** 2))),
+    np.hypot: _binary(np.hypot, lambda a, b, f: (a / f, b / f)),
+}
+
+_COMPARISON = [np.less, np.less_equal, np.greater, np.greater_equal, np.equal, np.not_equal, np.isfinite, np.isnan]
+
+_FUNCTIONS = {
+    np.sum: _sum,
+    np.mean: _mean,
+    np.average: _average,
+    np.dot: _dot,
+    np.max: lambda a, axis=None: _extremum(a, np.argmax, axis),
+    np.min: lambda a, axis=None: _extremum(a, np.argmin, axis),
+    np.amax: lambda a, axis=None: _extremum(a, np.argmax, axis),
+    np.amin: lambda a, axis=None: _extremum(a, np.argmin, axis),
+    np.concatenate: _concatenate,
+    np.stack: _stack,
+    np.hstack: _hstack,
+    np.atleast_1d: _atleast_1d,
+    np.atleast_2d: _atleast_2d,
+    np.where: _where,
+    np.reshape: lambda a, newshape: a.reshape(newshape),
+    np.ravel: lambda a: a.ravel(),
+    np.squeeze: lambda a, axis=None: a.squeeze(axis),
+    np.transpose: lambda a, axes=None: a.transpose() if axes is None else a.transpose(axes),
+    np.shape: lambda a: a.shape,
+    np.ndim: lambda a: a.ndim,
+    np.size: lambda a: a.size,
+    np.copy: lambda a: a.copy(),
+}
+
+
+def seedInputs(funcs, keys):
+    """
+    Convert the functionals in keys to DualArrays that are seeded
+    with respect to each of their entries. As for the complex step,
+    an entry is a scalar functional or one index along the first axis
+    of an array functional.
+
+    Returns
+    -------
+    dualFuncs : dict
+        Dictionary of seeded DualArrays
+    nEntries : dict
+        Number of entries (and seeds) of each functional
+    """
+    nEntries = {}
+    for key in keys:
+        nEntries[key] = _nEntries(funcs[key])
+    nSeed = sum(nEntries.values())
+
+    dualFuncs = {}
+    seed = 0
+    for key in keys:
+        value = np.array(funcs[key], float)
+        deriv = np.zeros(value.shape + (nSeed,))
+        if _nEntries(funcs[key]) == 1:
+            deriv[..., seed] = 1.0
+        else:
+            for i in range(nEntries[key]):
+                deriv[i, ..., seed + i] = 1.0
+        dualFuncs[key] = DualArray(value, deriv)
+        seed += nEntries[key]
+
+    return dualFuncs, nEntries
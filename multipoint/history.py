@@ -0,0 +1,150 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import os
+import numpy as np
+
+from .transport import encodeJacobians, decodeJacobians
+from .utils import dkeys
+
+# Every record starts with this many bytes of header: five int64
+# values (magic, kind, ptID, fail, payload length) followed by the
+# hex hash of the design variables padded to a multiple of 16 bytes
+MAGIC = 0x4D504C4F47
+HASH_LEN = 40
+HEADER_LEN = 96
+
+KINDS = {"x": 0, "objective": 1, "sensitivity": 2, "funcs": 3, "gcon": 4}
+
+# Functionals and design variables are stored as single-block
+# "sensitivities" so that arrays are memory-mappable
+_VALUE = "value"
+
+# Kinds whose values are plain functionals rather than nested
+# dictionaries of sensitivities
+_FLAT_KINDS = ["x", "objective", "funcs"]
+
+
+def _records(data):
+    """
+    Yield the (offset, kind, ptID, fail, length) of every complete
+    record of the log data, stopping at the first record that is
+    torn or not a record at all
+    """
+    offset = 0
+    while offset + HEADER_LEN <= len(data):
+        magic, kind, ptID, fail, length = data[offset : offset + 40].view("int64")
+        if magic != MAGIC or length < 0 or offset + HEADER_LEN + length > len(data):
+            return
+        yield offset, int(kind), int(ptID), bool(fail), int(length)
+        offset += HEADER_LEN + int(length)
+
+
+class LogWriter(object):
+    """
+    Append-only binary log of evaluations. Every record holds the
+    results of one evaluation of one kind ('x', 'objective',
+    'sensitivity', 'funcs' or 'gcon') at one design point, encoded
+    with the same format as the sparse sensitivity exchange. All
+    records are padded to a multiple of 16 bytes so that the arrays
+    they hold can be used directly from a memory map of the file.
+
+    Parameters
+    ----------
+    fileName : str
+        Name of the log file. New records are appended to an
+        existing file, which is first truncated after its last complete
+        record so that a record torn when a job died is dropped.
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = open(fileName, "ab")
+        size = os.path.getsize(fileName)
+        if size > 0:
+            end = 0
+            for offset, kind, ptID, fail, length in _records(np.fromfile(fileName, "uint8")):
+                end = offset + HEADER_LEN + length
+            if end < size:
+                self.file.truncate(end)
+
+    def append(self, kind, xHash, values, fail=False, ptID=None):
+        """
+        Append one record to the log and flush it to the file.
+
+        Parameters
+        ----------
+        kind : str
+            One of the keys of KINDS
+        xHash : str
+            Hex hash of the design variables of the evaluation
+        values : dict
+            Functionals (or design variables) or nested dictionary of
+            sensitivities
+        fail : bool
+            Fail flag of the evaluation
+        ptID : int
+            Point ID of a dynamically scheduled set
+        """
+        keys = [key for key in dkeys(values) if key != "fail"]
+        if kind in _FLAT_KINDS:
+            values = dict((key, {_VALUE: values[key]}) for key in keys)
+        payload = encodeJacobians(values, keys)
+
+        header = np.zeros(HEADER_LEN, "uint8")
+        header[:40] = np.array(
+            [MAGIC, KINDS[kind], -1 if ptID is None else ptID, bool(fail), payload.nbytes], "int64"
+        ).view("uint8")
+        header[40 : 40 + HASH_LEN] = np.frombuffer(xHash.encode(), "uint8")
+
+        self.file.write(header.tobytes())
+        self.file.write(payload.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LogReader(object):
+    """
+    Read-only index of one or more logs written by LogWriter. The
+    files are memory mapped and only the record headers are read when
+    the index is built. A record that was only partially written when
+    the job died is ignored.
+
+    Parameters
+    ----------
+    fileNames : list
+        Names of the log files. Files that do not exist are skipped.
+    """
+
+    def __init__(self, fileNames):
+        self.index = {}
+        self.maps = []
+        for fileName in fileNames:
+            if not os.path.exists(fileName) or os.path.getsize(fileName) == 0:
+                continue
+            # Copy-on-write so that the records may be modified in
+            # memory without changing the file
+            data = np.asarray(np.memmap(fileName, "uint8", mode="c"))
+            self.maps.append(data)
+            for offset, kind, ptID, fail, length in _records(data):
+                xHash = data[offset + 40 : offset + 40 + HASH_LEN].tobytes().decode()
+                start = offset + HEADER_LEN
+                self.index[(kind, xHash, ptID)] = (data[start : start + length], fail)
+
+    def get(self, kind, xHash, ptID=None):
+        """
+        Return the (values, fail) of the last record of kind at the
+        design point with hash xHash, or None if there is no such
+        record. Arrays are returned as views into the memory map.
+        """
+        record = self.index.get((KINDS[kind], xHash, -1 if ptID is None else ptID))
+        if record is None:
+            return None
+
+        values = decodeJacobians(record[0])
+        if kind in _FLAT_KINDS:
+            values = dict((key, values[key][_VALUE]) for key in values)
+
+        return values, record[1]
@@ -0,0 +1,203 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import os
+import sys
+import threading
+import numpy as np
+from mpi4py import MPI
+
+# Every chunk in the log starts with four int64 values: magic, rank in
+# the set, member and the number of bytes that follow
+MAGIC = 0x4D504F5554
+HEADER_LEN = 32
+
+# Written to the pipe by flush() to find the end of the output so far
+_SENTINEL = b"\0multipoint-flush\0"
+
+# The file descriptors that are redirected. sys.stdout and sys.stderr
+# may have been replaced, for example by a test runner, so they are
+# not used to find them.
+_STDOUT = 1
+_STDERR = 2
+
+
+def _flushStreams():
+    """Flush the Python streams that may write to stdout and stderr.
+    Streams that were replaced by objects that cannot be flushed, or
+    closed as by utils.redirectIO(), are skipped."""
+    for stream in [sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__]:
+        flush = getattr(stream, "flush", None)
+        if flush is not None and not getattr(stream, "closed", False):
+            flush()
+
+
+class MemberLog(object):
+    """
+    Aggregated log of the output of all processors of a procSet. It
+    can be used instead of utils.redirectIO(): the stdout and stderr
+    of this processor are redirected to a pipe that a background
+    thread drains into a buffer in memory. flush() then writes the
+    buffers of all processors of comm to one shared log with a single
+    collective MPI-IO write, so no processor keeps a file of its own
+    open and the file system only sees one write per flush.
+
+    Every chunk of output is stored with the rank and member it came
+    from, and readMemberLog() sorts them again.
+
+    Parameters
+    ----------
+    comm : MPI.Intracomm
+        Communicator of the processors writing to the log, usually the
+        setComm returned by createCommunicators()
+    fileName : str
+        Name of the log. New output is appended to an existing log.
+    member : int
+        Member of this processor, stored with its output
+
+    Examples
+    --------
+    >>> comm, setComm, setFlags, groupFlags, ptID = MP.createCommunicators()
+    >>> log = MemberLog(setComm, 'cruise.mplog', ptID)
+    >>> log.redirect()
+    >>> ...
+    >>> log.flush()
+    >>> log.close()
+
+    If close() is not called, the redirected output since the last
+    flush is lost when the processor exits.
+    """
+
+    def __init__(self, comm, fileName, member=0):
+        self.comm = comm
+        self.member = member
+        self.file = MPI.File.Open(comm, fileName, MPI.MODE_WRONLY | MPI.MODE_CREATE | MPI.MODE_APPEND)
+        self.buffer = bytearray()
+        self.ready = None
+        self.lock = threading.Lock()
+        self.flushed = threading.Event()
+        self.readFd = None
+        self.writeFd = None
+        self.savedFds = None
+        self.thread = None
+
+    def redirect(self):
+        """Redirect stdout and stderr of this processor to the log. The
+        file descriptors 1 and 2 are redirected, so everything written
+        to them is captured, whether from Python or not."""
+        _flushStreams()
+        self.readFd, self.writeFd = os.pipe()
+        self.savedFds = (os.dup(_STDOUT), os.dup(_STDERR))
+        os.dup2(self.writeFd, _STDOUT)
+        os.dup2(self.writeFd, _STDERR)
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def write(self, text):
+        """Add text to the output of this processor"""
+        data = text.encode() if isinstance(text, str) else bytes(text)
+        if self.thread is not None:
+            # Keep the order with the redirected output
+            os.write(self.writeFd, data)
+        else:
+            with self.lock:
+                self.buffer += data
+
+    def flush(self):
+        """
+        Write the output of all processors of comm since the last
+        flush to the log. This is a collective call.
+        """
+        data = self._collect()
+        chunk = np.zeros(0, "uint8")
+        if len(data) > 0:
+            header = np.array([MAGIC, self.comm.rank, self.member, len(data)], "int64").view("uint8")
+            chunk = np.concatenate([header, np.frombuffer(bytes(data), "uint8")])
+        self.file.Write_ordered(chunk)
+
+    def close(self):
+        """Restore stdout and stderr, flush the log and close it. This
+        is a collective call."""
+        if self.file is None:
+            return
+        self.restore()
+        self.flush()
+        self.file.Close()
+        self.file = None
+
+    def restore(self):
+        """
+        Restore stdout and stderr of this processor. The output
+        redirected so far is kept in the buffer until the next flush.
+        """
+        if self.thread is None:
+            return
+        _flushStreams()
+        os.dup2(self.savedFds[0], _STDOUT)
+        os.dup2(self.savedFds[1], _STDERR)
+        for fd in self.savedFds:
+            os.close(fd)
+        # Closing the write end ends the thread once the pipe is drained
+        os.close(self.writeFd)
+        self.thread.join()
+        os.close(self.readFd)
+        self.thread = None
+
+    def _collect(self):
+        """Return the output written so far and clear the buffer"""
+        if self.thread is not None:
+            # Everything before the sentinel was written before this call
+            _flushStreams()
+            self.flushed.clear()
+            os.write(self.writeFd, _SENTINEL)
+            self.flushed.wait()
+            with self.lock:
+                data = self.ready
+                self.ready = None
+            return data
+
+        with self.lock:
+            data = self.buffer
+            self.buffer = bytearray()
+        return data
+
+    def _drain(self):
+        """Read the pipe into the buffer until it is closed"""
+        while True:
+            data = os.read(self.readFd, 65536)
+            if len(data) == 0:
+                return
+            with self.lock:
+                # Only the new data can complete the sentinel
+                start = max(0, len(self.buffer) - len(_SENTINEL))
+                self.buffer += data
+                index = self.buffer.find(_SENTINEL, start)
+                if index >= 0:
+                    self.ready = self.buffer[:index]
+                    self.buffer = self.buffer[index + len(_SENTINEL) :]
+                    self.flushed.set()
+
+
+def readMemberLog(fileName):
+    """
+    Read a log written by MemberLog.
+
+    Returns
+    -------
+    output : dict
+        Dictionary mapping each (member, rank) to the text written by
+        that processor, in the order it was written
+    """
+    data = np.fromfile(fileName, "uint8")
+    output = {}
+    offset = 0
+    while offset + HEADER_LEN <= len(data):
+        magic, rank, member, length = data[offset : offset + HEADER_LEN].view("int64")
+        if magic != MAGIC:
+            break
+        start = offset + HEADER_LEN
+        key = (int(member), int(rank))
+        output[key] = output.get(key, "") + data[start : start + length].tobytes().decode(errors="replace")
+        offset = start + length
+
+    return output
@@ -2,6 +2,10 @@
 # Imports
 # =============================================================================
 import os
+import time
+import atexit
+import json
+import pickle
 import inspect
 import types
 import copy
@@ -10,7 +14,24 @@ from collections import OrderedDict
 import numpy as np
 from mpi4py import MPI
 
-from .utils import MPError, dkeys, skeys, _extractKeys, _complexifyFuncs
+from .utils import (
+    MPError,
+    dkeys,
+    skeys,
+    _extractKeys,
+    _complexifyFuncs,
+    _nEntries,
+    _hashFuncs,
+    _perturbFuncs,
+    _colorColumns,
+    _sparsityPattern,
+)
+from .transport import FuncLayout, NodeShare, funcDescriptor, exchangeJacobians
+from .dual import DualArray, seedInputs
+from .profiling import Profiler
+from .history import LogWriter, LogReader
+from .directories import DirectoryManager
+from .memberlog import MemberLog
 
 # =============================================================================
 # MultiPoint Class
@@ -26,6 +47,92 @@ class multiPointSparse(object):
         are created. It is usually MPI_COMM_WORLD but may be
         another intraCommunicator that has already been created.
 
+    commMode : str
+        How the functionals are exchanged in obj(). 'pickle' (default)
+        broadcasts every functional separately as a pickled
+        object. 'buffer' packs all the functionals into one contiguous
+        NumPy buffer, using a layout that is determined on the first
+        call, and moves them (together with the fail flag) with a
+        single Allgatherv. Functionals that are not numeric always use
+        'pickle'.
+
+    sensCommMode : str
+        How the functional sensitivities are exchanged in
+        sens(). 'pickle' (default) broadcasts every functional
+        separately as a pickled object. 'sparse' encodes each
+        (functional, dvSet) block in a binary format that only
+        carries the nonzero entries and moves all of them with a
+        single Allgatherv.
+
+    compressSens : bool
+        Flag to additionally compress the encoded sensitivities with
+        zlib when sensCommMode is 'sparse'.
+
+    objConPlacement : str
+        Where the objCon function (and its derivatives) are
+        evaluated. 'all' (default) evaluates it on every rank and
+        broadcasts the result of rank 0. 'root' only evaluates it on
+        rank 0 and broadcasts the result. 'setRoots' evaluates it on
+        the root of every procSet and broadcasts the result within each
+        set. 'local' evaluates it on every rank without any
+        communication, which requires objCon to be deterministic. The
+        distributed complex step of setObjCon() always uses every rank.
+
+    profile : bool
+        Flag to record the time of every phase of obj() and sens() on
+        every rank: the user functions, the time spent waiting for the
+        slowest procSet, the exchanges, objCon and its derivatives, as
+        well as the bytes sent per functional and the peak memory. A
+        barrier is added before each exchange to separate the waiting
+        time from the communication. See getProfile() and
+        saveProfile().
+
+    cacheSize : int
+        Number of design points whose obj() and sens() results are kept
+        in a least-recently-used cache. When obj() or sens() is called
+        again with the same design variables on every rank, the cached
+        result is returned without calling any user function or
+        communicating the functionals. Setting or adding a user
+        function, the objCon function or the optProb invalidates all the
+        cached results. Failed evaluations are not cached, so they are
+        evaluated again. The default of 0 disables the cache.
+
+    cacheDir : str
+        Optional directory in which the root processor additionally
+        stores every result on disk, so that a restarted optimization
+        can reuse the results of a previous run.
+
+    historyDir : str
+        Optional directory in which every obj() and sens() call is
+        recorded in append-only binary logs: the root of every member
+        logs the results of its user functions and the root processor
+        logs x, the final functionals and gcon, including the ones
+        returned from the cache. See history.LogReader to read them.
+
+    replayHistory : bool
+        Flag to replay the logs in historyDir of a previous run. Members
+        that find their results for the current x in the logs use them
+        instead of calling their user functions, so a restarted
+        optimization quickly fast-forwards to where the previous run
+        stopped. New results are appended to the same logs.
+
+    topology : str
+        Topology of the exchanges of the functionals and their
+        sensitivities. With 'flat' every processor takes part in the
+        exchanges on gcomm. With 'hierarchical' only the roots of the
+        members exchange the data, on a communicator of their own, and
+        every root then broadcasts the result to the rest of its
+        member. This reduces the number of processors in the
+        collectives from the size of gcomm to the number of members.
+        With 'shared' the member roots and the first processor of
+        every node exchange the data, and every node keeps a single
+        copy of the functionals and sensitivities in MPI shared memory
+        that all its processors read as read-only views. This reduces
+        both the memory and the traffic between nodes. A member root
+        that is not the first processor of its node still receives all
+        the data in the exchange, so its memory peaks at one extra copy
+        until the copy of the node is shared.
+
     Examples
     --------
     We will setup a multipoint problem with two procSets: a 'cruise'
@@ -97,24 +204,93 @@ class multiPointSparse(object):
     the optProb (Optimization instance).
     """
 
-    def __init__(self, gcomm):
+    def __init__(
+        self,
+        gcomm,
+        commMode="pickle",
+        sensCommMode="pickle",
+        compressSens=False,
+        objConPlacement="all",
+        profile=False,
+        cacheSize=0,
+        cacheDir=None,
+        historyDir=None,
+        replayHistory=False,
+        topology="flat",
+    ):
         assert type(gcomm) == MPI.Intracomm
+        if commMode not in ["pickle", "buffer"]:
+            raise MPError("commMode must be one of 'pickle' or 'buffer'.")
+        if sensCommMode not in ["pickle", "sparse"]:
+            raise MPError("sensCommMode must be one of 'pickle' or 'sparse'.")
+        if objConPlacement not in ["all", "root", "setRoots", "local"]:
+            raise MPError("objConPlacement must be one of 'all', 'root', 'setRoots' or 'local'.")
+        if topology not in ["flat", "hierarchical", "shared"]:
+            raise MPError("topology must be one of 'flat', 'hierarchical' or 'shared'.")
         self.gcomm = gcomm
+        self.commMode = commMode
+        self.sensCommMode = sensCommMode
+        self.compressSens = compressSens
+        self.objConPlacement = objConPlacement
+        self.topology = topology
+        self.profiler = Profiler(profile)
+        self.cacheSize = int(cacheSize)
+        self.cacheDir = cacheDir
+        self.objCache = OrderedDict()
+        self.sensCache = OrderedDict()
+        self.stateHash = None
+        self.cacheGeneration = 0
+        if self.cacheDir is not None and self.gcomm.rank == 0:
+            os.makedirs(self.cacheDir, exist_ok=True)
+        if replayHistory and historyDir is None:
+            raise MPError("historyDir must be given to replay the history.")
+        self.historyDir = historyDir
+        self.replayHistory = replayHistory
+        self.historyLog = None
+        self.historyReader = None
+        self.rootLog = None
+        self.dirManager = None
+        self.memberLog = None
         self.pSet = OrderedDict()
         self.dummyPSet = set()
         self.pSetRoot = None
+        self.setComm = None
         self.objective = None
         self.setFlags = None
         self.constraints = None
         self.cumSets = [0]
+        self.rankLayout = None
         self.objCommPattern = None
+        self.objLayout = None
         self.sensCommPattern = None
+        self.rootComm = None
+        self.memberComm = None
+        self.exchangeComm = None
+        self.nodeComm = None
+        self.nodeShare = None
+        self.nExchangeProcs = None
+        self.keyHashes = {}
+        self.rootKeys = {}
         # User-specified function
         self.userObjCon = None
         self.nUserObjConArgs = None
+        self.batchedObjCon = False
+        self.objConBatchSize = None
+        self.userObjConSens = "CS"
+        self.distributedObjCon = False
+        self.cacheObjConJac = False
+        self.checkObjConLinear = False
+        self.colorObjCon = False
+        self.objConColoring = None
+        self.objConJacCache = None
+        self.objConLinear = None
+        self.objConMutatesInputs = None
 
         # Information used for determining keys for CS loop
         self.conKeys = set()
+        self.objKeys = set()
+        self.sparseThreshold = None
+        self.conPatterns = {}
         self.outputWRT = {}
         self.outputSize = {}
         self.dvSize = {}
@@ -125,7 +301,9 @@ class multiPointSparse(object):
         self.outputKeys = None
         self.passThroughKeys = None
 
-    def addProcessorSet(self, setName, nMembers, memberSizes):
+    def addProcessorSet(
+        self, setName, nMembers, memberSizes, nPoints=None, timeBudget=None, speculative=False, dvGroups=None
+    ):
         """
         A Processor set is defined as one or more groups of processors
         that use the same obj() and sens() routines. Members of
@@ -133,6 +311,17 @@ class multiPointSparse(object):
         number of functions. In all cases, the function names must be
         unique.
 
+        If nPoints is given, the set is scheduled dynamically: the
+        nMembers members pull the nPoints points from a shared work
+        queue until all of them are evaluated, so a set may have fewer
+        members than points. The obj and sens functions of such a set
+        are called once per point as func(x, ptID) and func(x, funcs,
+        ptID) respectively, and must return functionals whose names
+        are unique for every point (for example by including ptID). The
+        sens function of a point is always called on the member that
+        evaluated its obj function in the last obj() call, so it can
+        use the state of the analysis of that point.
+
         Parameters
         ----------
         setName : str
@@ -147,10 +336,43 @@ class multiPointSparse(object):
             If a list or array is provided, a different number of processors
             on each member can be specified.
 
+        nPoints : int
+            Number of points evaluated by the members of a dynamically
+            scheduled set. The default of None statically assigns one
+            point to each member.
+
+        timeBudget : float
+            Wall-clock budget in seconds for the evaluation of one point
+            by the obj or sens functions of the set. A point that takes
+            longer is reported with fail=True and recorded as a
+            straggler, see getStragglers(). The budget does not
+            interrupt the user functions, for static and scheduled sets
+            alike: a late point is only flagged once its functions
+            return. For obj() and sens() to return on time, long-running
+            user functions must poll timeRemaining() or stopRequested()
+            and return early.
+
+        speculative : bool
+            Flag to speculatively re-run the points of a dynamically
+            scheduled set that are still being evaluated on members that
+            have run out of points. The result of the member that
+            finishes a point first is used and stopRequested() becomes
+            True on the other member.
+
+        dvGroups : list
+            Names of the design variable groups the functions of the set
+            depend on. If they are given, the set is only evaluated again
+            when one of them changed since its last successful
+            evaluation. Otherwise the last functionals or sensitivities
+            of the set are reused. Setting or adding a function of the
+            set discards them. The default of None evaluates the set in
+            every call.
+
         Examples
         --------
         >>> MP.addProcessorSet('cruise', 3, 32)
         >>> MP.addProcessorSet('maneuver', 2, [10, 20])
+        >>> MP.addProcessorSet('sweep', 4, 16, nPoints=40)
         """
         # Lets let the user explicitly set nMembers to 0. This is
         # equalevent to just turning off that proc set.
@@ -158,21 +380,47 @@ class multiPointSparse(object):
             self.dummyPSet.add(setName)
         else:
             nMembers = int(nMembers)
-            memberSizes = np.atleast_1d(memberSizes)
+            memberSizes = np.atleast_1d(memberSizes).astype(int)
             if len(memberSizes) == 1:
-                memberSizes = np.ones(nMembers) * memberSizes[0]
+                memberSizes = np.full(nMembers, memberSizes[0])
             else:
                 if len(memberSizes) != nMembers:
                     raise MPError("The supplied memberSizes list is not the correct length.")
-
-            self.pSet[setName] = procSet(setName, nMembers, memberSizes, len(self.pSet))
-
-    def createCommunicators(self):
+            if nPoints is not None:
+                nPoints = int(nPoints)
+                if nPoints < 1:
+                    raise MPError("nPoints must be a positive integer.")
+            if speculative and nPoints is None:
+                raise MPError("Only dynamically scheduled sets with nPoints can be speculative.")
+
+            self.pSet[setName] = procSet(setName, nMembers, memberSizes, len(self.pSet), nPoints)
+            self.pSet[setName].timeBudget = timeBudget
+            self.pSet[setName].speculative = speculative
+            self.pSet[setName].dvGroups = None if dvGroups is None else list(dvGroups)
+
+    def createCommunicators(self, memberSizes=None, layoutFile=None):
         """
         Create the communicators after all the procSets have been
         added. All procSets MUST be added before this routine is
         called.
 
+        Parameters
+        ----------
+        memberSizes : dict
+            Optional dictionary mapping set names to the list of member
+            sizes to use instead of the ones given to
+            addProcessorSet(), for example the layout proposed by
+            planner.planMemberSizes().
+        layoutFile : str
+            Optional JSON file storing the layout, i.e. the member sizes
+            of every set, so that later runs reuse the same layout, for
+            example one planned with planner.planMemberSizes(). If the
+            file exists, the layout is read from it on the root
+            processor and used instead of the member sizes given to
+            addProcessorSet(). An MPError is raised if it does not match
+            the procSets, the number of processors or the memberSizes
+            given here. Otherwise the layout is written to it.
+
         Returns
         -------
         comm : MPI.Intracomm
@@ -199,61 +447,182 @@ class multiPointSparse(object):
         >>> setFlags['cruise'] and groupFlags[1] == True
         """
 
-        # First we determine the total number of required procs:
-        nProc = 0
-        for setName in dkeys(self.pSet):
-            nProc += self.pSet[setName].nProc
+        if memberSizes is not None:
+            for setName in dkeys(memberSizes):
+                if setName not in self.pSet:
+                    continue
+                sizes = np.atleast_1d(memberSizes[setName]).astype(int)
+                if len(sizes) != self.pSet[setName].nMembers:
+                    raise MPError("The supplied memberSizes list for set '%s' is not the correct length." % setName)
+                self.pSet[setName].memberSizes = sizes
+                self.pSet[setName].nProc = int(np.sum(sizes))
+
+        if layoutFile is not None:
+            layout = None
+            if self.gcomm.rank == 0 and os.path.exists(layoutFile):
+                with open(layoutFile, "r") as f:
+                    layout = json.load(f)
+            layout = self.gcomm.bcast(layout, root=0)
+            if layout is not None:
+                self._applyLayout(layout, memberSizes)
+            elif self.gcomm.rank == 0:
+                with open(layoutFile, "w") as f:
+                    json.dump(self._getLayout(), f, indent=1)
+
+        pSets = list(self.pSet.values())
+        cumSets, memberRoots, setID, memberID = self._computeLayout()
+        setFlags = dict((pSet.setName, pSet.setID == setID) for pSet in pSets)
+
+        # The communicators are created from the groups of the layout:
+        # unlike Split, Create_group only involves the ranks of the new
+        # communicator, and no barrier is needed between the sets
+        group = self.gcomm.Get_group()
+        setGroup = group.Range_incl([(cumSets[setID], cumSets[setID + 1] - 1, 1)])
+        setComm = self.gcomm.Create_group(setGroup)
+        setGroup.Free()
+
+        # Let the procSet create the communicators of its members
+        pSet = pSets[setID]
+        pSet.gcomm = setComm
+        pSet.createCommunicators()
+        comm = pSet.comm
+        groupFlags = pSet.groupFlags
+        ptID = pSet.groupID
 
-        # Check the sizes
-        if nProc < self.gcomm.size or nProc > self.gcomm.size:
-            raise MPError("multiPointSparse must be called with EXACTLY %d processors." % (nProc))
+        self.setFlags = setFlags
+        self.setComm = setComm
+        self.cumSets = cumSets
+        self.rankLayout = (memberRoots, setID, memberID)
+
+        # The roots of all members are the only ones that send data
+        self.rootComm = MPI.COMM_NULL
+        if comm.rank == 0:
+            rootGroup = group.Incl(np.concatenate(memberRoots))
+            self.rootComm = self.gcomm.Create_group(rootGroup)
+            rootGroup.Free()
+        group.Free()
+        self.memberComm = comm
+        if self.topology == "flat":
+            self.exchangeComm = self.gcomm
+            self.nExchangeProcs = self.gcomm.size
+        elif self.topology == "hierarchical":
+            self.exchangeComm = self.rootComm
+            self.nExchangeProcs = sum(len(roots) for roots in memberRoots)
+        else:
+            # The member roots send the data and the first rank of every
+            # node receives it for the whole node
+            self.nodeComm = self.gcomm.Split_type(MPI.COMM_TYPE_SHARED, key=self.gcomm.rank)
+            self.nodeShare = NodeShare(self.nodeComm)
+            exchanging = comm.rank == 0 or self.nodeComm.rank == 0
+            self.exchangeComm = self.gcomm.Split(0 if exchanging else MPI.UNDEFINED, self.gcomm.rank)
+            self.nExchangeProcs = self.gcomm.allreduce(int(exchanging))
+        # Now just append the dummy procSets:
+        for key in skeys(self.dummyPSet):
+            self.setFlags[key] = False
 
-        # Create a cumulative size array
-        setCount = len(self.pSet)
-        setSizes = np.zeros(setCount)
-        for setName in dkeys(self.pSet):
-            setSizes[self.pSet[setName].setID] = self.pSet[setName].nProc
+        self.pSetRoot = {}
+        for key in dkeys(self.pSet):
+            self.pSetRoot[key] = cumSets[self.pSet[key].setID]
 
-        cumSets = np.zeros(setCount + 1, "intc")
-        for i in range(setCount):
-            cumSets[i + 1] = cumSets[i] + setSizes[i]
+        self.profiler.label = "%s member %d rank %d" % (self.getSetName(), ptID, comm.rank)
 
-        setFlags = {}
+        if self.historyDir is not None:
+            self._openHistory()
 
-        # Determine the member_key for each processor
-        for key in dkeys(self.pSet):
-            if self.gcomm.rank >= cumSets[self.pSet[key].setID] and self.gcomm.rank < cumSets[self.pSet[key].setID + 1]:
-                memberKey = self.pSet[key].setID
-                setFlags[self.pSet[key].setName] = True
-            else:
-                setFlags[self.pSet[key].setName] = False
-
-        setComm = self.gcomm.Split(memberKey)
+        return comm, setComm, setFlags, groupFlags, ptID
 
-        # Set this new_comm into each pSet and let each procSet create
-        # its own split:
-        for key in dkeys(self.pSet):
-            if setFlags[key]:
+    def _computeLayout(self):
+        """
+        Compute the layout of the procSets on gcomm. The ranks of every
+        set and of every member are contiguous, so the whole layout
+        follows from the cumulative sizes.
 
-                self.pSet[key].gcomm = setComm
-                self.pSet[key].createCommunicators()
+        Returns
+        -------
+        cumSets : numpy array
+            The first rank of every set, followed by the size of gcomm
+        memberRoots : list
+            The ranks of the member roots of every set
+        setID : int
+            The set of this processor
+        memberID : int
+            The member of this processor in its set
+        """
+        pSets = list(self.pSet.values())
+        cumSets = np.zeros(len(pSets) + 1, "intc")
+        cumSets[1:] = np.cumsum([pSet.nProc for pSet in pSets])
+        nProc = cumSets[-1]
 
-                self.gcomm.barrier()
+        # Check the sizes
+        if nProc != self.gcomm.size:
+            raise MPError("multiPointSparse must be called with EXACTLY %d processors." % (nProc))
 
-                comm = self.pSet[key].comm
-                groupFlags = self.pSet[key].groupFlags
-                ptID = self.pSet[key].groupID
+        memberRoots = [cumSets[pSet.setID] + np.cumsum(pSet.memberSizes) - pSet.memberSizes for pSet in pSets]
+        setID = int(np.searchsorted(cumSets, self.gcomm.rank, side="right")) - 1
+        memberID = int(np.searchsorted(memberRoots[setID], self.gcomm.rank, side="right")) - 1
 
-        self.setFlags = setFlags
-        # Now just append the dummy procSets:
-        for key in skeys(self.dummyPSet):
-            self.setFlags[key] = False
+        return cumSets, memberRoots, setID, memberID
 
-        self.pSetRoot = {}
-        for key in dkeys(self.pSet):
-            self.pSetRoot[key] = cumSets[self.pSet[key].setID]
+    def _getLayout(self):
+        """Return the layout of the procSets as a JSON serializable
+        dictionary, listing the member sizes of every set in order"""
+        return {
+            "nProc": int(sum(pSet.nProc for pSet in self.pSet.values())),
+            "sets": [
+                {"setName": pSet.setName, "memberSizes": pSet.memberSizes.tolist()} for pSet in self.pSet.values()
+            ],
+        }
 
-        return comm, setComm, setFlags, groupFlags, ptID
+    def _applyLayout(self, layout, memberSizes=None):
+        """
+        Use the member sizes of a layout returned by _getLayout(). The
+        sets given in memberSizes must already have the same sizes.
+        """
+        setNames = [entry["setName"] for entry in layout["sets"]]
+        nProc = sum(sum(entry["memberSizes"]) for entry in layout["sets"])
+        if setNames != list(self.pSet.keys()) or layout["nProc"] != self.gcomm.size or nProc != self.gcomm.size:
+            raise MPError("The cached layout does not match the procSets or the number of processors.")
+        for entry in layout["sets"]:
+            pSet = self.pSet[entry["setName"]]
+            sizes = np.array(entry["memberSizes"], int)
+            if len(sizes) != pSet.nMembers:
+                raise MPError("The cached layout of set '%s' does not have the correct length." % pSet.setName)
+            if memberSizes is not None and pSet.setName in memberSizes and not np.array_equal(sizes, pSet.memberSizes):
+                raise MPError("The cached layout of set '%s' does not match the given memberSizes." % pSet.setName)
+            pSet.memberSizes = sizes
+            pSet.nProc = int(np.sum(pSet.memberSizes))
+
+    def _openHistory(self):
+        """
+        Open the log of every member root and the root processor in
+        historyDir. When replaying, the existing log of the member is
+        read first, or the logs of the whole set for a dynamically
+        scheduled set since its points may have been evaluated by any
+        of its members.
+        """
+        if self.gcomm.rank == 0:
+            os.makedirs(self.historyDir, exist_ok=True)
+        self.gcomm.barrier()
+
+        setName = self.getSetName()
+        pSet = self.pSet[setName]
+        if pSet.comm.rank == 0:
+            if self.replayHistory:
+                if pSet.nPoints is None:
+                    fileNames = [self._historyFile(setName, pSet.groupID)]
+                else:
+                    fileNames = [self._historyFile(setName, i) for i in range(pSet.nMembers)]
+                self.historyReader = LogReader(fileNames)
+        # The writers drop torn records at the end of the logs, which
+        # must not happen while another member still maps them
+        self.gcomm.barrier()
+        if pSet.comm.rank == 0:
+            self.historyLog = LogWriter(self._historyFile(setName, pSet.groupID))
+        if self.gcomm.rank == 0:
+            self.rootLog = LogWriter(os.path.join(self.historyDir, "root.mplog"))
+
+    def _historyFile(self, setName, member):
+        return os.path.join(self.historyDir, "%s_%d.mplog" % (setName, member))
 
     def getSetName(self):
         """After MP.createCommunicators is call, this routine may be called
@@ -270,18 +639,28 @@ class multiPointSparse(object):
             if self.setFlags[iset]:
                 return iset
 
-    def createDirectories(self, rootDir):
+    def createDirectories(self, rootDir, scratchDir=None):
 
         """
         This function can be called only after all the procSets have
         been added. This can facilitate distingushing output files
         when there are a large number of procSets and/or members of
-        procSets.
+        procSets. After createCommunicators(), the member roots create
+        the directories of their members in parallel. Before it, the
+        root processor creates all of them.
 
         Parameters
         ----------
         rootDir : str
             Root path where directories are to be created
+        scratchDir : str
+            Optional node-local scratch path, such as /tmp. If it is
+            given, the directories returned for the set of this
+            processor are staged in scratchDir instead, and their
+            contents are copied back to the directories in rootDir in
+            the background after every evaluation of the set and by
+            flushDirectories(). This requires createCommunicators()
+            to be called first.
 
         Returns
         -------
@@ -306,22 +685,235 @@ class multiPointSparse(object):
         if len(self.pSet) == 0:
             return
 
+        if self.rankLayout is None and scratchDir is not None:
+            raise MPError("createCommunicators must be called before createDirectories to use a scratchDir.")
+
+        self.dirManager = DirectoryManager(rootDir, scratchDir)
         ptDirs = {}
         for key in dkeys(self.pSet):
-            ptDirs[key] = []
-            for i in range(self.pSet[key].nMembers):
-                dirName = rootDir + "/%s_%d" % (self.pSet[key].setName, i)
-                ptDirs[key].append(dirName)
-
-                if self.gcomm.rank == 0:  # Only global root proc makes
-                    # directories
-                    os.system("mkdir -p %s" % (dirName))
+            pSet = self.pSet[key]
+            # A dynamically scheduled set gets one directory per point
+            nDirs = pSet.nMembers
+            if pSet.nPoints is not None:
+                nDirs = pSet.nPoints
+            dirNames = ["%s_%d" % (pSet.setName, i) for i in range(nDirs)]
+            ptDirs[key] = [os.path.join(rootDir, dirName) for dirName in dirNames]
+
+            if self.rankLayout is None:
+                if self.gcomm.rank == 0:
+                    self.dirManager.create(dirNames)
+                continue
+
+            # The member roots create the directories in parallel
+            memberRoots, setID, memberID = self.rankLayout
+            owners = memberRoots[pSet.setID][np.arange(nDirs) % pSet.nMembers]
+            self.dirManager.create([dirNames[i] for i in range(nDirs) if owners[i] == self.gcomm.rank])
+
+            if scratchDir is not None and pSet.setID == setID:
+                stageName = "%s_member%d" % (key, memberID)
+                if pSet.nPoints is None:
+                    ptDirs[key][memberID] = self.dirManager.stage(stageName, [dirNames[memberID]])[0]
+                else:
+                    # Any member may evaluate any point of a scheduled set
+                    ptDirs[key] = self.dirManager.stage(stageName, dirNames)
+
+        self.gcomm.barrier()
 
         return ptDirs
 
+    def flushDirectories(self, wait=True):
+        """
+        Copy the contents of the directories staged in node-local
+        scratch by createDirectories() back to rootDir. This is done in
+        the background after every evaluation of a set, so it only needs
+        to be called at the end of the optimization to wait for the
+        last files. This is a collective call.
+
+        Parameters
+        ----------
+        wait : bool
+            Flag to wait until all the files are copied
+        """
+        if self.dirManager is not None:
+            self.dirManager.flush(self.memberComm, wait)
+
+    def redirectOutput(self, logDir):
+        """
+        Redirect stdout and stderr of every processor to one aggregated
+        log per procSet, logDir/<setName>.mplog, instead of one file per
+        processor as with utils.redirectIO(). The output is buffered in
+        memory and written to the log with one collective write after
+        every evaluation of the set. The log can be read with
+        memberlog.readMemberLog(). This must be called after
+        createCommunicators() and is a collective call. closeOutput()
+        must be called at the end to write the remaining output and
+        close the logs. Otherwise stdout and stderr are only restored
+        at exit, without any collective call, and the output since the
+        last evaluation is lost.
+
+        Parameters
+        ----------
+        logDir : str
+            Directory of the logs
+        """
+        self.closeOutput()
+        if self.gcomm.rank == 0:
+            os.makedirs(logDir, exist_ok=True)
+        self.gcomm.barrier()
+
+        setName = self.getSetName()
+        self.memberLog = MemberLog(self.setComm, os.path.join(logDir, "%s.mplog" % setName), self.pSet[setName].groupID)
+        self.memberLog.redirect()
+        atexit.register(self._restoreOutput)
+
+    def closeOutput(self):
+        """
+        Write the output since the last evaluation to the logs of
+        redirectOutput(), restore stdout and stderr and close the
+        logs. This is a collective call.
+        """
+        if self.memberLog is not None:
+            atexit.unregister(self._restoreOutput)
+            self.memberLog.close()
+            self.memberLog = None
+
+    def _restoreOutput(self):
+        """Restore stdout and stderr at exit. The ranks may exit at
+        different times, so no collective call can be made here."""
+        if self.memberLog is not None:
+            self.memberLog.restore()
+
+    def timeRemaining(self):
+        """
+        Return the number of seconds left in the timeBudget of the point
+        this processor is evaluating, or infinity if its set has no
+        budget. This may be polled by long-running user functions.
+        """
+        pSet = self.pSet[self.getSetName()]
+        if pSet.timeBudget is None or pSet.pointStart is None:
+            return np.inf
+        return pSet.timeBudget - (time.time() - pSet.pointStart)
+
+    def stopRequested(self):
+        """
+        Return True if the user functions should stop the evaluation of
+        the current point: either its timeBudget is used up, or another
+        member of a speculative set has already finished it. The point
+        is then reported with fail=True or its result is discarded
+        anyway. This is a collective call on the member communicator.
+        """
+        pSet = self.pSet[self.getSetName()]
+        stop = self.timeRemaining() < 0.0 or pSet.pointDone()
+        return pSet.comm.bcast(stop, root=0)
+
+    def getStragglers(self):
+        """
+        Return the points that exceeded the timeBudget of their set in
+        all the obj() and sens() calls so far. This is a collective
+        call on gcomm.
+
+        Returns
+        -------
+        stragglers : list
+            One record per straggling point with the set name, the
+            member, the function type, the point ID (None for a static
+            set), the wall time and the budget
+        """
+        stragglers = []
+        for key in dkeys(self.pSet):
+            if self.setFlags[key] and self.pSet[key].comm.rank == 0:
+                stragglers.extend(self.pSet[key].stragglers)
+
+        return [record for procRecords in self.gcomm.allgather(stragglers) for record in procRecords]
+
+    def getTimings(self):
+        """
+        Return the wall times of the user functions recorded by every
+        member in all the obj() and sens() calls so far. This is a
+        collective call on gcomm.
+
+        Returns
+        -------
+        records : list
+            One record per member with the set name, the member index,
+            the number of processors of the member and the list of wall
+            times of each function type ('objective' and 'sensitivity')
+        """
+        records = []
+        for key in dkeys(self.pSet):
+            if self.setFlags[key] and self.pSet[key].comm.rank == 0:
+                pSet = self.pSet[key]
+                records.append(
+                    {
+                        "setName": key,
+                        "member": int(pSet.groupID),
+                        "nProc": int(pSet.comm.size),
+                        "times": pSet.times,
+                    }
+                )
+
+        return [record for procRecords in self.gcomm.allgather(records) for record in procRecords]
+
+    def saveTimings(self, fileName):
+        """
+        Write the timings returned by getTimings() to a JSON file that
+        can be read by planner.loadTimings() to plan the memberSizes of
+        a later run. This is a collective call on gcomm.
+
+        Parameters
+        ----------
+        fileName : str
+            Name of the file to write
+        """
+        records = self.getTimings()
+        if self.gcomm.rank == 0:
+            with open(fileName, "w") as f:
+                json.dump(records, f, indent=1)
+        self.gcomm.barrier()
+
+    def getProfile(self):
+        """
+        Return the aggregated profile of all the obj() and sens() calls
+        so far, see Profiler.report(). The constructor must have been
+        called with profile=True. This is a collective call on gcomm.
+
+        Returns
+        -------
+        report : dict
+            The report on the root of gcomm, None on all other ranks
+        """
+        if not self.profiler.enabled:
+            raise MPError("Profiling must be enabled with profile=True to get the profile.")
+        return self.profiler.report(self.gcomm)
+
+    def saveProfile(self, fileName, fileFormat="json"):
+        """
+        Write the aggregated profile to a file on the root of
+        gcomm. This is a collective call on gcomm.
+
+        Parameters
+        ----------
+        fileName : str
+            Name of the file to write
+        fileFormat : str
+            'json' (default) for the aggregated report or 'trace' for a
+            Chrome trace event file that can be opened with
+            chrome://tracing or Perfetto
+        """
+        if not self.profiler.enabled:
+            raise MPError("Profiling must be enabled with profile=True to save the profile.")
+        if fileFormat not in ["json", "trace"]:
+            raise MPError("fileFormat must be one of 'json' or 'trace'.")
+        self.profiler.save(self.gcomm, fileName, fileFormat)
+        self.gcomm.barrier()
+
     def setProcSetObjFunc(self, setName, func):
         """
-        Set a single python function handle to compute the functionals
+        Set a single python function handle to compute the functionals.
+        Only the functionals returned on the root processor of every
+        member are used: a functional that is only returned on the other
+        processors of a member is never communicated. The same holds for
+        the sensitivities returned by the sens functions.
 
         Parameters
         ----------
@@ -338,11 +930,15 @@ class multiPointSparse(object):
             raise MPError("func must be a Python function handle.")
 
         self.pSet[setName].objFunc = [func]
+        self.pSet[setName].lastResults.clear()
+        self._invalidateCache()
 
     def setProcSetSensFunc(self, setName, func):
         """
         Set the python function handle to compute the derivative of
-        the functionals
+        the functionals. As for setProcSetObjFunc(), only the
+        sensitivities returned on the root processor of every member are
+        used.
 
         Parameters
         ----------
@@ -359,6 +955,8 @@ class multiPointSparse(object):
             raise MPError("func must be a Python function handle.")
 
         self.pSet[setName].sensFunc = [func]
+        self.pSet[setName].lastResults.clear()
+        self._invalidateCache()
 
     def addProcSetObjFunc(self, setName, func):
         """
@@ -379,6 +977,8 @@ class multiPointSparse(object):
             raise MPError("func must be a Python function handle.")
 
         self.pSet[setName].objFunc.append(func)
+        self.pSet[setName].lastResults.clear()
+        self._invalidateCache()
 
     def addProcSetSensFunc(self, setName, func):
         """
@@ -402,8 +1002,21 @@ class multiPointSparse(object):
             raise MPError("func must be a Python function handle.")
 
         self.pSet[setName].sensFunc.append(func)
-
-    def setObjCon(self, func):
+        self.pSet[setName].lastResults.clear()
+        self._invalidateCache()
+
+    def setObjCon(
+        self,
+        func,
+        batched=False,
+        batchSize=None,
+        sens="CS",
+        distributed=False,
+        cacheJac=False,
+        checkLinear=False,
+        coloring=False,
+        copyInputs=None,
+    ):
         """
         Set the python function handle to compute the final objective
         and constraints that are combinations of the functionals.
@@ -412,6 +1025,75 @@ class multiPointSparse(object):
         ----------
         func : Python function
             Python function handle
+
+        batched : bool
+            Flag to specify that func is vectorized. Every input
+            functional passed to a batched function carries an extra
+            leading axis (of length one in obj()) and every returned
+            output must carry the same leading axis. The pass-through
+            functionals are passed unchanged. This allows the complex
+            step derivatives to be evaluated with a single call instead
+            of one call per entry of every input.
+
+        batchSize : int
+            Maximum number of perturbations evaluated in a single call
+            of a batched function. The default is to evaluate all of them
+            at once.
+
+        sens : str or Python function
+            How the derivatives of func are computed. 'CS' (default) uses
+            the complex step method. 'AD' evaluates func once with
+            forward mode dual numbers, which requires func to only use
+            the NumPy operations supported by multipoint.dual.DualArray.
+            Array outputs must be built with np.concatenate or np.stack,
+            not np.array or a list. Alternatively, a Python function with the same arguments as
+            func may be given that returns the Jacobian directly as a
+            nested dictionary, jac[outputKey][inputKey], of arrays of size
+            (outputSize, nEntries), where nEntries is one for a scalar
+            input and the length of the first axis otherwise. Missing
+            entries are assumed to be zero.
+
+        distributed : bool
+            Flag to split the complex step perturbations across all the
+            ranks of gcomm instead of evaluating all of them on every
+            rank. Each rank then computes a partial gradient and the
+            results are summed with a single Allreduce.
+
+        cacheJac : bool
+            Flag to keep the derivatives of func with respect to the
+            functionals and reuse them as long as the values of the
+            functionals do not change.
+
+        checkLinear : bool
+            Flag to check whether func is linear. The first time the
+            derivatives are needed, they are also evaluated at a
+            randomly perturbed point, where the pass-through functionals
+            are perturbed as well if func takes them. If both agree, the
+            derivatives are kept and func is only differentiated again
+            when the pass-through functionals change. Only use this if
+            func is defined in a neighborhood of the functionals.
+
+        coloring : bool
+            Flag to perturb structurally independent entries of the
+            inputs together in the complex step. The first time the
+            derivatives are needed, every entry is perturbed separately,
+            at the functionals and at a randomly perturbed point, to
+            find which outputs each entry affects. The entries that
+            never affect the same output are then grouped by greedy
+            coloring (Curtis-Powell-Reid), so that every later
+            evaluation takes one call of func per group instead of one
+            per entry. Entries that affect no output are skipped. Only
+            use this if which outputs depend on which inputs does not
+            change with the values of the functionals.
+
+        copyInputs : bool
+            Flag to pass deep copies of the functionals to func, which
+            is needed if func modifies its inputs in place. If False,
+            the functionals are passed as read-only views and modifying
+            them raises an error. The default of None finds out on the
+            first call: func gets deep copies, and if it changed any of
+            their values, all later calls get deep copies as well.
+            Otherwise they get read-only views.
         """
         if not isinstance(func, types.FunctionType):
             raise MPError("func must be a Python function handle.")
@@ -424,11 +1106,31 @@ class multiPointSparse(object):
                 + "def objCon(funcs):, def objCon(funcs, printOK): or def objCon(funcs, printOK, passThroughFuncs):"
             )
 
+        if isinstance(sens, types.FunctionType):
+            if len(inspect.signature(sens).parameters) != len(sig.parameters):
+                raise MPError("The sens function given to 'setObjCon' must take the same arguments as func.")
+        elif sens not in ["CS", "AD"]:
+            raise MPError("sens must be one of 'CS', 'AD' or a Python function handle.")
+        if coloring and not (isinstance(sens, str) and sens == "CS"):
+            raise MPError("coloring is only used with sens='CS'.")
+
         # Now we know that there are exactly one or two arguments.
         self.nUserObjConArgs = len(sig.parameters)
         self.userObjCon = func
-
-    def setOptProb(self, optProb):
+        self.batchedObjCon = batched
+        self.objConBatchSize = batchSize
+        self.userObjConSens = sens
+        self.distributedObjCon = distributed
+        self.cacheObjConJac = cacheJac
+        self.checkObjConLinear = checkLinear
+        self.colorObjCon = coloring
+        self.objConColoring = None
+        self.objConJacCache = None
+        self.objConLinear = None
+        self.objConMutatesInputs = copyInputs
+        self._invalidateCache()
+
+    def setOptProb(self, optProb, sparseThreshold=None):
         """
         Set the optimization problem that this multiPoint object will
         be used for. This is required for this class to know how to
@@ -442,11 +1144,26 @@ class multiPointSparse(object):
         ----------
         optProb : pyOptSparse optimization problem class
             The optProb object to use
+
+        sparseThreshold : float
+            If given, the constraint Jacobian blocks computed from the
+            objCon function that were declared sparse with the jac
+            argument of addConGroup(), and whose fraction of declared
+            nonzero entries is at most sparseThreshold, are returned in
+            pyOptSparse's sparse COO format instead of as dense
+            arrays. The COO blocks always hold the entries of the
+            declared sparsity pattern, including the ones that happen to
+            be zero. An MPError is raised if a block has nonzero
+            entries outside of its declared pattern.
         """
 
         optProb.finalizeDesignVariables()
         optProb.finalizeConstraints()
 
+        for dvGroup in dkeys(optProb.variables):
+            ss = optProb.dvOffset[dvGroup]
+            self.dvSize[dvGroup] = ss[1] - ss[0]
+
         # Since there is no distinction between objective(s) and
         # constraints just put everything in conKeys, including the
         # objective(s)
@@ -455,16 +1172,22 @@ class multiPointSparse(object):
                 self.conKeys.add(iCon)
                 self.outputWRT[iCon] = optProb.constraints[iCon].wrt
                 self.outputSize[iCon] = optProb.constraints[iCon].ncon
+
+                # Keep the sparsity pattern of the blocks declared sparse
+                jac = optProb.constraints[iCon].jac
+                for dvGroup in self.outputWRT[iCon]:
+                    pattern = None if jac is None else _sparsityPattern(jac.get(dvGroup))
+                    if pattern is not None and len(pattern[0]) < self.outputSize[iCon] * self.dvSize[dvGroup]:
+                        self.conPatterns[iCon, dvGroup] = pattern
         for iObj in dkeys(optProb.objectives):
             self.conKeys.add(iObj)
+            self.objKeys.add(iObj)
             self.outputWRT[iObj] = list(optProb.variables.keys())
             self.outputSize[iObj] = 1
 
-        for dvGroup in dkeys(optProb.variables):
-            ss = optProb.dvOffset[dvGroup]
-            self.dvSize[dvGroup] = ss[1] - ss[0]
-
         self.conKeys = set(self.conKeys)
+        self.sparseThreshold = sparseThreshold
+        self._invalidateCache()
 
         # Check the dvsAsFuncs names to make sure they are *actually*
         # design variables and raise error
@@ -525,61 +1248,78 @@ class multiPointSparse(object):
         x : dict
             Dictionary of variables returned from pyOptSparse
         """
+        if self.cacheSize == 0 and self.cacheDir is None:
+            return self._obj(x)
+
+        xHash = _hashFuncs(x, x.keys())
+        entry = self._cacheLookup(self.objCache, "obj", xHash)
+        if entry is not None:
+            # The saved functionals are needed by sens()
+            funcs, fail, self.funcs, self.inputKeys, self.outputKeys, self.passThroughKeys = entry
+            self._logRoot(x, "funcs", funcs, fail)
+            return copy.deepcopy(funcs), fail
+
+        funcs, fail = self._obj(x)
+        self.stateHash = xHash
+        # A failure may be transient, so it is evaluated again next time.
+        # The caller owns the returned arrays, so the cache keeps copies.
+        if not fail:
+            entry = (copy.deepcopy(funcs), fail, self.funcs, self.inputKeys, self.outputKeys, self.passThroughKeys)
+            self._cacheStore(self.objCache, "obj", xHash, entry)
+
+        return dict(funcs), fail
+
+    def _obj(self, x):
+        """Evaluate the functionals and objCon at x, see obj()"""
+        startTime = self.profiler.begin()
         for key in dkeys(self.pSet):
             if self.setFlags[key]:
                 # Run "obj" function to generate functionals
-                res = {"fail": False}
-                for func in self.pSet[key].objFunc:
-                    tmp = func(x)
-                    if tmp is None:
-                        raise MPError(
-                            (
-                                "No return from user supplied objective function for pSet {}. "
-                                + "Functional derivatives must be returned in a dictionary."
-                            ).format(key)
-                        )
-
-                    if "fail" in tmp:
-                        res["fail"] = bool(tmp.pop("fail") or res["fail"])
-                    res.update(tmp)
-
-        if self.objCommPattern is None:
-            # On the first pass we need to determine the (one-time)
-            # communication pattern
-
-            # Send all the keys
-            allKeys = self.gcomm.allgather(sorted(list(res.keys())))
-
-            self.objCommPattern = dict()
-
-            for i in range(len(allKeys)):  # This is looping over processors
-                for key in allKeys[i]:  # This loops over keys from proc
-                    if key not in self.objCommPattern:
-                        if key != "fail":
-                            # Only add on the lowest proc and ignore on higher
-                            # ones
-                            self.objCommPattern[key] = i
-
-        # Perform Communication of functionals
-        allFuncs = dict()
-        for key in dkeys(self.objCommPattern):
-            if self.objCommPattern[key] == self.gcomm.rank:
-                tmp = self.gcomm.bcast(res[key], root=self.objCommPattern[key])
-            else:
-                tmp = self.gcomm.bcast(None, root=self.objCommPattern[key])
-
-            allFuncs[key] = tmp
-
-        # Simply do an allReduce on the fail flag:
-        fail = self.gcomm.allreduce(res["fail"], op=MPI.LOR)
+                res = self._runProcSet(self.pSet[key], self.pSet[key].objFunc, (x,), "objective")
+
+        self.profiler.wait(self.gcomm)
+        exchangeTime = self.profiler.begin()
+        changed = self._keysChanged(res, "obj")
+        allFuncs = None
+        if self.objLayout is not None:
+            allFuncs, fail = self._exchange(res, lambda comm, res: self.objLayout.exchange(comm, res, changed))
+            if allFuncs is None:
+                # A functional was added or removed or changed shape or
+                # type since the layout was determined. Rediscover
+                # everything.
+                self.objCommPattern = None
+                self.objLayout = None
+        elif self.objCommPattern is not None:
+            allFuncs, fail = self._exchange(
+                res, lambda comm, res: self._pickleExchange(comm, res, self.objCommPattern, changed)
+            )
+            if allFuncs is None:
+                # Only the member roots whose keys changed send them again
+                self.objCommPattern, descriptors = self._discoverCommPattern(res, "obj", incremental=True)
+
+        if allFuncs is None:
+            if self.objCommPattern is None:
+                # On the first pass we need to determine the (one-time)
+                # communication pattern
+                packed = self.commMode == "buffer"
+                self.objCommPattern, descriptors = self._discoverCommPattern(res, "obj", packed)
+                if packed:
+                    self.objLayout = FuncLayout.fromDescriptors(self.objCommPattern, descriptors, self.nExchangeProcs)
+
+            # Perform Communication of functionals
+            allFuncs, fail = self._exchange(res, lambda comm, res: self._pickleExchange(comm, res, self.objCommPattern))
+        self.profiler.end("exchange", "collective", exchangeTime, funcType="objective")
+        self.profiler.addBytes("objective", res, self._ownedKeys(self.objCommPattern))
 
         # Add in the extra DVs as Funcs...can do this on all procs
         # since all procs have the same x
         for dv in self.dvsAsFuncs:
-            allFuncs[dv] = x[dv]
+            allFuncs[dv] = copy.copy(x[dv])
 
-        # Save the functions since we need these for the derivatives
-        self.funcs = copy.deepcopy(allFuncs)
+        # Save the functions since we need these for the derivatives.
+        # All the values were received on this rank so they can be
+        # stored as read-only views without copying them.
+        self.funcs = _extractKeys(allFuncs, allFuncs.keys())
 
         # Determine which additional keys are necessary:
         funckeys = set(allFuncs.keys())
@@ -599,16 +1339,47 @@ class multiPointSparse(object):
             self.inputKeys.update(self.consAsInputs)
             self.passThroughKeys.difference_update(self.consAsInputs)
 
+        objConTime = self.profiler.begin()
+        funcs = self._placeObjCon(lambda: self._objConFuncs(allFuncs))
+        self.profiler.end("objCon", "objCon", objConTime)
+        self.profiler.end("obj", "call", startTime)
+        self._logRoot(x, "funcs", funcs, fail)
+
+        return funcs, fail
+
+    def _objConFuncs(self, allFuncs):
+        """Evaluate the objCon function with the functionals in allFuncs
+        and add the pass-through functionals to its outputs"""
         inputFuncs = _extractKeys(allFuncs, self.inputKeys)
         passThroughFuncs = _extractKeys(allFuncs, self.passThroughKeys)
-        funcs = self._userObjConWrap(inputFuncs, True, passThroughFuncs)
+        if self.batchedObjCon:
+            # Add and remove the leading batch axis
+            for key in inputFuncs:
+                inputFuncs[key] = np.asarray(inputFuncs[key])[np.newaxis]
+            funcs = self._userObjConWrap(inputFuncs, True, passThroughFuncs)
+            for key in funcs:
+                if np.ndim(funcs[key]) == 0:
+                    continue
+                if np.shape(funcs[key])[0] != 1:
+                    raise MPError(
+                        "The output '%s' of the batched objCon function has a leading dimension of %d instead of "
+                        "a batch axis of length 1." % (key, np.shape(funcs[key])[0])
+                    )
+                funcs[key] = np.asarray(funcs[key])[0]
+        else:
+            funcs = self._userObjConWrap(inputFuncs, True, passThroughFuncs)
 
         # Add the pass-through ones back:
         funcs.update(passThroughFuncs)
 
-        (funcs, fail) = self.gcomm.bcast((funcs, fail), root=0)
+        # The functionals are read-only views of self.funcs, so the
+        # returned ones (and any output that is a view of them) are
+        # copied
+        for key in funcs:
+            if isinstance(funcs[key], np.ndarray) and not funcs[key].flags.writeable:
+                funcs[key] = funcs[key].copy()
 
-        return funcs, fail
+        return funcs
 
     def sens(self, x, funcs):
         """
@@ -622,53 +1393,55 @@ class multiPointSparse(object):
         x : dict
             Dictionary of variables returned from pyOptSparse
         """
+        if self.cacheSize == 0 and self.cacheDir is None:
+            return self._sens(x, funcs)
+
+        xHash = _hashFuncs(x, x.keys())
+        entry = self._cacheLookup(self.sensCache, "sens", xHash)
+        if entry is not None:
+            gcon, fail = entry
+            self._logRoot(x, "gcon", gcon, fail)
+            return copy.deepcopy(gcon), fail
+
+        if self.stateHash != xHash:
+            # The last obj() result came from the cache, so the user
+            # analyses are not at this design point. Run them again
+            # before computing their derivatives.
+            self._obj(x)
+            self.stateHash = xHash
+
+        gcon, fail = self._sens(x, funcs)
+        if not fail:
+            self._cacheStore(self.sensCache, "sens", xHash, (copy.deepcopy(gcon), fail))
+
+        return dict(gcon), fail
+
+    def _sens(self, x, funcs):
+        """Evaluate the derivatives of the functionals and objCon at x, see sens()"""
+        startTime = self.profiler.begin()
         for key in dkeys(self.pSet):
             if self.setFlags[key]:
                 # Run "sens" function to functionals sensitivities
-                res = {"fail": False}
-                for func in self.pSet[key].sensFunc:
-                    tmp = func(x, funcs)
-                    if tmp is None:
-                        raise MPError(
-                            (
-                                "No return from user supplied sensitivity function for pSet {}. "
-                                + "Functional derivatives must be returned in a dictionary."
-                            ).format(key)
-                        )
-                    if "fail" in tmp:
-                        res["fail"] = bool(tmp.pop("fail") or res["fail"])
-
-                    res.update(tmp)
+                res = self._runProcSet(self.pSet[key], self.pSet[key].sensFunc, (x, funcs), "sensitivity")
 
+        self.profiler.wait(self.gcomm)
+        exchangeTime = self.profiler.begin()
+        funcSens = None
         if self.sensCommPattern is None:
             # On the first pass we need to determine the (one-time)
             # communication pattern
-
-            # Send all the keys
-            allKeys = self.gcomm.allgather(sorted(list(res.keys())))
-
-            self.sensCommPattern = dict()
-
-            for i in range(len(allKeys)):  # This is looping over processors
-                for key in allKeys[i]:  # This loops over keys from proc
-                    if key not in self.sensCommPattern:
-                        if key != "fail":
-                            # Only add on the lowest proc and ignore on higher
-                            # ones
-                            self.sensCommPattern[key] = i
+            self.sensCommPattern, descriptors = self._discoverCommPattern(res, "sens")
+        else:
+            funcSens, fail = self._exchangeSens(res, self._keysChanged(res, "sens"))
+            if funcSens is None:
+                # Only the member roots whose keys changed send them again
+                self.sensCommPattern, descriptors = self._discoverCommPattern(res, "sens", incremental=True)
 
         # Perform Communication of functional (derivatives)
-        funcSens = dict()
-        for key in dkeys(self.sensCommPattern):
-            if self.sensCommPattern[key] == self.gcomm.rank:
-                tmp = self.gcomm.bcast(res[key], root=self.sensCommPattern[key])
-            else:
-                tmp = self.gcomm.bcast(None, root=self.sensCommPattern[key])
-
-            funcSens[key] = tmp
-
-        # Simply do an allReduce on the fail flag:
-        fail = self.gcomm.allreduce(res["fail"], op=MPI.LOR)
+        if funcSens is None:
+            funcSens, fail = self._exchangeSens(res)
+        self.profiler.end("exchange", "collective", exchangeTime, funcType="sensitivity")
+        self.profiler.addBytes("sensitivity", res, self._ownedKeys(self.sensCommPattern))
 
         # Add in the sensitivity of the extra DVs as Funcs...This will
         # just be an identity matrix
@@ -683,12 +1456,222 @@ class multiPointSparse(object):
         # constraints (and objective(s)) with respect to the
         # intermediate functionals. We will put everything in gcon
         # (including the objective)
+        objConTime = self.profiler.begin()
+        if self.distributedObjCon and self.userObjConSens == "CS":
+            # Every rank evaluates some of the perturbations, so sum the
+            # partial contributions of all ranks
+            gcon = self._objConGradient(funcSens)
+            self._allreduceGcon(gcon)
+            self._sparsifyGcon(gcon)
+        else:
+            gcon = self._placeObjCon(lambda: self._sparsifyGcon(self._objConGradient(funcSens)))
+        self.profiler.end("objConSens", "objCon", objConTime)
+        self.profiler.end("sens", "call", startTime)
+        self._logRoot(x, "gcon", gcon, fail)
+
+        return gcon, fail
+
+    def _logRoot(self, x, kind, result, fail):
+        """Append the result of kind ('funcs' or 'gcon') at x to the log
+        of the root processor, preceded by x for the functionals"""
+        if self.rootLog is None:
+            return
+        xHash = _hashFuncs(x, x.keys())
+        if kind == "funcs":
+            self.rootLog.append("x", xHash, x)
+        self.rootLog.append(kind, xHash, result, fail)
+
+    def _runProcSet(self, pSet, funcList, args, funcType):
+        """
+        Run the user functions in funcList of this rank's procSet, unless
+        the set declared its dvGroups and none of them changed since the
+        last successful evaluation of funcType, in which case the last
+        results are reused.
+        """
+        if pSet.dvGroups is None:
+            return self._evaluateProcSet(pSet, funcList, args, funcType)
+
+        x = args[0]
+        missing = [key for key in pSet.dvGroups if key not in x]
+        if len(missing) > 0:
+            raise MPError("The dvGroups %s of set '%s' are not design variables." % (missing, pSet.setName))
+
+        dvHash = _hashFuncs(x, pSet.dvGroups)
+        last = pSet.lastResults.get(funcType)
+        if last is not None and last[0] == dvHash:
+            return copy.deepcopy(last[1])
+
+        res = self._evaluateProcSet(pSet, funcList, args, funcType)
+        # Every rank of the set must make the same decision next time.
+        # The results are copied, since the caller may modify them.
+        if pSet.gcomm.allreduce(res["fail"], op=MPI.LOR):
+            pSet.lastResults.pop(funcType, None)
+        else:
+            pSet.lastResults[funcType] = (dvHash, copy.deepcopy(res))
+
+        return res
+
+    def _evaluateProcSet(self, pSet, funcList, args, funcType):
+        """
+        Run the user functions in funcList of this rank's procSet and
+        merge their results. The functions of a dynamically scheduled
+        set are run once for every point of this member, see
+        procSet.points(), and the results of all the points are then
+        collected on the root of the set so that the communication
+        pattern does not depend on which member evaluated which point.
+        """
+        startTime = time.time()
+        xHash = None
+        if self.historyDir is not None:
+            xHash = _hashFuncs(args[0], args[0].keys())
+
+        if pSet.nPoints is None:
+            res, replayed = self._runPoint(pSet, funcList, args, funcType, xHash)
+            if not replayed:
+                self._logPoint(funcType, xHash, res)
+            pSet.times[funcType].append(time.time() - startTime)
+            self._flushOutput()
+            return res
+
+        res = {"fail": False}
+        pSet.pointKeys = {}
+        for ptID in pSet.points(funcType):
+            tmp, replayed = self._runPoint(pSet, funcList, args + (ptID,), funcType, xHash, ptID)
+            if not pSet.finishPoint(ptID):
+                # Another member finished this point first, so the
+                # result of this member is discarded, and not logged
+                continue
+            if not replayed:
+                self._logPoint(funcType, xHash, tmp, ptID)
+            if funcType == "objective":
+                pSet.objPoints.append(ptID)
+            res["fail"] = res["fail"] or tmp.pop("fail")
+            pSet.pointKeys[ptID] = sorted(tmp.keys())
+            res.update(tmp)
+        pSet.times[funcType].append(time.time() - startTime)
+        self._flushOutput()
+
+        # Collect the results of every member on the set root
+        if pSet.comm.rank == 0:
+            allRes = pSet.gcomm.gather((res, pSet.pointKeys), root=0)
+        else:
+            allRes = pSet.gcomm.gather(({"fail": res["fail"]}, {}), root=0)
+
+        if pSet.gcomm.rank == 0:
+            res = {"fail": False}
+            pSet.pointKeys = {}
+            for tmp, pointKeys in allRes:
+                res["fail"] = res["fail"] or tmp.pop("fail")
+                res.update(tmp)
+                pSet.pointKeys.update(pointKeys)
+        else:
+            res = {"fail": res["fail"]}
+        pSet.pointKeys = pSet.gcomm.bcast(pSet.pointKeys, root=0)
+
+        return res
 
+    def _flushOutput(self):
+        """Write the output of the last evaluation of the set of this
+        processor to the log and start copying its staged directories"""
+        if self.memberLog is not None:
+            self.memberLog.flush()
+        self.flushDirectories(wait=False)
+
+    def _runPoint(self, pSet, funcList, args, funcType, xHash, ptID=None):
+        """
+        Run the user functions of one point, or replay their results
+        from the history. A point that exceeds the timeBudget of the
+        set is reported as failed.
+
+        Returns
+        -------
+        res : dict
+            The results of the point
+        replayed : bool
+            True if the results were replayed from the history
+        """
+        pSet.pointStart = time.time()
+        pSet.currentPoint = ptID
+        res, replayed = self._runPointFuncs(pSet, funcList, args, funcType, xHash, ptID)
+        elapsed = time.time() - pSet.pointStart
+        pSet.pointStart = None
+
+        if pSet.timeBudget is not None and elapsed > pSet.timeBudget:
+            res["fail"] = True
+            if pSet.comm.rank == 0:
+                pSet.stragglers.append(
+                    {
+                        "setName": pSet.setName,
+                        "member": int(pSet.groupID),
+                        "funcType": funcType,
+                        "ptID": ptID,
+                        "time": elapsed,
+                        "budget": pSet.timeBudget,
+                    }
+                )
+
+        return res, replayed
+
+    def _runPointFuncs(self, pSet, funcList, args, funcType, xHash, ptID):
+        """Run or replay the user functions of one point, see _runPoint()"""
+        if xHash is None:
+            return self._runUserFuncs(pSet, funcList, args, funcType), False
+
+        if self.replayHistory:
+            record = None
+            if pSet.comm.rank == 0:
+                record = self.historyReader.get(funcType, xHash, ptID)
+            fail = pSet.comm.bcast(None if record is None else record[1], root=0)
+            if fail is not None:
+                res = dict(record[0]) if pSet.comm.rank == 0 else {}
+                res["fail"] = fail
+                return res, True
+
+            if funcType == "sensitivity" and pSet.stateHash.get(ptID) != xHash:
+                # The functionals at this point were replayed, so the
+                # user analyses must be run before their derivatives
+                self._runUserFuncs(pSet, pSet.objFunc, args[:1] + args[2:], "objective")
+
+        res = self._runUserFuncs(pSet, funcList, args, funcType)
+        pSet.stateHash[ptID] = xHash
+
+        return res, False
+
+    def _logPoint(self, funcType, xHash, res, ptID=None):
+        """Append the results of one point to the history log of the
+        member root, if a history is kept"""
+        if self.historyLog is not None:
+            self.historyLog.append(funcType, xHash, res, res["fail"], ptID)
+
+    def _runUserFuncs(self, pSet, funcList, args, funcType):
+        """Call every function in funcList with args and merge the results"""
+        res = {"fail": False}
+        for func in funcList:
+            with self.profiler.phase(func.__name__, "user", setName=pSet.setName, member=int(pSet.groupID)):
+                tmp = func(*args)
+            if tmp is None:
+                raise MPError(
+                    (
+                        "No return from user supplied {} function for pSet {}. "
+                        + "Functional derivatives must be returned in a dictionary."
+                    ).format(funcType, pSet.setName)
+                )
+
+            if "fail" in tmp:
+                res["fail"] = bool(tmp.pop("fail") or res["fail"])
+            res.update(tmp)
+
+        return res
+
+    def _objConGradient(self, funcSens):
+        """
+        Assemble the gradient of all the constraints (and objective(s))
+        from the functional sensitivities and the derivatives of the
+        objCon function.
+        """
         gcon = {}
-        # Extract/Complexify just the keys we need:
+        # Extract just the keys we need:
         passThroughFuncs = _extractKeys(self.funcs, self.passThroughKeys)
-        cFuncs = _extractKeys(self.funcs, self.inputKeys)
-        cFuncs = _complexifyFuncs(cFuncs, self.inputKeys)
 
         # Just copy the passthrough keys and keys that are both inputs and constrains:
         for pKey in self.passThroughKeys:
@@ -696,61 +1679,756 @@ class multiPointSparse(object):
         for cKey in self.consAsInputs:
             gcon[cKey] = funcSens[cKey]
 
-        # Setup zeros for the output keys:
+        # Derivatives of the output keys with respect to the input keys
+        conSens = self._getObjConSens(passThroughFuncs)
+
+        # Chain rule with the functional sensitivities. Only loop over
+        # the DVsets that each output key has:
         for oKey in skeys(self.outputKeys):
             gcon[oKey] = {}
-            # Only loop over the DVsets that this constraint has:
             for dvSet in self.outputWRT[oKey]:
-                gcon[oKey][dvSet] = np.zeros((self.outputSize[oKey], self.dvSize[dvSet]))
-
-        for iKey in skeys(self.inputKeys):  # Keys to peturb:
-            if np.isscalar(cFuncs[iKey]) or len(np.atleast_1d(cFuncs[iKey])) == 1:
-                cFuncs[iKey] += 1e-40j
-                con = self._userObjConWrap(cFuncs, False, passThroughFuncs)
-                cFuncs[iKey] -= 1e-40j
-
-                # Extract the derivative of output key variables
-                for oKey in skeys(self.outputKeys):
-                    n = self.outputSize[oKey]
-                    for dvSet in self.outputWRT[oKey]:
-                        if dvSet in funcSens[iKey]:
-                            deriv = (np.imag(np.atleast_1d(con[oKey])) / 1e-40).reshape((n, 1))
-                            gcon[oKey][dvSet] += np.dot(deriv, np.atleast_2d(funcSens[iKey][dvSet]))
+                gcon[oKey][dvSet] = self._chainRule(conSens, funcSens, oKey, dvSet)
+
+        return gcon
+
+    def _evaluatesObjCon(self):
+        """Return True if the objCon function is evaluated on this rank
+        according to objConPlacement"""
+        if self.objConPlacement == "root":
+            return self.gcomm.rank == 0
+        elif self.objConPlacement == "setRoots":
+            return self.setComm.rank == 0
+        return True
+
+    def _shareObjConResult(self, result):
+        """Give the result computed from the objCon function to every
+        rank according to objConPlacement"""
+        if self.objConPlacement in ["all", "root"]:
+            return self.gcomm.bcast(result, root=0)
+        elif self.objConPlacement == "setRoots":
+            return self.setComm.bcast(result, root=0)
+        return result
+
+    def _placeObjCon(self, func):
+        """
+        Call func, which evaluates the objCon function or its
+        derivatives, on the ranks given by objConPlacement and return
+        its result on every rank. If func raises an exception, an error
+        marker is shared instead of the result, so that every rank
+        raises rather than waiting for the result forever.
+        """
+        result = None
+        error = None
+        if self._evaluatesObjCon():
+            try:
+                result = (func(), None)
+            except Exception as e:
+                error = e
+                result = (None, type(e).__name__)
+
+        result, errorName = self._shareObjConResult(result)
+        if error is not None:
+            raise error
+        if errorName is not None:
+            raise MPError(
+                "The objCon function or its derivatives raised %s on the processor that evaluates them." % errorName
+            )
+
+        return result
+
+    def _chainRule(self, conSens, funcSens, oKey, dvSet):
+        """
+        Compute the derivative of the output key oKey with respect to
+        dvSet as a single matrix product dCon/dFuncs @ dFuncs/dx. Input
+        keys and individual entries that do not contribute (either
+        factor is zero) are left out of the product.
+        """
+        nDV = self.dvSize[dvSet]
+        dCon = []
+        dFuncs = []
+        for iKey in skeys(self.inputKeys):
+            if iKey not in funcSens:
+                raise MPError(
+                    "No sensitivities were returned for the functional '%s'. The sens functions must return the "
+                    "sensitivities of every functional returned by the obj functions." % iKey
+                )
+            if dvSet not in funcSens[iKey]:
+                continue
+
+            # Entries of the input key that affect the output
+            cols = np.flatnonzero(np.any(conSens[oKey][iKey] != 0, axis=0))
+            if len(cols) == 0:
+                continue
+
+            block = np.atleast_2d(funcSens[iKey][dvSet])
+            block = np.broadcast_to(block, (conSens[oKey][iKey].shape[1], nDV))[cols]
+            keep = np.any(block != 0, axis=1)
+            if not np.any(keep):
+                continue
+
+            dCon.append(conSens[oKey][iKey][:, cols[keep]])
+            dFuncs.append(block[keep])
+
+        if len(dCon) == 0:
+            return np.zeros((self.outputSize[oKey], nDV))
+
+        return np.dot(np.hstack(dCon), np.vstack(dFuncs))
+
+    def _sparsifyGcon(self, gcon):
+        """
+        Convert the output key constraint blocks of gcon that were
+        declared sparse enough in the optProb into pyOptSparse's COO
+        format in place and return gcon. The entries of the declared
+        sparsity pattern are used, so that the number of nonzeros never
+        depends on the values. Objective gradients are always left
+        dense. An MPError is raised if a block has nonzero entries
+        outside of its declared sparsity pattern, since they would be
+        dropped.
+        """
+        if self.sparseThreshold is None:
+            return gcon
+
+        for oKey in skeys(self.outputKeys):
+            for dvSet in self.outputWRT[oKey]:
+                if (oKey, dvSet) not in self.conPatterns:
+                    continue
+                block = gcon[oKey][dvSet]
+                rows, cols = self.conPatterns[oKey, dvSet]
+                if len(rows) <= self.sparseThreshold * block.size:
+                    if np.count_nonzero(block) != np.count_nonzero(block[rows, cols]):
+                        raise MPError(
+                            "The derivatives of '%s' with respect to '%s' have nonzero entries outside of the "
+                            "sparsity pattern declared in the optProb." % (oKey, dvSet)
+                        )
+                    gcon[oKey][dvSet] = {"coo": [rows, cols, block[rows, cols]], "shape": list(block.shape)}
+
+        return gcon
 
+    def _getObjConSens(self, passThroughFuncs):
+        """
+        Return the derivatives of the objCon outputs with respect to its
+        inputs at the current functionals. If cacheJac is set, the last
+        Jacobian is reused when the functionals have not changed. If
+        checkLinear is set, the Jacobian is evaluated once more at a
+        perturbed point the first time, perturbing the pass-through
+        functionals as well for an objCon that takes them. When both
+        agree, objCon is treated as linear and the Jacobian is only
+        recomputed when the pass-through functionals change. When the
+        input functionals or their shapes change, the linearity is
+        checked again.
+        """
+        passThroughHash = None
+        if self.nUserObjConArgs == 3:
+            passThroughHash = _hashFuncs(self.funcs, skeys(self.passThroughKeys))
+        inputShapes = [(iKey, np.shape(self.funcs[iKey])) for iKey in skeys(self.inputKeys)]
+        if self.objConLinear:
+            if self.objConJacCache[0] == (inputShapes, passThroughHash):
+                return self.objConJacCache[1]
+            if self.objConJacCache[0][0] != inputShapes:
+                self.objConLinear = None
+
+        if self.cacheObjConJac and not self.objConLinear:
+            keys = skeys(self.inputKeys)
+            if self.nUserObjConArgs == 3:
+                keys += skeys(self.passThroughKeys)
+            funcsHash = _hashFuncs(self.funcs, keys)
+            if self.objConJacCache is not None and self.objConJacCache[0] == funcsHash:
+                return self.objConJacCache[1]
+
+        conSens = self._computeObjConSens(self.funcs, passThroughFuncs)
+
+        if self.checkObjConLinear and self.objConLinear is None:
+            perturbedPassThrough = passThroughFuncs
+            if self.nUserObjConArgs == 3:
+                perturbedPassThrough = _perturbFuncs(self.funcs, self.passThroughKeys)
+            conSens2 = self._computeObjConSens(_perturbFuncs(self.funcs, self.inputKeys), perturbedPassThrough)
+            linear = True
+            for oKey in skeys(self.outputKeys):
+                for iKey in skeys(self.inputKeys):
+                    J1 = conSens[oKey][iKey]
+                    J2 = conSens2[oKey][iKey]
+                    if not np.allclose(J1, J2, rtol=1e-10, atol=1e-14 * max(np.max(np.abs(J1), initial=0.0), 1.0)):
+                        linear = False
+            if self.distributedObjCon and self.userObjConSens == "CS":
+                # Every rank only has some of the columns
+                linear = self.gcomm.allreduce(linear, op=MPI.LAND)
+            self.objConLinear = linear
+
+        if self.objConLinear:
+            # The Jacobian of a linear objCon can still depend on the
+            # pass-through functionals
+            self.objConJacCache = ((inputShapes, passThroughHash), conSens)
+        elif self.cacheObjConJac:
+            self.objConJacCache = (funcsHash, conSens)
+
+        return conSens
+
+    def _computeObjConSens(self, funcs, passThroughFuncs):
+        """
+        Compute the derivatives of the objCon outputs with respect to
+        its inputs, evaluated at funcs, with the selected method.
+        """
+        if isinstance(self.userObjConSens, types.FunctionType):
+            return self._objConSensUser(funcs, passThroughFuncs)
+        elif self.userObjConSens == "AD":
+            return self._objConSensAD(funcs, passThroughFuncs)
+
+        if self.colorObjCon:
+            conSens = self._colorObjCon(funcs, passThroughFuncs)
+            if conSens is not None:
+                return conSens
+
+        # Extract/Complexify just the keys we need:
+        cFuncs = _extractKeys(funcs, self.inputKeys)
+        cFuncs = _complexifyFuncs(cFuncs, self.inputKeys)
+        if self.batchedObjCon:
+            return self._objConSensBatched(cFuncs, passThroughFuncs)
+        return self._objConSens(cFuncs, passThroughFuncs)
+
+    def _colorObjCon(self, funcs, passThroughFuncs):
+        """
+        Find which outputs every complex step perturbation affects and
+        group the perturbations that never affect the same output
+        entry. This is only done again if the perturbations change.
+
+        Returns
+        -------
+        conSens : dict or None
+            The derivatives at funcs if they were computed to find the
+            coloring, None otherwise
+        """
+        cFuncs = _complexifyFuncs(_extractKeys(funcs, self.inputKeys), self.inputKeys)
+        perturbations = self._perturbations(cFuncs)
+        if self.objConColoring is not None and self.objConColoring[0] == perturbations:
+            return None
+        self.objConColoring = None
+
+        # Perturb every entry separately at the functionals and at a
+        # perturbed point, in case a derivative is zero by chance
+        pattern = None
+        allConSens = []
+        for point in [funcs, _perturbFuncs(funcs, self.inputKeys)]:
+            cFuncs = _complexifyFuncs(_extractKeys(point, self.inputKeys), self.inputKeys)
+            if self.batchedObjCon:
+                conSens = self._objConSensBatched(cFuncs, passThroughFuncs)
             else:
-                for i in range(len(cFuncs[iKey])):
-                    cFuncs[iKey][i] += 1e-40j
-                    con = self._userObjConWrap(cFuncs, False, passThroughFuncs)
-                    cFuncs[iKey][i] -= 1e-40j
+                conSens = self._objConSens(cFuncs, passThroughFuncs)
+            allConSens.append(conSens)
+            nonzero = np.vstack(
+                [np.hstack([conSens[oKey][iKey] for iKey in skeys(self.inputKeys)]) for oKey in skeys(self.outputKeys)]
+            )
+            pattern = nonzero != 0 if pattern is None else pattern | (nonzero != 0)
+
+        if self.distributedObjCon:
+            # Every rank only has some of the columns
+            pattern = pattern.astype("uint8")
+            self.gcomm.Allreduce(MPI.IN_PLACE, pattern, op=MPI.BOR)
+            pattern = pattern.astype(bool)
 
-                    # Extract the derivative of output key variables
-                    for oKey in skeys(self.outputKeys):
-                        n = self.outputSize[oKey]
+        # Split the pattern back into the rows of every output key
+        rows = {}
+        start = 0
+        for oKey in skeys(self.outputKeys):
+            rows[oKey] = pattern[start : start + self.outputSize[oKey]]
+            start += self.outputSize[oKey]
 
-                        for dvSet in self.outputWRT[oKey]:
-                            if dvSet in funcSens[iKey]:
-                                deriv = (np.imag(np.atleast_1d(con[oKey])) / 1e-40).reshape((n, 1))
-                                gcon[oKey][dvSet] += np.dot(deriv, np.atleast_2d(funcSens[iKey][dvSet][i, :]))
+        self.objConColoring = (perturbations, _colorColumns(pattern), rows)
 
-        gcon = self.gcomm.bcast(gcon, root=0)
-        fail = self.gcomm.bcast(fail, root=0)
+        return allConSens[0]
 
-        return gcon, fail
+    def _objConSeeds(self, perturbations):
+        """
+        Return the seeds of the complex step, the lists of the
+        perturbations evaluated together in one call of objCon, and the
+        rows of every output key each perturbation affects. Without a
+        coloring every perturbation is a seed of its own and the rows
+        are None.
+        """
+        if self.objConColoring is not None and self.objConColoring[0] == perturbations:
+            return self.objConColoring[1], self.objConColoring[2]
+        return [[p] for p in range(len(perturbations))], None
+
+    def _perturbEntry(self, cFuncs, perturbation, h):
+        """Add h to the entry of the input keys given by perturbation"""
+        iKey, i = perturbation
+        if i is None:
+            cFuncs[iKey] += h
+        else:
+            cFuncs[iKey][i] += h
+
+    def _storeDerivs(self, derivs, deriv, seed, rows):
+        """
+        Store the derivatives deriv of one output key with respect to
+        the perturbations of seed in the columns of derivs. With a
+        coloring, every perturbation only takes its own rows.
+        """
+        if rows is None:
+            derivs[:, seed[0]] = deriv
+            return
+        for p in seed:
+            derivs[rows[:, p], p] = deriv[rows[:, p]]
+
+    def _perturbations(self, funcs):
+        """
+        Return the list of (iKey, index) of every complex step
+        perturbation of the input keys. An index of None means the whole
+        (scalar) key is perturbed.
+        """
+        perturbations = []
+        for iKey in skeys(self.inputKeys):
+            if np.isscalar(funcs[iKey]) or len(np.atleast_1d(funcs[iKey])) == 1:
+                perturbations.append((iKey, None))
+            else:
+                perturbations.extend([(iKey, i) for i in range(len(funcs[iKey]))])
+
+        return perturbations
+
+    def _localPerturbations(self, nPert):
+        """
+        Return the range of perturbations evaluated on this rank. If the
+        complex step is distributed, every rank gets a contiguous slice.
+        """
+        if self.distributedObjCon:
+            size = self.gcomm.size
+            rank = self.gcomm.rank
+            return range(rank * nPert // size, (rank + 1) * nPert // size)
+
+        return range(nPert)
+
+    def _splitConSens(self, derivs, perturbations):
+        """
+        Slice the derivatives of each output key with respect to all the
+        perturbations into the blocks for each input key.
+        """
+        conSens = {}
+        for oKey in skeys(self.outputKeys):
+            conSens[oKey] = {}
+            start = 0
+            for iKey in skeys(self.inputKeys):
+                nEntries = sum(1 for pert in perturbations if pert[0] == iKey)
+                conSens[oKey][iKey] = derivs[oKey][:, start : start + nEntries]
+                start += nEntries
+
+        return conSens
+
+    def _objConSens(self, cFuncs, passThroughFuncs):
+        """
+        Compute the derivatives of the output keys of the user objCon
+        function with respect to each of the input keys with the
+        complex step method, perturbing one entry at a time, or one
+        group of entries of the coloring at a time.
 
-    def _userObjConWrap(self, funcs, printOK, passThroughFuncs):
+        Returns
+        -------
+        conSens : dict
+            conSens[oKey][iKey] is an array of size (outputSize, nEntries)
+            where nEntries is the number of entries of the input key. If
+            the complex step is distributed, only the columns of the
+            perturbations evaluated on this rank are nonzero.
+        """
+        perturbations = self._perturbations(cFuncs)
+        seeds, rows = self._objConSeeds(perturbations)
+        derivs = {}
+        for oKey in skeys(self.outputKeys):
+            derivs[oKey] = np.zeros((self.outputSize[oKey], len(perturbations)))
+
+        for s in self._localPerturbations(len(seeds)):
+            for p in seeds[s]:
+                self._perturbEntry(cFuncs, perturbations[p], 1e-40j)
+            con = self._userObjConWrap(cFuncs, False, passThroughFuncs)
+            for p in seeds[s]:
+                self._perturbEntry(cFuncs, perturbations[p], -1e-40j)
+
+            # Extract the derivative of output key variables
+            for oKey in skeys(self.outputKeys):
+                if rows is None or np.any(rows[oKey]):
+                    deriv = np.imag(np.atleast_1d(con[oKey])) / 1e-40
+                    self._storeDerivs(derivs[oKey], deriv, seeds[s], None if rows is None else rows[oKey])
+
+        return self._splitConSens(derivs, perturbations)
+
+    def _objConSensBatched(self, cFuncs, passThroughFuncs):
+        """
+        Compute the same derivatives as _objConSens() for a batched
+        objCon function. Every input key is given an extra leading
+        axis with one entry per seed, so that all (or objConBatchSize)
+        seeds are evaluated in a single call.
+        """
+        perturbations = self._perturbations(cFuncs)
+        seeds, rows = self._objConSeeds(perturbations)
+        local = self._localPerturbations(len(seeds))
+        batchSize = max(len(local), 1) if self.objConBatchSize is None else self.objConBatchSize
+        derivs = {}
+        for oKey in skeys(self.outputKeys):
+            derivs[oKey] = np.zeros((self.outputSize[oKey], len(perturbations)))
+
+        for start in range(local.start, local.stop, batchSize):
+            batch = seeds[start : min(start + batchSize, local.stop)]
+            bFuncs = {}
+            for iKey in skeys(self.inputKeys):
+                bFuncs[iKey] = np.repeat(np.asarray(cFuncs[iKey], "D")[np.newaxis], len(batch), axis=0)
+            for j, seed in enumerate(batch):
+                for p in seed:
+                    iKey, i = perturbations[p]
+                    if i is None:
+                        bFuncs[iKey][j] += 1e-40j
+                    else:
+                        bFuncs[iKey][j, i] += 1e-40j
+
+            con = self._userObjConWrap(bFuncs, False, passThroughFuncs)
+
+            # Outputs that do not carry the batch axis do not depend on
+            # the inputs
+            for oKey in skeys(self.outputKeys):
+                n = self.outputSize[oKey]
+                deriv = np.imag(np.asarray(con[oKey]))
+                if deriv.size == n * len(batch):
+                    deriv = deriv.reshape((len(batch), n)) / 1e-40
+                    for j, seed in enumerate(batch):
+                        self._storeDerivs(derivs[oKey], deriv[j], seed, None if rows is None else rows[oKey])
+
+        return self._splitConSens(derivs, perturbations)
+
+    def _objConSensAD(self, funcs, passThroughFuncs):
+        """
+        Compute the same derivatives as _objConSens() in a single
+        forward mode pass with dual numbers.
+        """
+        inputKeys = skeys(self.inputKeys)
+        dualFuncs, nEntries = seedInputs(funcs, inputKeys)
+        if self.batchedObjCon:
+            for key in inputKeys:
+                dualFuncs[key] = dualFuncs[key][np.newaxis]
+
+        try:
+            con = self._userObjConWrap(dualFuncs, False, passThroughFuncs)
+        except TypeError as e:
+            raise MPError(
+                "The objCon function could not be differentiated with sens='AD' ({}). Use sens='CS' instead.".format(e)
+            )
+
+        nSeed = sum(nEntries.values())
+        conSens = {}
+        for oKey in skeys(self.outputKeys):
+            n = self.outputSize[oKey]
+            if isinstance(con[oKey], DualArray):
+                deriv = np.real(con[oKey].deriv).reshape((n, nSeed))
+            elif np.asarray(con[oKey]).dtype.kind in "biufc":
+                # Output does not depend on the inputs
+                deriv = np.zeros((n, nSeed))
+            else:
+                raise MPError(
+                    "The objCon output '%s' could not be differentiated with sens='AD'. Build array outputs from "
+                    "the inputs with np.concatenate or np.stack instead of np.array or a list, or use sens='CS'."
+                    % oKey
+                )
+
+            conSens[oKey] = {}
+            start = 0
+            for iKey in inputKeys:
+                conSens[oKey][iKey] = deriv[:, start : start + nEntries[iKey]]
+                start += nEntries[iKey]
+
+        return conSens
+
+    def _objConSensUser(self, funcs, passThroughFuncs):
+        """
+        Get the same derivatives as _objConSens() from the user
+        supplied objCon sensitivity function.
+        """
+        inputFuncs = _extractKeys(funcs, self.inputKeys)
+        jac = self._userObjConWrap(inputFuncs, False, passThroughFuncs, self.userObjConSens)
+        if jac is None:
+            raise MPError("No return from the user supplied objCon sensitivity function.")
+
+        conSens = {}
+        for oKey in skeys(self.outputKeys):
+            n = self.outputSize[oKey]
+            conSens[oKey] = {}
+            for iKey in skeys(self.inputKeys):
+                m = _nEntries(inputFuncs[iKey])
+                block = np.asarray(jac.get(oKey, {}).get(iKey, 0.0), float)
+                if block.size == 1 and n * m != 1:
+                    block = np.full((n, m), block.item())
+                conSens[oKey][iKey] = block.reshape((n, m))
+
+        return conSens
+
+    def _allreduceGcon(self, gcon):
+        """Sum the output key blocks of gcon over all ranks in place
+        with a single Allreduce"""
+        blocks = []
+        for oKey in skeys(self.outputKeys):
+            for dvSet in self.outputWRT[oKey]:
+                blocks.append(gcon[oKey][dvSet])
+        if len(blocks) == 0:
+            return
+
+        buf = np.concatenate([block.reshape(-1) for block in blocks])
+        self.gcomm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+
+        start = 0
+        for block in blocks:
+            block.reshape(-1)[:] = buf[start : start + block.size]
+            start += block.size
+
+    def _invalidateCache(self):
+        """
+        Drop the cached results after a user function, objCon or the
+        optProb changed. The generation is part of the names of the
+        files in the disk cache, so their results are not used either.
+        """
+        self.cacheGeneration += 1
+        self.objCache.clear()
+        self.sensCache.clear()
+        # The next sens() evaluates the functionals again, so that the
+        # keys and functionals it uses come from the new functions
+        self.stateHash = None
+
+    def _cacheLookup(self, cache, kind, xHash):
+        """
+        Look up the result for the design point with hash xHash in the
+        memory cache and then in the disk cache. Every rank must agree
+        on both the hash and the hit, otherwise the result is computed
+        again everywhere. The ranks also agree on the latest generation
+        of the cache, since the functions may only have been changed on
+        some of them.
+        """
+        entry = cache.get(xHash)
+        hashValue = int(xHash[:15], 16)
+        flags = np.array([hashValue, -hashValue, entry is not None, -self.cacheGeneration], "int64")
+        self.gcomm.Allreduce(MPI.IN_PLACE, flags, op=MPI.MIN)
+        self.cacheGeneration = int(-flags[3])
+        if flags[0] != -flags[1]:
+            return None
+
+        if flags[2]:
+            cache.move_to_end(xHash)
+            return entry
+
+        if self.cacheDir is not None:
+            entry = None
+            if self.gcomm.rank == 0:
+                fileName = self._cacheFile(kind, xHash)
+                if os.path.exists(fileName):
+                    with open(fileName, "rb") as f:
+                        entry = pickle.load(f)
+            entry = self.gcomm.bcast(entry, root=0)
+            if entry is not None:
+                self._cacheStore(cache, None, xHash, entry)
+                return entry
+
+        return None
+
+    def _cacheStore(self, cache, kind, xHash, entry):
+        """
+        Store a result in the memory cache, dropping the least recently
+        used one if it is full, and in the disk cache unless kind is None.
+        """
+        if self.cacheSize > 0:
+            cache[xHash] = entry
+            cache.move_to_end(xHash)
+            while len(cache) > self.cacheSize:
+                cache.popitem(last=False)
+
+        if kind is not None and self.cacheDir is not None and self.gcomm.rank == 0:
+            fileName = self._cacheFile(kind, xHash)
+            with open(fileName + ".tmp", "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(fileName + ".tmp", fileName)
+
+    def _cacheFile(self, kind, xHash):
+        return os.path.join(self.cacheDir, "%s_%s_%d.pkl" % (kind, xHash, self.cacheGeneration))
+
+    def _exchangeRank(self):
+        """Rank of this processor in the communicator the exchanges run
+        on, or None if it does not take part in them"""
+        if self.exchangeComm != MPI.COMM_NULL:
+            return self.exchangeComm.rank
+        return None
+
+    def _ownedKeys(self, commPattern):
+        """Return the keys this rank sends in commPattern"""
+        return [key for key in dkeys(commPattern) if commPattern[key] == self._exchangeRank()]
+
+    def _exchangeSens(self, res, changed=False):
+        """Exchange the functional sensitivities with the sensCommMode"""
+        if self.sensCommMode == "sparse":
+            return self._exchange(
+                res,
+                lambda comm, res: exchangeJacobians(comm, res, self.sensCommPattern, self.compressSens, changed),
+                nested=True,
+            )
+        return self._exchange(
+            res, lambda comm, res: self._pickleExchange(comm, res, self.sensCommPattern, changed), nested=True
+        )
+
+    def _exchange(self, res, exchange, nested=False):
+        """
+        Run exchange(comm, res) with the topology. With the flat
+        topology every rank takes part in the exchange on gcomm. With
+        the hierarchical topology the fail flags are first reduced on
+        the member roots, only the member roots exchange the data on
+        rootComm and each member root then broadcasts the result to its
+        member. With the shared topology the fail flags are reduced on
+        the first rank of every node, the member roots and the first
+        ranks of the nodes exchange the data and the first rank of every
+        node then shares the result with the rest of its node. nested
+        is True if res holds sensitivities rather than functionals.
+        """
+        if self.topology == "flat":
+            return exchange(self.gcomm, res)
+
+        if self.topology == "hierarchical":
+            fail = self.memberComm.reduce(res["fail"], op=MPI.LOR, root=0)
+            result = None
+            if self.rootComm != MPI.COMM_NULL:
+                result = exchange(self.rootComm, dict(res, fail=fail))
+            return self.memberComm.bcast(result, root=0)
+
+        fail = self.nodeComm.reduce(res["fail"], op=MPI.LOR, root=0)
+        if self.nodeComm.rank != 0:
+            fail = res["fail"]
+        result = None
+        if self.exchangeComm != MPI.COMM_NULL:
+            result = exchange(self.exchangeComm, dict(res, fail=fail))
+        if self.nodeComm.rank != 0:
+            # Drop the copy of a member root before the node's copy is
+            # shared, so that it is never kept
+            result = None
+        return self.nodeShare.share(result, nested)
+
+    def _keyHash(self, res):
+        """Hash of the keys of res"""
+        return hash(tuple(sorted(key for key in res.keys() if key != "fail")))
+
+    def _keysChanged(self, res, kind):
+        """
+        Return True if this rank is a member root whose keys of kind
+        ('obj' or 'sens') changed since the communication pattern was
+        determined. The keys of the other ranks are not used.
+        """
+        if self.rootComm == MPI.COMM_NULL:
+            return False
+        return self.keyHashes.get(kind) != self._keyHash(res)
+
+    def _discoverCommPattern(self, res, kind, descriptors=False, incremental=False):
+        """
+        Determine the communication pattern of kind ('obj' or 'sens'):
+        the lowest member root that has a key in res is the one that
+        sends it. The ranks in the pattern are those of exchangeComm,
+        the communicator the exchanges run on with the topology. The
+        keys are only gathered from the member roots on the root
+        processor, which then broadcasts the pattern. If
+        incremental is True, only the member roots whose keys changed
+        send them again. If descriptors is True, the packed layout
+        descriptor of every key is gathered as well.
+
+        Returns
+        -------
+        commPattern : dict
+            Dictionary mapping each key to the rank that sends it
+        descriptors : dict or None
+            Dictionary mapping each key to its descriptor
+        """
+        keyHash = self._keyHash(res)
+        if self.rootComm != MPI.COMM_NULL:
+            info = None
+            if not incremental or self.keyHashes.get(kind) != keyHash:
+                if descriptors:
+                    info = dict((key, funcDescriptor(res[key])) for key in dkeys(res) if key != "fail")
+                else:
+                    info = [key for key in dkeys(res) if key != "fail"]
+            allKeys = self.rootComm.gather((self._exchangeRank(), info), root=0)
+        self.keyHashes[kind] = keyHash
+
+        commPattern = None
+        keyDescriptors = None
+        if self.gcomm.rank == 0:
+            if not incremental:
+                self.rootKeys[kind] = {}
+            for rank, info in allKeys:
+                if info is not None:
+                    self.rootKeys[kind][rank] = info
+
+            commPattern = {}
+            keyDescriptors = {} if descriptors else None
+            for rank in sorted(self.rootKeys[kind].keys()):  # This is looping over member roots
+                for key in self.rootKeys[kind][rank]:  # This loops over keys from proc
+                    # Only add on the lowest proc and ignore on higher
+                    # ones
+                    if key not in commPattern:
+                        commPattern[key] = rank
+                        if descriptors:
+                            keyDescriptors[key] = self.rootKeys[kind][rank][key]
+
+        return self.gcomm.bcast((commPattern, keyDescriptors), root=0)
+
+    def _pickleExchange(self, comm, res, commPattern, changed=False):
+        """
+        Exchange the values in res one key at a time with pickled
+        broadcasts on comm following commPattern. The fail flags and changed
+        flags (if the keys of this rank changed since commPattern was
+        determined) are reduced first. If the keys changed on any rank,
+        (None, None) is returned without exchanging anything.
+        """
+        flags = np.array([res["fail"], changed], "intc")
+        comm.Allreduce(MPI.IN_PLACE, flags, op=MPI.MAX)
+        if flags[1]:
+            return None, None
+
+        allFuncs = dict()
+        for key in dkeys(commPattern):
+            if commPattern[key] == comm.rank:
+                tmp = comm.bcast(res[key], root=commPattern[key])
+            else:
+                tmp = comm.bcast(None, root=commPattern[key])
+
+            allFuncs[key] = tmp
+
+        return allFuncs, bool(flags[0])
+
+    def _userObjConWrap(self, funcs, printOK, passThroughFuncs, func=None):
+        """
+        Call the user objCon function (or func) with the functionals,
+        as deep copies if the function modifies its inputs in place and
+        as read-only views otherwise. If this is not known yet, deep
+        copies are passed and their hashes are compared before and
+        after the call, see setObjCon().
+        """
+        if self.objConMutatesInputs is False:
+            return self._callUserObjCon(funcs, printOK, passThroughFuncs, func)
+
+        funcs = copy.deepcopy(funcs)
+        passThroughFuncs = copy.deepcopy(passThroughFuncs)
+        if self.objConMutatesInputs:
+            return self._callUserObjCon(funcs, printOK, passThroughFuncs, func)
+
+        # The function may add or replace keys of the dicts, so only
+        # the values it was given are compared
+        inputs = (dict(funcs), dict(passThroughFuncs))
+        before = [_hashFuncs(d, d.keys()) for d in inputs]
+        result = self._callUserObjCon(funcs, printOK, passThroughFuncs, func)
+        self.objConMutatesInputs = before != [_hashFuncs(d, d.keys()) for d in inputs]
+
+        return result
+
+    def _callUserObjCon(self, funcs, printOK, passThroughFuncs, func=None):
         """Small wrapper to determine how to call user function:"""
+        if func is None:
+            func = self.userObjCon
         if self.nUserObjConArgs == 1:
-            return self.userObjCon(funcs)
+            return func(funcs)
         elif self.nUserObjConArgs == 2:
             if self.gcomm.rank == 0:
-                return self.userObjCon(funcs, printOK)
+                return func(funcs, printOK)
             else:
-                return self.userObjCon(funcs, False)
+                return func(funcs, False)
         elif self.nUserObjConArgs == 3:
             if self.gcomm.rank == 0:
-                return self.userObjCon(funcs, printOK, passThroughFuncs)
+                return func(funcs, printOK, passThroughFuncs)
             else:
-                return self.userObjCon(funcs, False, passThroughFuncs)
+                return func(funcs, False, passThroughFuncs)
 
 
 class procSet(object):
@@ -761,11 +2439,26 @@ class procSet(object):
     have already checked the inputs.
     """
 
-    def __init__(self, setName, nMembers, memberSizes, setID):
+    def __init__(self, setName, nMembers, memberSizes, setID, nPoints=None):
         self.setName = setName
         self.nMembers = nMembers
+        self.nPoints = nPoints
+        self.pointKeys = None
+        self.objPoints = None
+        self.queued = False
+        self.queue = None
+        self.nCalls = 0
+        self.times = {"objective": [], "sensitivity": []}
+        self.stateHash = {}
+        self.timeBudget = None
+        self.speculative = False
+        self.dvGroups = None
+        self.lastResults = {}
+        self.stragglers = []
+        self.pointStart = None
+        self.currentPoint = None
         self.memberSizes = memberSizes
-        self.nProc = np.sum(self.memberSizes)
+        self.nProc = int(np.sum(self.memberSizes))
         self.gcomm = None
         self.objFunc = []
         self.sensFunc = []
@@ -782,18 +2475,128 @@ class procSet(object):
         """
         # Create a cumulative size array
         cumGroups = np.zeros(self.nMembers + 1, "intc")
-
-        for i in range(self.nMembers):
-            cumGroups[i + 1] = cumGroups[i] + self.memberSizes[i]
+        cumGroups[1:] = np.cumsum(self.memberSizes)
 
         # Determine the member_key (m_key) for each processor
-        m_key = None
-        for i in range(self.nMembers):
-            if self.gcomm.rank >= cumGroups[i] and self.gcomm.rank < cumGroups[i + 1]:
-                m_key = i
+        m_key = int(np.searchsorted(cumGroups, self.gcomm.rank, side="right")) - 1
 
-        self.comm = self.gcomm.Split(m_key)
+        group = self.gcomm.Get_group()
+        memberGroup = group.Range_incl([(cumGroups[m_key], cumGroups[m_key + 1] - 1, 1)])
+        self.comm = self.gcomm.Create_group(memberGroup)
+        memberGroup.Free()
+        group.Free()
         self.groupFlags = np.zeros(self.nMembers, bool)
         self.groupFlags[m_key] = True
         self.groupID = m_key
         self.cumGroups = cumGroups
+
+        if self.nPoints is not None:
+            # The work queue is a single counter on the root of the set
+            # that the member roots atomically increment. It is followed
+            # by the number of the last call in which each point was
+            # finished and in which each point was speculatively re-run.
+            size = MPI.INT64_T.Get_size()
+            nValues = 1 + 2 * self.nPoints
+            self.queue = MPI.Win.Allocate(nValues * size if self.gcomm.rank == 0 else 0, size, comm=self.gcomm)
+            if self.gcomm.rank == 0:
+                self.queue.Lock(0)
+                self.queue.Put(np.zeros(nValues, "int64"), 0)
+                self.queue.Unlock(0)
+            self.gcomm.barrier()
+
+    def points(self, funcType):
+        """
+        Return the points this member evaluates in the current call.
+        The functionals of the points are pulled from the work queue,
+        see nextPoints(). The sensitivities of every point are evaluated
+        by the member whose functionals of that point were used in the
+        last objective call, since its analysis holds the state of that
+        point. They are only pulled from the queue if there was no
+        objective call yet.
+        """
+        if funcType == "sensitivity" and self.objPoints is not None:
+            self.queued = False
+            return list(self.objPoints)
+
+        self.queued = True
+        if funcType == "objective":
+            self.objPoints = []
+        return self.nextPoints()
+
+    def nextPoints(self):
+        """
+        Generator of the points this member evaluates in the current
+        call. The member root fetches the next point from the shared
+        counter and broadcasts it to the rest of the member. The
+        counter is never reset: every call takes exactly nPoints +
+        nMembers values from it (each member takes one value past the
+        last point to find out that the queue is empty), so the points
+        of each call are found relative to a known base.
+        """
+        base = self.nCalls * (self.nPoints + self.nMembers)
+        self.nCalls += 1
+        while True:
+            value = None
+            if self.comm.rank == 0:
+                value = self._fetchAndOp(0, 1, MPI.SUM)
+            ptID = self.comm.bcast(value - base, root=0)
+            if ptID >= self.nPoints:
+                break
+            yield ptID
+
+        if not self.speculative:
+            return
+
+        # Re-run the points that are still being evaluated by other
+        # members. Each point is only re-run once per call.
+        while True:
+            ptID = None
+            if self.comm.rank == 0:
+                done = np.zeros(self.nPoints, "int64")
+                self.queue.Lock(0, MPI.LOCK_SHARED)
+                self.queue.Get([done, MPI.INT64_T], 0, target=(1, self.nPoints, MPI.INT64_T))
+                self.queue.Unlock(0)
+                for iPoint in range(self.nPoints):
+                    if done[iPoint] < self.nCalls:
+                        if self._fetchAndOp(1 + self.nPoints + iPoint, self.nCalls, MPI.MAX) < self.nCalls:
+                            ptID = iPoint
+                            break
+            ptID = self.comm.bcast(ptID, root=0)
+            if ptID is None:
+                return
+            yield ptID
+
+    def finishPoint(self, ptID):
+        """
+        Mark the point as finished and return True if this member is the
+        first to finish it in the current call, i.e. if its results
+        must be used.
+        """
+        if not self.speculative or not self.queued:
+            return True
+
+        first = None
+        if self.comm.rank == 0:
+            first = self._fetchAndOp(1 + ptID, self.nCalls, MPI.MAX) < self.nCalls
+        return self.comm.bcast(first, root=0)
+
+    def pointDone(self):
+        """Return True on the member root if another member already
+        finished the point this member is evaluating"""
+        if not self.speculative or not self.queued or self.currentPoint is None or self.comm.rank != 0:
+            return False
+
+        done = np.zeros(1, "int64")
+        self.queue.Lock(0, MPI.LOCK_SHARED)
+        self.queue.Get([done, MPI.INT64_T], 0, target=(1 + self.currentPoint, 1, MPI.INT64_T))
+        self.queue.Unlock(0)
+        return done[0] >= self.nCalls
+
+    def _fetchAndOp(self, disp, value, op):
+        """Atomically apply op with value to the entry disp of the queue
+        window and return its previous value"""
+        result = np.zeros(1, "int64")
+        self.queue.Lock(0, MPI.LOCK_SHARED)
+        self.queue.Fetch_and_op(np.array([value], "int64"), result, 0, disp, op)
+        self.queue.Unlock(0)
+        return int(result[0])
@@ -0,0 +1,183 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import json
+import numpy as np
+
+from .utils import MPError, dkeys
+
+
+def loadTimings(fileNames):
+    """
+    Load the timing records written by multiPointSparse.saveTimings()
+    from one or more previous runs.
+
+    Parameters
+    ----------
+    fileNames : str or list
+        File name or list of file names to read
+
+    Returns
+    -------
+    records : list
+        List of timing records of all the files
+    """
+    if isinstance(fileNames, str):
+        fileNames = [fileNames]
+
+    records = []
+    for fileName in fileNames:
+        with open(fileName, "r") as f:
+            records.extend(json.load(f))
+
+    return records
+
+
+def fitScaling(nProcs, times):
+    """
+    Fit the Amdahl model t(p) = serial + parallel / p to the measured
+    wall times of one member. If the member was only run on one
+    processor count, perfect scaling is assumed.
+
+    Parameters
+    ----------
+    nProcs : list
+        Processor counts the member was run on
+    times : list
+        Wall time for each of the processor counts
+
+    Returns
+    -------
+    model : tuple
+        The (serial, parallel) coefficients of the model
+    """
+    nProcs = np.asarray(nProcs, float)
+    times = np.asarray(times, float)
+    if len(np.unique(nProcs)) < 2:
+        return (0.0, float(np.mean(times * nProcs)))
+
+    A = np.column_stack([np.ones(len(nProcs)), 1.0 / nProcs])
+    serial, parallel = np.linalg.lstsq(A, times, rcond=None)[0]
+
+    # Neither part of the time can be negative
+    if serial < 0.0:
+        return (0.0, float(np.mean(times * nProcs)))
+    if parallel < 0.0:
+        return (float(np.mean(times)), 0.0)
+
+    return (float(serial), float(parallel))
+
+
+def buildModels(records, funcTypes=("objective", "sensitivity")):
+    """
+    Fit the scaling model of every member from the timing
+    records. The times of the function types in funcTypes are added
+    together, so by default the models predict the wall time of one
+    obj() plus one sens() call.
+
+    Returns
+    -------
+    models : dict
+        Dictionary mapping each set name to a list with the (serial,
+        parallel) model of each member
+    """
+    samples = {}
+    for record in records:
+        wallTime = 0.0
+        for funcType in funcTypes:
+            times = record["times"].get(funcType, [])
+            if len(times) > 0:
+                wallTime += np.mean(times)
+        key = (record["setName"], record["member"])
+        samples.setdefault(key, ([], []))
+        samples[key][0].append(record["nProc"])
+        samples[key][1].append(wallTime)
+
+    models = {}
+    for setName, member in sorted(samples.keys()):
+        nProcs, times = samples[(setName, member)]
+        models.setdefault(setName, [])
+        if member != len(models[setName]):
+            raise MPError("No timings were recorded for member %d of set '%s'." % (len(models[setName]), setName))
+        models[setName].append(fitScaling(nProcs, times))
+
+    return models
+
+
+def predictTime(model, nProc):
+    """Predicted wall time of a member with the given model on nProc processors"""
+    return model[0] + model[1] / nProc
+
+
+def simulateLayout(models, memberSizes):
+    """
+    Predict the wall time of a candidate layout without running
+    it. Since every member waits for the slowest one in obj() and
+    sens(), the predicted wall time of the layout is the largest
+    predicted member time.
+
+    Parameters
+    ----------
+    models : dict
+        Member models as returned by buildModels()
+    memberSizes : dict
+        Dictionary mapping each set name to the list of member sizes
+
+    Returns
+    -------
+    makespan : float
+        Predicted wall time of the layout
+    memberTimes : dict
+        Dictionary mapping each set name to the list of predicted
+        member times
+    """
+    memberTimes = {}
+    for setName in dkeys(models):
+        sizes = np.atleast_1d(memberSizes[setName])
+        if len(sizes) != len(models[setName]):
+            raise MPError("The memberSizes of set '%s' do not match the number of members." % setName)
+        memberTimes[setName] = [predictTime(model, size) for model, size in zip(models[setName], sizes)]
+
+    makespan = max(max(times) for times in memberTimes.values())
+
+    return makespan, memberTimes
+
+
+def planMemberSizes(models, nProc, minSize=1):
+    """
+    Propose the number of processors of every member that minimizes
+    the predicted wall time (makespan) of the layout on nProc
+    processors. Every member starts with minSize processors and the
+    remaining processors are handed out one at a time to the member
+    that is currently predicted to be the slowest. Since the time of
+    each member decreases monotonically with its size, this minimizes
+    the largest member time.
+
+    Parameters
+    ----------
+    models : dict
+        Member models as returned by buildModels()
+    nProc : int
+        Total number of processors available
+    minSize : int
+        Smallest number of processors of any member
+
+    Returns
+    -------
+    memberSizes : dict
+        Dictionary mapping each set name to the list of member sizes,
+        which can be passed directly to createCommunicators()
+    """
+    members = [(setName, i) for setName in dkeys(models) for i in range(len(models[setName]))]
+    if len(members) * minSize > nProc:
+        raise MPError(
+            "Cannot give %d members at least %d processors each with %d processors." % (len(members), minSize, nProc)
+        )
+
+    memberSizes = dict((setName, [minSize] * len(models[setName])) for setName in dkeys(models))
+    for i in range(nProc - len(members) * minSize):
+        times = [predictTime(models[setName][j], memberSizes[setName][j]) for setName, j in members]
+        setName, j = members[int(np.argmax(times))]
+        memberSizes[setName][j] += 1
+
+    return memberSizes
@@ -0,0 +1,178 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import json
+import time
+import pickle
+from contextlib import contextmanager
+import numpy as np
+
+from .utils import dkeys
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is then not recorded
+    resource = None
+
+
+def _nBytes(val):
+    """Return the number of bytes needed to send one functional or one
+    dictionary of functional sensitivities"""
+    if isinstance(val, dict):
+        return sum(_nBytes(val[key]) for key in val)
+    try:
+        arr = np.asarray(val)
+    except Exception:
+        arr = None
+    if arr is not None and arr.dtype.kind in "biufc":
+        return int(arr.nbytes)
+    return len(pickle.dumps(val, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class Profiler(object):
+    """
+    Records the wall time of every phase of obj() and sens() on this
+    rank: the user functions, the time spent waiting for the other
+    ranks before each exchange (the load imbalance), the exchange
+    itself and the objCon evaluation and derivatives. The number of
+    bytes each rank sends for every functional is recorded as well.
+    When the profiler is not enabled every call is a no-op.
+
+    Parameters
+    ----------
+    enabled : bool
+        Flag to record anything at all
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.label = ""
+        self.events = []
+        self.bytes = {}
+
+    def begin(self):
+        """Return the start time of a phase that is ended with end()"""
+        return time.time()
+
+    def end(self, name, category, start, **args):
+        """Record a phase that started at start and ends now"""
+        if self.enabled:
+            self.events.append((name, category, start, time.time() - start, args))
+
+    @contextmanager
+    def phase(self, name, category, **args):
+        """Context manager recording the time of the enclosed block"""
+        start = self.begin()
+        try:
+            yield
+        finally:
+            self.end(name, category, start, **args)
+
+    def wait(self, comm):
+        """
+        Time how long this rank waits for the slowest rank of comm with
+        a barrier. This is only done if the profiler is enabled so
+        that the exchange that follows only measures the communication
+        itself.
+        """
+        if self.enabled:
+            with self.phase("wait", "collective"):
+                comm.Barrier()
+
+    def addBytes(self, funcType, res, keys):
+        """Add the number of bytes sent for the functionals in keys"""
+        if self.enabled:
+            nBytes = self.bytes.setdefault(funcType, {})
+            for key in keys:
+                nBytes[key] = nBytes.get(key, 0) + _nBytes(res[key])
+
+    def report(self, comm):
+        """
+        Gather the records of every rank of comm and aggregate
+        them. This is a collective call.
+
+        Returns
+        -------
+        report : dict
+            The aggregated report on the root of comm, None on every
+            other rank. It contains the raw 'events' and a summary of
+            every rank, the 'phases' with the min, mean and max total
+            time of every phase over the ranks, the total 'bytes' sent
+            for every functional and the 'overhead', the fraction of the
+            obj() and sens() time that was not spent in user
+            functions.
+        """
+        maxrss = None
+        if resource is not None:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        allRecords = comm.gather((self.label, self.events, self.bytes, maxrss), root=0)
+        if comm.rank != 0:
+            return None
+
+        ranks = []
+        phases = {}
+        nBytes = {}
+        for rank, (label, events, rankBytes, rss) in enumerate(allRecords):
+            totals = {}
+            for name, category, start, duration, args in events:
+                totals[name] = totals.get(name, 0.0) + duration
+            for name in totals:
+                phases.setdefault(name, [0.0] * len(allRecords))[rank] = totals[name]
+            for funcType in rankBytes:
+                for key in rankBytes[funcType]:
+                    nBytes.setdefault(funcType, {})
+                    nBytes[funcType][key] = nBytes[funcType].get(key, 0) + rankBytes[funcType][key]
+            ranks.append({"rank": rank, "label": label, "maxrss": rss, "phases": totals, "events": events})
+
+        userTime = sum(
+            duration for rank in ranks for name, category, start, duration, args in rank["events"] if category == "user"
+        )
+        totalTime = sum(phases.get("obj", [])) + sum(phases.get("sens", []))
+
+        return {
+            "ranks": ranks,
+            "phases": dict(
+                (name, {"min": min(phases[name]), "mean": float(np.mean(phases[name])), "max": max(phases[name])})
+                for name in dkeys(phases)
+            ),
+            "bytes": nBytes,
+            "overhead": 1.0 - userTime / totalTime if totalTime > 0.0 else 0.0,
+        }
+
+    def save(self, comm, fileName, fileFormat="json"):
+        """
+        Write the report to fileName on the root of comm. fileFormat is
+        either 'json' for the report itself or 'trace' for a timeline
+        in the Chrome trace event format that can be opened with
+        chrome://tracing or Perfetto, with one process per rank. This
+        is a collective call.
+        """
+        report = self.report(comm)
+        if report is None:
+            return
+
+        if fileFormat == "trace":
+            t0 = min([event[2] for rank in report["ranks"] for event in rank["events"]] + [time.time()])
+            traceEvents = []
+            for rank in report["ranks"]:
+                traceEvents.append(
+                    {"name": "process_name", "ph": "M", "pid": rank["rank"], "args": {"name": rank["label"]}}
+                )
+                for name, category, start, duration, args in rank["events"]:
+                    traceEvents.append(
+                        {
+                            "name": name,
+                            "cat": category,
+                            "ph": "X",
+                            "ts": (start - t0) * 1e6,
+                            "dur": duration * 1e6,
+                            "pid": rank["rank"],
+                            "tid": 0,
+                            "args": args,
+                        }
+                    )
+            report = {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+        with open(fileName, "w") as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,420 @@
+# =============================================================================
+# Imports
+# =============================================================================
+import pickle
+import weakref
+import zlib
+import numpy as np
+from mpi4py import MPI
+
+from .utils import dkeys
+
+# All segments in the exchange buffers are padded to this many bytes
+# so that the unpacked views are properly aligned for any dtype.
+ALIGN = 16
+
+# Bit flags stored in the header byte of every rank's segment
+FAIL_FLAG = 1
+MISMATCH_FLAG = 2
+
+
+def _align(nBytes):
+    """Round nBytes up to the next multiple of ALIGN"""
+    return (nBytes + ALIGN - 1) // ALIGN * ALIGN
+
+
+def funcDescriptor(val):
+    """
+    Return a tuple of (shape, dtype, isScalar) that describes how a
+    functional is stored in a packed buffer. None is returned if the
+    functional is not numeric and therefore cannot be packed.
+    """
+    try:
+        arr = np.asarray(val)
+    except Exception:
+        return None
+    if arr.dtype.kind not in "biufc":
+        return None
+    return (arr.shape, arr.dtype.str, bool(np.isscalar(val)))
+
+
+class FuncLayout(object):
+    """
+    Cached byte layout of all the functionals in one contiguous
+    buffer. Each rank owns one segment of the buffer which starts
+    with a header holding the fail/mismatch flags, followed by the
+    functionals that rank owns in the communication pattern. All
+    functionals are then moved with a single Allgatherv.
+
+    Parameters
+    ----------
+    commPattern : dict
+        Dictionary mapping each functional to the rank that owns it
+    descriptors : dict
+        Dictionary mapping each functional to its (shape, dtype, isScalar)
+        descriptor as returned by funcDescriptor()
+    nProc : int
+        Size of the communicator the layout is used on
+    """
+
+    def __init__(self, commPattern, descriptors, nProc):
+        self.descriptors = descriptors
+        self.ownedKeys = [[] for i in range(nProc)]
+        for key in dkeys(commPattern):
+            self.ownedKeys[commPattern[key]].append(key)
+
+        self.offsets = {}
+        self.counts = np.zeros(nProc, "intc")
+        self.displs = np.zeros(nProc, "intc")
+        offset = 0
+        for iProc in range(nProc):
+            self.displs[iProc] = offset
+            offset += ALIGN
+            for key in self.ownedKeys[iProc]:
+                shape, dtype, isScalar = self.descriptors[key]
+                self.offsets[key] = offset
+                offset += _align(int(np.prod(shape, dtype=int)) * np.dtype(dtype).itemsize)
+            self.counts[iProc] = offset - self.displs[iProc]
+        self.size = offset
+
+    @classmethod
+    def fromDescriptors(cls, commPattern, descriptors, nProc):
+        """
+        Create the layout from the descriptors of the owners of the
+        functionals. None is returned if any of the functionals cannot
+        be packed.
+        """
+        for key in dkeys(commPattern):
+            if descriptors[key] is None:
+                return None
+
+        return cls(commPattern, descriptors, nProc)
+
+    def pack(self, res, rank, changed=False):
+        """Pack the functionals owned by rank into its send buffer. If
+        changed is True the keys of this rank changed and the buffer is
+        only flagged as a mismatch."""
+        sendBuf = np.zeros(self.counts[rank], "uint8")
+        if res.get("fail", False):
+            sendBuf[0] |= FAIL_FLAG
+        if changed:
+            sendBuf[0] |= MISMATCH_FLAG
+            return sendBuf
+
+        for key in self.ownedKeys[rank]:
+            shape, dtype, isScalar = self.descriptors[key]
+            arr = np.asarray(res.get(key))
+            if key not in res or arr.shape != shape or arr.dtype.str != dtype:
+                # The functional no longer fits the cached layout;
+                # flag it so that every rank rediscovers the layout
+                sendBuf[0] |= MISMATCH_FLAG
+                continue
+            start = self.offsets[key] - self.displs[rank]
+            sendBuf[start : start + arr.nbytes] = np.ascontiguousarray(arr).reshape(-1).view("uint8")
+
+        return sendBuf
+
+    def unpack(self, recvBuf):
+        """Return a dictionary of functionals that are views into recvBuf"""
+        funcs = {}
+        for key in dkeys(self.offsets):
+            shape, dtype, isScalar = self.descriptors[key]
+            dtype = np.dtype(dtype)
+            start = self.offsets[key]
+            size = int(np.prod(shape, dtype=int))
+            val = recvBuf[start : start + size * dtype.itemsize].view(dtype).reshape(shape)
+            if isScalar:
+                val = val[()]
+            funcs[key] = val
+
+        return funcs
+
+    def exchange(self, comm, res, changed=False):
+        """
+        Exchange all the functionals and the fail flag on comm with a
+        single Allgatherv. changed flags that the keys of this rank
+        changed since the layout was determined.
+
+        Returns
+        -------
+        funcs : dict or None
+            All the functionals. None is returned if a functional did not
+            match the cached layout or the keys changed on any rank, in
+            which case the exchange must be repeated after the layout
+            is rediscovered.
+        fail : bool
+            Logical OR of the fail flags on all ranks
+        """
+        sendBuf = self.pack(res, comm.rank, changed)
+        recvBuf = np.empty(self.size, "uint8")
+        comm.Allgatherv(sendBuf, [recvBuf, self.counts, self.displs, MPI.BYTE])
+
+        flags = np.bitwise_or.reduce(recvBuf[self.displs])
+        if flags & MISMATCH_FLAG:
+            return None, None
+
+        return self.unpack(recvBuf), bool(flags & FAIL_FLAG)
+
+
+# =============================================================================
+# Binary transport of functional sensitivities
+# =============================================================================
+def _encodeBlock(block, chunks, offset):
+    """
+    Return the manifest entry of one Jacobian block and the new offset
+    into the data region, appending the raw bytes of the block to
+    chunks. The block is stored as 'zero', 'dense' or 'coo' (flat
+    indices of the nonzeros and their values) depending on which is
+    smallest. Non-numeric blocks (pyOptSparse sparse dicts etc.) are
+    pickled into the manifest as they are.
+    """
+    desc = funcDescriptor(block)
+    if desc is None:
+        return ("object", block), offset
+
+    shape, dtype, isScalar = desc
+    arr = np.ascontiguousarray(block).reshape(-1)
+    nz = np.flatnonzero(arr)
+    if len(nz) == 0:
+        return ("zero", shape, dtype, isScalar), offset
+
+    indexDtype = np.dtype("int32") if arr.size < 2 ** 31 else np.dtype("int64")
+    if len(nz) * (indexDtype.itemsize + arr.itemsize) < arr.nbytes:
+        data = [nz.astype(indexDtype), arr[nz]]
+        entry = ("coo", shape, dtype, isScalar, offset, len(nz), indexDtype.str)
+    else:
+        data = [arr]
+        entry = ("dense", shape, dtype, isScalar, offset)
+
+    for d in data:
+        chunks.append(d.view("uint8"))
+        chunks.append(np.zeros(_align(d.nbytes) - d.nbytes, "uint8"))
+        offset += _align(d.nbytes)
+
+    return entry, offset
+
+
+def _decodeBlock(entry, data):
+    """Rebuild one Jacobian block from its manifest entry"""
+    kind = entry[0]
+    if kind == "object":
+        return entry[1]
+
+    shape, dtype, isScalar = entry[1:4]
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape, dtype=int))
+    if kind == "dense":
+        offset = entry[4]
+        arr = data[offset : offset + size * dtype.itemsize].view(dtype).reshape(shape)
+    else:
+        arr = np.zeros(shape, dtype)
+        if kind == "coo":
+            offset, nnz, indexDtype = entry[4:]
+            indexDtype = np.dtype(indexDtype)
+            idx = data[offset : offset + nnz * indexDtype.itemsize].view(indexDtype)
+            offset += _align(nnz * indexDtype.itemsize)
+            arr.reshape(-1)[idx] = data[offset : offset + nnz * dtype.itemsize].view(dtype)
+
+    if isScalar:
+        return arr[()]
+    return arr
+
+
+def encodeJacobians(funcSens, keys, compress=False):
+    """
+    Encode the sensitivities of the functionals in keys into a single
+    byte buffer. The buffer starts with two uint64 values, the length
+    of the pickled manifest and the compression flag, followed by the
+    (possibly zlib compressed) manifest and data region. The total
+    length is padded to a multiple of ALIGN.
+
+    Parameters
+    ----------
+    funcSens : dict
+        Nested dictionary of functional sensitivities, funcSens[key][dvSet]
+    keys : list
+        Functionals to encode
+    compress : bool
+        Flag to compress the buffer with zlib
+
+    Returns
+    -------
+    buf : numpy array
+        Encoded uint8 buffer
+    """
+    manifest = []
+    chunks = []
+    offset = 0
+    for key in keys:
+        if isinstance(funcSens[key], dict):
+            blocks = []
+            for dvSet in funcSens[key]:
+                entry, offset = _encodeBlock(funcSens[key][dvSet], chunks, offset)
+                blocks.append((dvSet, entry))
+            manifest.append((key, blocks))
+        else:
+            manifest.append((key, funcSens[key]))
+
+    header = pickle.dumps(manifest, protocol=pickle.HIGHEST_PROTOCOL)
+    body = np.concatenate(
+        [np.frombuffer(header, "uint8"), np.zeros(_align(len(header)) - len(header), "uint8")] + chunks
+    )
+    if compress:
+        body = np.frombuffer(zlib.compress(body, 1), "uint8")
+
+    prefix = np.array([len(header), int(compress)], "uint64").view("uint8")
+    pad = np.zeros(_align(body.nbytes) - body.nbytes, "uint8")
+
+    return np.concatenate([prefix, body, pad])
+
+
+def decodeJacobians(buf):
+    """
+    Decode a buffer produced by encodeJacobians() and return the
+    nested dictionary of sensitivities. Dense blocks are returned as
+    views into the buffer.
+    """
+    headerLen, compressed = [int(i) for i in buf[:16].view("uint64")]
+    body = buf[16:]
+    if compressed:
+        body = np.frombuffer(bytearray(zlib.decompress(body)), "uint8")
+
+    manifest = pickle.loads(body[:headerLen].tobytes())
+    data = body[_align(headerLen) :]
+
+    funcSens = {}
+    for key, blocks in manifest:
+        if isinstance(blocks, list):
+            funcSens[key] = {}
+            for dvSet, entry in blocks:
+                funcSens[key][dvSet] = _decodeBlock(entry, data)
+        else:
+            funcSens[key] = blocks
+
+    return funcSens
+
+
+def exchangeJacobians(comm, res, commPattern, compress=False, changed=False):
+    """
+    Exchange the functional sensitivities in res on comm following
+    commPattern. Every rank encodes the keys it owns, the encoded
+    sizes, fail flags and changed flags (if the keys of the rank
+    changed since commPattern was determined) are shared with an
+    Allgather and the encoded buffers are then moved with a single
+    Allgatherv.
+
+    Returns
+    -------
+    funcSens : dict or None
+        All the functional sensitivities. None is returned if the keys
+        changed on any rank, in which case the exchange must be
+        repeated after commPattern is rediscovered.
+    fail : bool
+        Logical OR of the fail flags on all ranks
+    """
+    if changed:
+        sendBuf = np.zeros(0, "uint8")
+    else:
+        ownedKeys = [key for key in dkeys(commPattern) if commPattern[key] == comm.rank]
+        sendBuf = encodeJacobians(res, ownedKeys, compress)
+
+    info = np.zeros((comm.size, 3), "int64")
+    comm.Allgather(np.array([sendBuf.nbytes, res["fail"], changed], "int64"), info)
+    if np.any(info[:, 2]):
+        return None, None
+    counts = info[:, 0]
+    displs = np.zeros(comm.size, "int64")
+    displs[1:] = np.cumsum(counts)[:-1]
+
+    recvBuf = np.empty(np.sum(counts), "uint8")
+    comm.Allgatherv(sendBuf, [recvBuf, counts, displs, MPI.BYTE])
+
+    funcSens = {}
+    for iProc in range(comm.size):
+        if counts[iProc] > 0:
+            funcSens.update(decodeJacobians(recvBuf[displs[iProc] : displs[iProc] + counts[iProc]]))
+
+    return funcSens, bool(np.any(info[:, 1]))
+
+
+# =============================================================================
+# Node-local shared memory
+# =============================================================================
+class NodeShare(object):
+    """
+    Delivers the result of an exchange to every rank of a node through
+    one MPI shared memory window per result. Only the first rank of the
+    node needs to hold the result, which it encodes with
+    encodeJacobians() into a window allocated with
+    Win.Allocate_shared. Every rank of the node then decodes the window
+    itself, so that the dense functionals and sensitivity blocks are
+    read-only views into the single copy of the node.
+
+    A window is only freed once no rank of the node references any of
+    its views anymore, so the results remain valid for as long as they
+    are used.
+
+    Parameters
+    ----------
+    nodeComm : MPI.Intracomm
+        Communicator of the ranks sharing memory, as created by
+        Split_type(MPI.COMM_TYPE_SHARED)
+    """
+
+    def __init__(self, nodeComm):
+        self.comm = nodeComm
+        self.windows = []
+
+    def share(self, result, nested=False):
+        """
+        Deliver result, the (values, fail) tuple of an exchange on the
+        first rank of the node, to every rank of the node. The result
+        of the other ranks is ignored. values is either a dictionary of
+        functionals or, if nested is True, a nested dictionary of
+        functional sensitivities. A (None, None) result is returned as
+        it is. This is a collective call on the node.
+        """
+        self._freeWindows()
+
+        header = None
+        if self.comm.rank == 0 and result[0] is not None:
+            values, fail = result
+            keys = [key for key in dkeys(values) if key != "fail"]
+            if not nested:
+                values = dict((key, {"value": values[key]}) for key in keys)
+            data = encodeJacobians(values, keys)
+            header = (data.nbytes, fail)
+        header = self.comm.bcast(header, root=0)
+        if header is None:
+            return None, None
+        nBytes, fail = header
+
+        win = MPI.Win.Allocate_shared(nBytes if self.comm.rank == 0 else 0, 1, comm=self.comm)
+        mem, _ = win.Shared_query(0)
+        buf = np.frombuffer(mem, "uint8", count=nBytes)
+        win.Fence()
+        if self.comm.rank == 0:
+            buf[:] = data
+        win.Fence()
+        buf.flags.writeable = False
+
+        values = decodeJacobians(buf)
+        if not nested:
+            values = dict((key, values[key]["value"]) for key in values)
+        self.windows.append((win, weakref.ref(buf)))
+
+        return values, fail
+
+    def _freeWindows(self):
+        """Free the windows that no rank of the node references anymore"""
+        if len(self.windows) == 0:
+            return
+        unused = np.array([ref() is None for win, ref in self.windows], "intc")
+        self.comm.Allreduce(MPI.IN_PLACE, unused, op=MPI.MIN)
+        windows = []
+        for (win, ref), free in zip(self.windows, unused):
+            if free:
+                win.Free()
+            else:
+                windows.append((win, ref))
+        self.windows = windows
@@ -2,6 +2,8 @@ import os
 import sys
 import io
 import copy
+import hashlib
+import pickle
 from mpi4py import MPI
 import numpy as np
 
@@ -29,14 +31,113 @@ def _complexifyFuncs(funcs, keys):
     return funcs
 
 
+def _nEntries(val):
+    """Return the number of entries a functional is perturbed by when
+    computing derivatives: one for a scalar, otherwise the length of
+    the first axis"""
+    if np.isscalar(val) or len(np.atleast_1d(val)) == 1:
+        return 1
+    return len(val)
+
+
 def _extractKeys(funcs, keys):
-    """Return a copy of the dict with just the keys given in keys"""
+    """Return a new dict with just the keys given in keys. Arrays are
+    not copied, instead read-only views are returned. Scalars are
+    immutable and any other type of value is deep copied."""
+    newDict = {}
+    for key in skeys(keys):
+        val = funcs[key]
+        if isinstance(val, np.ndarray):
+            val = val.view()
+            val.flags.writeable = False
+        elif not (np.isscalar(val) or val is None):
+            val = copy.deepcopy(val)
+        newDict[key] = val
+    return newDict
+
+
+def _hashFuncs(funcs, keys):
+    """Return a hash of the values of the given keys of a dict. Equal
+    values give the same hash on every processor."""
+    h = hashlib.sha1()
+    for key in skeys(keys):
+        h.update(repr(key).encode())
+        try:
+            val = np.asarray(funcs[key])
+        except Exception:
+            val = None
+        if val is None or val.dtype.kind not in "biufc":
+            h.update(pickle.dumps(funcs[key]))
+        else:
+            h.update(repr((val.shape, val.dtype.str)).encode())
+            h.update(np.ascontiguousarray(val).tobytes())
+    return h.hexdigest()
+
+
+def _perturbFuncs(funcs, keys, delta=1e-3):
+    """Return a copy of the dict with just the keys given in keys whose
+    values are randomly perturbed by a relative amount of about
+    delta. The same perturbation is used on every processor."""
+    rng = np.random.RandomState(0)
     newDict = {}
     for key in skeys(keys):
-        newDict[key] = copy.deepcopy(funcs[key])
+        val = np.array(funcs[key], float)
+        newDict[key] = val + delta * (1.0 + np.abs(val)) * rng.uniform(-1.0, 1.0, val.shape)
+        if np.isscalar(funcs[key]):
+            newDict[key] = newDict[key][()]
     return newDict
 
 
+def _sparsityPattern(jac):
+    """
+    Return the (rows, cols) of the entries of a Jacobian block given in
+    pyOptSparse's sparse 'coo', 'csr' or 'csc' format (or as a SciPy
+    sparse matrix), in the order they are stored. None is returned for
+    a dense block.
+    """
+    if hasattr(jac, "tocoo"):
+        jac = jac.tocoo()
+        return np.asarray(jac.row, int), np.asarray(jac.col, int)
+    if not isinstance(jac, dict):
+        return None
+    if "coo" in jac:
+        return np.asarray(jac["coo"][0], int), np.asarray(jac["coo"][1], int)
+    if "csr" in jac:
+        rowp = np.asarray(jac["csr"][0], int)
+        return np.repeat(np.arange(len(rowp) - 1), np.diff(rowp)), np.asarray(jac["csr"][1], int)
+    if "csc" in jac:
+        colp = np.asarray(jac["csc"][0], int)
+        return np.asarray(jac["csc"][1], int), np.repeat(np.arange(len(colp) - 1), np.diff(colp))
+    return None
+
+
+def _colorColumns(pattern):
+    """
+    Group the columns of the boolean matrix pattern so that no two
+    columns of a group have a nonzero in the same row, with the greedy
+    Curtis-Powell-Reid algorithm. The columns with the most nonzeros
+    are colored first. Columns without any nonzero are left out.
+
+    Returns
+    -------
+    groups : list
+        List of the lists of column indices of each group
+    """
+    counts = np.sum(pattern, axis=0)
+    groups = []
+    used = []
+    for col in sorted(np.flatnonzero(counts), key=lambda col: -counts[col]):
+        for group, mask in zip(groups, used):
+            if not np.any(mask & pattern[:, col]):
+                group.append(int(col))
+                mask |= pattern[:, col]
+                break
+        else:
+            groups.append([int(col)])
+            used.append(pattern[:, col].copy())
+    return groups
+
+
 def dkeys(dict):
     """Utility function to return the keys of a dict in sorted order
     so that the iteration order is guaranteed to be the same. Blame
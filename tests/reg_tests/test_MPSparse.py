@@ -1,8 +1,16 @@
+import os
+import sys
 import unittest
+import shutil
+import tempfile
+import time
 import numpy as np
 import copy
 from mpi4py import MPI
 from multipoint import multiPointSparse
+from multipoint.memberlog import readMemberLog
+from multipoint.history import LogReader
+from multipoint.utils import MPError, _extractKeys, _hashFuncs
 from pyoptsparse import Optimization
 
 gcomm = MPI.COMM_WORLD
@@ -47,6 +55,12 @@ def objCon(funcs, printOK):
     return funcs
 
 
+def objConBatched(funcs, printOK):
+    # Same as objCon, but every input carries a leading batch axis
+    funcs["total_drag"] = funcs["set1_drag"] + funcs["set2_drag"]
+    return funcs
+
+
 # we create a fake optimization problem to test
 SET_NAMES = ["set1", "set2"]
 COMM_SIZES = {"set1": [1, 1], "set2": [1]}
@@ -61,10 +75,11 @@ ALL_OBJCONS = [OBJECTIVE] + CONS
 
 class TestMPSparse(unittest.TestCase):
     N_PROCS = 3
+    MP_KWARGS = {}
 
     def setUp(self):
         # construct MP
-        self.MP = multiPointSparse(gcomm)
+        self.MP = multiPointSparse(gcomm, **self.MP_KWARGS)
         for setName in SET_NAMES:
             comm_size = COMM_SIZES[setName]
             self.MP.addProcessorSet(setName, nMembers=len(comm_size), memberSizes=comm_size)
@@ -111,6 +126,29 @@ class TestMPSparse(unittest.TestCase):
         tmpGroupFlags[self.ptID] = False
         self.assertFalse(np.any(tmpGroupFlags))
 
+    def test_layout_file(self):
+        layoutDir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        layoutFile = os.path.join(layoutDir, "layout.json")
+        # The first run writes the layout and the second one reads it
+        for i in range(2):
+            MP = multiPointSparse(gcomm)
+            for setName in SET_NAMES:
+                MP.addProcessorSet(setName, nMembers=len(COMM_SIZES[setName]), memberSizes=COMM_SIZES[setName])
+            comm, setComm, setFlags, groupFlags, ptID = MP.createCommunicators(layoutFile=layoutFile)
+            self.assertEqual(setFlags, self.setFlags)
+            self.assertEqual(ptID, self.ptID)
+            self.assertEqual(comm.size, self.comm.size)
+
+        # The layout must agree with explicit memberSizes
+        MP = multiPointSparse(gcomm)
+        for setName in SET_NAMES:
+            MP.addProcessorSet(setName, nMembers=len(COMM_SIZES[setName]), memberSizes=COMM_SIZES[setName])
+        with self.assertRaises(MPError):
+            MP.createCommunicators(memberSizes={"set1": [2, 1]}, layoutFile=layoutFile)
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(layoutDir)
+
     def test_obj_sens(self):
         x = {}
         x["v1"] = 5
@@ -128,3 +166,899 @@ class TestMPSparse(unittest.TestCase):
         # check that the derivs are wrt all DVs
         for key, val in funcsSens.items():
             self.assertEquals(set(DVS), set(val.keys()))
+
+    def test_batched_objCon(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        funcsSens, fail = self.MP.sens(x, funcs)
+
+        self.MP.setObjCon(objConBatched, batched=True)
+        funcs2, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        funcsSens2, fail = self.MP.sens(x, funcs2)
+        self.assertFalse(fail)
+
+        np.testing.assert_allclose(funcs[OBJECTIVE], funcs2[OBJECTIVE])
+        for dv in DVS:
+            np.testing.assert_allclose(funcsSens[OBJECTIVE][dv], funcsSens2[OBJECTIVE][dv])
+
+    def test_batched_objCon_no_batch_axis(self):
+        def objConNoBatchAxis(funcs, printOK):
+            funcs = objConBatched(funcs, printOK)
+            funcs["thickness_con"] = np.ones(3)
+            return funcs
+
+        self.MP.setObjCon(objConNoBatchAxis, batched=True)
+        with self.assertRaises(MPError):
+            self.MP.obj({"v1": 5.0, "v2": 2.0})
+
+    def test_sparse_gcon(self):
+        def objConThickness(funcs, printOK):
+            funcs = objCon(funcs, printOK)
+            funcs["thickness_con"] = funcs["set1_thickness"][:, 0] * funcs["set2_drag"]
+            return funcs
+
+        # Only the block with respect to v1 is declared sparse, and its
+        # entries are all zero
+        optProb = Optimization("multipoint sparse test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        jac = {"v1": {"coo": [np.array([0, 2]), np.array([0, 0]), np.ones(2)], "shape": [5, 1]}}
+        optProb.addConGroup("thickness_con", 5, upper=0.0, wrt=DVS, jac=jac)
+        self.MP.setObjCon(objConThickness)
+        self.MP.setOptProb(optProb, sparseThreshold=0.5)
+
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        gcon, fail = self.MP.sens(x, funcs)
+        self.assertFalse(fail)
+        rows, cols, data = gcon["thickness_con"]["v1"]["coo"]
+        np.testing.assert_array_equal(rows, [0, 2])
+        np.testing.assert_array_equal(cols, [0, 0])
+        np.testing.assert_array_equal(data, [0.0, 0.0])
+        np.testing.assert_allclose(gcon["thickness_con"]["v2"], np.full((5, 1), 3 * x["v2"] ** 2))
+
+        # The block with respect to v2 has nonzero entries outside of
+        # the declared pattern, which must not be dropped silently
+        jac["v2"] = {"coo": [np.array([0, 2]), np.array([0, 0]), np.ones(2)], "shape": [5, 1]}
+        optProb = Optimization("multipoint sparse test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        optProb.addConGroup("thickness_con", 5, upper=0.0, wrt=DVS, jac=jac)
+        self.MP.setOptProb(optProb, sparseThreshold=0.5)
+        funcs, fail = self.MP.obj(x)
+        with self.assertRaises(MPError):
+            self.MP.sens(x, funcs)
+
+    def test_key_change(self):
+        # set2 returns an extra functional on the second call only
+        def set2_obj_extra(x):
+            funcs = set2_obj(x)
+            if x["v1"] == 6.0:
+                funcs["set2_extra"] = np.arange(3.0) * x["v1"]
+            return funcs
+
+        def set2_sens_extra(x, funcs):
+            funcsSens = set2_sens(x, funcs)
+            if x["v1"] == 6.0:
+                funcsSens["set2_extra"] = {"v1": np.arange(3.0).reshape((3, 1)), "v2": np.zeros((3, 1))}
+            return funcsSens
+
+        self.MP.setProcSetObjFunc("set2", set2_obj_extra)
+        self.MP.setProcSetSensFunc("set2", set2_sens_extra)
+        for v1 in [5.0, 6.0, 7.0]:
+            x = {"v1": v1, "v2": 2.0}
+            funcs, fail = self.MP.obj(x)
+            self.assertFalse(fail)
+            self.assertEqual("set2_extra" in funcs, v1 == 6.0)
+            np.testing.assert_allclose(funcs[OBJECTIVE], np.average(funcs["set1_drag"]) + funcs["set2_drag"])
+            funcsSens, fail = self.MP.sens(x, funcs)
+            self.assertFalse(fail)
+
+    def test_missing_sens(self):
+        # set2 returns a functional without its sensitivities
+        def set2_obj_extra(x):
+            funcs = set2_obj(x)
+            funcs["set2_extra"] = x["v1"]
+            return funcs
+
+        self.MP.setProcSetObjFunc("set2", set2_obj_extra)
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        with self.assertRaises(MPError):
+            self.MP.sens(x, funcs)
+
+    def test_objCon_mutates_inputs(self):
+        calls = []
+
+        def objConMutate(funcs, printOK):
+            calls.append(printOK)
+            funcs["set2_drag"] = 2 * funcs["set2_drag"]
+            funcs["set1_thickness"][0] += 1.0
+            return objCon(funcs, printOK)
+
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        funcsSens, fail = self.MP.sens(x, funcs)
+        self.assertFalse(self.MP.objConMutatesInputs)
+        # The returned functionals are not views of the stored ones
+        self.assertTrue(funcs["set1_thickness"].flags.writeable)
+
+        self.MP.setObjCon(objConMutate)
+        funcs2, fail = self.MP.obj(x)
+        # objCon is only evaluated on some ranks with objConPlacement.
+        # Finding out that it modifies its inputs must not call it twice.
+        self.assertEqual(len(calls), int(self.MP._evaluatesObjCon()))
+        funcsSens2, fail = self.MP.sens(x, funcs2)
+        if self.MP._evaluatesObjCon():
+            self.assertTrue(self.MP.objConMutatesInputs)
+        np.testing.assert_allclose(funcs2[OBJECTIVE], funcs[OBJECTIVE] + funcs["set2_drag"])
+        np.testing.assert_allclose(funcsSens2[OBJECTIVE]["v1"], funcsSens[OBJECTIVE]["v1"])
+        np.testing.assert_allclose(funcsSens2[OBJECTIVE]["v2"], 2 * funcsSens[OBJECTIVE]["v2"])
+
+    def test_objCon_sens(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        funcsSens, fail = self.MP.sens(x, funcs)
+
+        def objConSens(funcs, printOK):
+            return {"total_drag": {"set1_drag": 1.0, "set2_drag": 1.0}}
+
+        for kwargs in [{"sens": "AD"}, {"sens": objConSens}, {"distributed": True}, {"checkLinear": True}]:
+            self.MP.setObjCon(objCon, **kwargs)
+            funcs2, fail = self.MP.obj(x)
+            funcsSens2, fail = self.MP.sens(x, funcs2)
+            self.assertFalse(fail)
+            for dv in DVS:
+                np.testing.assert_allclose(funcsSens[OBJECTIVE][dv], funcsSens2[OBJECTIVE][dv])
+
+        # objCon is a sum of functionals
+        if self.MP._evaluatesObjCon():
+            self.assertTrue(self.MP.objConLinear)
+
+    def test_objCon_AD_object_array(self):
+        # The output is an object array of dual numbers
+        def objConList(funcs, printOK):
+            funcs["total_drag"] = np.array([funcs["set1_drag"] + funcs["set2_drag"]])
+            return funcs
+
+        self.MP.setObjCon(objConList, sens="AD")
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        with self.assertRaises(MPError):
+            self.MP.sens(x, funcs)
+
+    def test_objCon_linear_new_input(self):
+        # set2 returns an extra functional from the second call on
+        def set2_obj_extra(x):
+            funcs = set2_obj(x)
+            if x["v1"] == 6.0:
+                funcs["set2_extra"] = np.arange(3.0) * x["v1"]
+            return funcs
+
+        def set2_sens_extra(x, funcs):
+            funcsSens = set2_sens(x, funcs)
+            if x["v1"] == 6.0:
+                funcsSens["set2_extra"] = {"v1": np.arange(3.0).reshape((3, 1)), "v2": np.zeros((3, 1))}
+            return funcsSens
+
+        def objConExtra(funcs, printOK):
+            funcs = objCon(funcs, printOK)
+            if "set2_extra" in funcs:
+                funcs["total_drag"] = funcs["total_drag"] + np.sum(funcs["set2_extra"])
+            return funcs
+
+        self.MP.setProcSetObjFunc("set2", set2_obj_extra)
+        self.MP.setProcSetSensFunc("set2", set2_sens_extra)
+        self.MP.setObjCon(objConExtra, checkLinear=True)
+        for v1, extra in [(5.0, 0.0), (6.0, 3.0)]:
+            x = {"v1": v1, "v2": 2.0}
+            funcs, fail = self.MP.obj(x)
+            gcon, fail = self.MP.sens(x, funcs)
+            self.assertFalse(fail)
+            if self.MP._evaluatesObjCon():
+                self.assertTrue(self.MP.objConLinear)
+            np.testing.assert_allclose(gcon[OBJECTIVE]["v1"], 2 * v1 + extra)
+            np.testing.assert_allclose(gcon[OBJECTIVE]["v2"], 12.0)
+
+    def test_objCon_linear_passThrough(self):
+        # The Jacobian of objCon depends on the pass-through set1_lift
+        def objConPassThrough(funcs, printOK, passThroughFuncs):
+            funcs["total_drag"] = funcs["set1_drag"] * passThroughFuncs["set1_lift"] + funcs["set2_drag"]
+            return funcs
+
+        optProb = Optimization("multipoint pass-through test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        optProb.addConGroup("set1_lift", 1, upper=100.0, wrt=DVS)
+        self.MP.setOptProb(optProb)
+
+        for checkLinear in [False, True]:
+            self.MP.setObjCon(objConPassThrough, checkLinear=checkLinear)
+            for v1 in [5.0, 6.0]:
+                x = {"v1": v1, "v2": 2.0}
+                funcs, fail = self.MP.obj(x)
+                gcon, fail = self.MP.sens(x, funcs)
+                self.assertFalse(fail)
+                np.testing.assert_allclose(gcon[OBJECTIVE]["v1"], funcs["set1_lift"] * 2 * v1)
+        self.assertFalse(self.MP.objConLinear)
+
+    def test_objCon_coloring(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        funcsSens, fail = self.MP.sens(x, funcs)
+
+        self.MP.setObjCon(objCon, coloring=True)
+        # The first call finds the coloring and the second one uses it
+        for i in range(2):
+            funcs2, fail = self.MP.obj(x)
+            funcsSens2, fail = self.MP.sens(x, funcs2)
+            for dv in DVS:
+                np.testing.assert_allclose(funcsSens[OBJECTIVE][dv], funcsSens2[OBJECTIVE][dv])
+
+        # Only set1_drag and set2_drag affect the only output and they
+        # cannot be grouped, the other entries are left out
+        if not self.MP._evaluatesObjCon():
+            return
+        perturbations, seeds, rows = self.MP.objConColoring
+        self.assertEqual(perturbations[0], ("set1_drag", None))
+        self.assertEqual(perturbations[7], ("set2_drag", None))
+        self.assertEqual(seeds, [[0], [7]])
+
+        # The Jacobian with the coloring matches the one without it
+        passThroughFuncs = _extractKeys(self.MP.funcs, self.MP.passThroughKeys)
+        colored = self.MP._computeObjConSens(self.MP.funcs, passThroughFuncs)
+        self.assertIsNotNone(self.MP.objConColoring)
+        self.MP.colorObjCon = False
+        uncolored = self.MP._computeObjConSens(self.MP.funcs, passThroughFuncs)
+        for oKey in self.MP.outputKeys:
+            for iKey in self.MP.inputKeys:
+                np.testing.assert_allclose(colored[oKey][iKey], uncolored[oKey][iKey], rtol=1e-14)
+
+
+class TestMPSparseBuffer(TestMPSparse):
+    MP_KWARGS = {"commMode": "buffer"}
+
+    def test_obj_buffer_layout(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertIsNotNone(self.MP.objLayout)
+        # The second call goes through the packed buffer and must agree
+        funcs2, fail2 = self.MP.obj(x)
+        self.assertEqual(fail, fail2)
+        for key in ALL_FUNCS + ALL_OBJCONS:
+            np.testing.assert_allclose(funcs[key], funcs2[key])
+
+
+class TestMPSparseProfile(TestMPSparse):
+    MP_KWARGS = {"profile": True}
+
+    def test_profile(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.MP.sens(x, funcs)
+
+        report = self.MP.getProfile()
+        if gcomm.rank == 0:
+            for name in ["obj", "sens", "wait", "exchange", "objCon", "objConSens"]:
+                self.assertIn(name, report["phases"])
+            self.assertEqual(set(report["bytes"]["objective"].keys()), set(ALL_FUNCS))
+            self.assertEqual(len(report["ranks"]), gcomm.size)
+        else:
+            self.assertIsNone(report)
+
+
+def failing_func(*args):
+    raise AssertionError("user function called on a cached design point")
+
+
+class TestMPSparseCache(TestMPSparse):
+    MP_KWARGS = {"cacheSize": 2}
+
+    def test_cache(self):
+        calls = []
+        setName = self.MP.getSetName()
+        objFunc, sensFunc = SET_FUNC_HANDLES[setName]
+
+        def counting_obj(x):
+            calls.append("obj")
+            return objFunc(x)
+
+        def counting_sens(x, funcs):
+            calls.append("sens")
+            return sensFunc(x, funcs)
+
+        self.MP.setProcSetObjFunc(setName, counting_obj)
+        self.MP.setProcSetSensFunc(setName, counting_sens)
+
+        # Repeated points must not call any user function
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        gcon, fail = self.MP.sens(x, funcs)
+        funcs2, fail2 = self.MP.obj(x)
+        gcon2, fail2 = self.MP.sens(x, funcs2)
+        self.assertEqual(calls, ["obj", "sens"])
+        for key in ALL_FUNCS + ALL_OBJCONS:
+            np.testing.assert_allclose(funcs[key], funcs2[key])
+        for dv in DVS:
+            np.testing.assert_allclose(gcon[OBJECTIVE][dv], gcon2[OBJECTIVE][dv])
+
+        # The least recently used point is dropped
+        for v1 in [6.0, 7.0, 5.0]:
+            self.MP.obj({"v1": v1, "v2": 2.0})
+        self.assertEqual(calls, ["obj", "sens", "obj", "obj", "obj"])
+
+        # Replacing objCon invalidates the cached results
+        def objConDouble(funcs, printOK):
+            funcs = objCon(funcs, printOK)
+            funcs["total_drag"] *= 2.0
+            return funcs
+
+        del calls[:]
+        self.MP.setObjCon(objConDouble)
+        funcs3, fail3 = self.MP.obj(x)
+        gcon3, fail3 = self.MP.sens(x, funcs3)
+        self.assertEqual(calls, ["obj", "sens"])
+        np.testing.assert_allclose(funcs3[OBJECTIVE], 2 * funcs[OBJECTIVE])
+        for dv in DVS:
+            np.testing.assert_allclose(gcon3[OBJECTIVE][dv], 2 * gcon[OBJECTIVE][dv])
+
+        # sens() at the last point uses the new objCon even if obj() was
+        # not called after replacing it
+        del calls[:]
+        self.MP.setObjCon(objCon)
+        gcon4, fail4 = self.MP.sens(x, funcs3)
+        self.assertEqual(calls, ["obj", "sens"])
+        for dv in DVS:
+            np.testing.assert_allclose(gcon4[OBJECTIVE][dv], gcon[OBJECTIVE][dv])
+
+    def test_cache_copies(self):
+        # Modifying the returned arrays must not change the cached ones
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        gcon, fail = self.MP.sens(x, funcs)
+        thickness = funcs["set1_thickness"].copy()
+        deriv = gcon[OBJECTIVE]["v1"].copy()
+        funcs["set1_thickness"][:] = 0.0
+        gcon[OBJECTIVE]["v1"][:] = 0.0
+
+        for _ in range(2):
+            funcs2, fail = self.MP.obj(x)
+            gcon2, fail = self.MP.sens(x, funcs2)
+            np.testing.assert_allclose(funcs2["set1_thickness"], thickness)
+            np.testing.assert_allclose(gcon2[OBJECTIVE]["v1"], deriv)
+            funcs2["set1_thickness"][:] = 0.0
+            gcon2[OBJECTIVE]["v1"][:] = 0.0
+
+    def test_cache_fail(self):
+        calls = []
+        setName = self.MP.getSetName()
+        objFunc = SET_FUNC_HANDLES[setName][0]
+
+        def failing_once_obj(x):
+            calls.append("obj")
+            funcs = objFunc(x)
+            funcs["fail"] = len(calls) == 1
+            return funcs
+
+        self.MP.setProcSetObjFunc(setName, failing_once_obj)
+
+        # A failed evaluation is not cached
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertTrue(fail)
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        funcs, fail = self.MP.obj(x)
+        self.assertEqual(calls, ["obj", "obj"])
+
+
+class TestMPSparseHistory(TestMPSparse):
+    def setUp(self):
+        self.historyDir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        self.MP_KWARGS = {"historyDir": self.historyDir}
+        super().setUp()
+
+    def tearDown(self):
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(self.historyDir)
+
+    def test_replay(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        gcon, fail = self.MP.sens(x, funcs)
+
+        # A restarted run must replay the logged results
+        self.MP_KWARGS = {"historyDir": self.historyDir, "replayHistory": True}
+        super().setUp()
+        setName = self.MP.getSetName()
+        self.MP.setProcSetObjFunc(setName, failing_func)
+        self.MP.setProcSetSensFunc(setName, failing_func)
+        funcs2, fail2 = self.MP.obj(x)
+        gcon2, fail2 = self.MP.sens(x, funcs2)
+        for key in ALL_FUNCS + ALL_OBJCONS:
+            np.testing.assert_allclose(funcs[key], funcs2[key])
+        for dv in DVS:
+            np.testing.assert_allclose(gcon[OBJECTIVE][dv], gcon2[OBJECTIVE][dv])
+
+
+class TestMPSparseDVGroups(unittest.TestCase):
+    N_PROCS = 3
+
+    def setUp(self):
+        # set1 only depends on v1 and set2 only on v2
+        self.MP = multiPointSparse(gcomm)
+        self.MP.addProcessorSet("set1", nMembers=2, memberSizes=1, dvGroups=["v1"])
+        self.MP.addProcessorSet("set2", nMembers=1, memberSizes=1, dvGroups=["v2"])
+        self.MP.createCommunicators()
+
+        # Number of obj and sens calls of every set on this processor
+        self.calls = dict((setName, [0, 0]) for setName in SET_NAMES)
+        for setName in SET_NAMES:
+            self.MP.setProcSetObjFunc(setName, self._counting(setName, 0, SET_FUNC_HANDLES[setName][0]))
+            self.MP.setProcSetSensFunc(setName, self._counting(setName, 1, SET_FUNC_HANDLES[setName][1]))
+
+        optProb = Optimization("multipoint dvGroups test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        self.MP.setObjCon(objCon)
+        self.MP.setOptProb(optProb)
+
+    def _counting(self, setName, index, func):
+        def counting_func(*args):
+            self.calls[setName][index] += 1
+            return func(*args)
+
+        return counting_func
+
+    def _checkCalls(self, expected):
+        setName = self.MP.getSetName()
+        self.assertEqual(self.calls[setName], expected[setName])
+
+    def test_skip_unchanged(self):
+        expected = {"set1": [0, 0], "set2": [0, 0]}
+        # Only the sets whose dvGroups changed are evaluated again
+        for v1, v2, changed in [(5.0, 2.0, SET_NAMES), (6.0, 2.0, ["set1"]), (6.0, 3.0, ["set2"]), (6.0, 3.0, [])]:
+            x = {"v1": v1, "v2": v2}
+            funcs, fail = self.MP.obj(x)
+            self.assertFalse(fail)
+            gcon, fail = self.MP.sens(x, funcs)
+            self.assertFalse(fail)
+            for setName in changed:
+                expected[setName] = [expected[setName][0] + 1, expected[setName][1] + 1]
+            self._checkCalls(expected)
+
+            np.testing.assert_allclose(funcs["set2_drag"], v2 ** 3)
+            np.testing.assert_allclose(funcs[OBJECTIVE], v1 ** 2 + v2 ** 3)
+            np.testing.assert_allclose(gcon[OBJECTIVE]["v1"], 2.0 * v1)
+            np.testing.assert_allclose(gcon[OBJECTIVE]["v2"], 3.0 * v2 ** 2)
+
+    def test_function_changed(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        self.MP.obj(x)
+
+        # Replacing a function discards the results of its set only
+        self.MP.setProcSetObjFunc("set2", self._counting("set2", 0, set2_obj))
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        self._checkCalls({"set1": [1, 0], "set2": [2, 0]})
+
+    def test_reuse_copies(self):
+        # The arrays returned by the obj function may be modified in place
+        # after the call, which must not change the reused results
+        thickness = np.ones((5, 1))
+
+        def set1_buffer_obj(x):
+            funcs = set1_obj(x)
+            funcs["set1_thickness"] = thickness
+            return funcs
+
+        self.MP.setProcSetObjFunc("set1", self._counting("set1", 0, set1_buffer_obj))
+        x = {"v1": 5.0, "v2": 2.0}
+        self.MP.obj(x)
+        thickness[:] = 0.0
+        for _ in range(2):
+            funcs, fail = self.MP.obj(x)
+            self.assertFalse(fail)
+            np.testing.assert_allclose(funcs["set1_thickness"], 1.0)
+            funcs["set1_thickness"][:] = 0.0
+        self._checkCalls({"set1": [1, 0], "set2": [1, 0]})
+
+    def test_fail(self):
+        def failing_once_obj(x):
+            funcs = set2_obj(x)
+            funcs["fail"] = self.calls["set2"][0] == 1
+            return funcs
+
+        # A failed evaluation is not reused
+        self.MP.setProcSetObjFunc("set2", self._counting("set2", 0, failing_once_obj))
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertTrue(fail)
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        self._checkCalls({"set1": [1, 0], "set2": [2, 0]})
+
+
+class TestMPSparseSparseSens(TestMPSparse):
+    MP_KWARGS = {"sensCommMode": "sparse", "compressSens": True}
+
+
+class TestMPSparseLocalObjCon(TestMPSparse):
+    MP_KWARGS = {"objConPlacement": "local"}
+
+
+class TestMPSparseRootObjCon(TestMPSparse):
+    MP_KWARGS = {"objConPlacement": "root"}
+
+    def test_placement(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        gcon, fail = self.MP.sens(x, funcs)
+        self.assertFalse(fail)
+
+        # Same problem with the default placement
+        self.MP_KWARGS = {}
+        self.setUp()
+        funcs2, fail = self.MP.obj(x)
+        gcon2, fail = self.MP.sens(x, funcs2)
+        self.assertEqual(set(funcs.keys()), set(funcs2.keys()))
+        for key in funcs2:
+            np.testing.assert_allclose(funcs[key], funcs2[key])
+        for key in ALL_OBJCONS:
+            for dv in DVS:
+                np.testing.assert_allclose(gcon[key][dv], gcon2[key][dv])
+
+
+class TestMPSparseSetRootsObjCon(TestMPSparseRootObjCon):
+    MP_KWARGS = {"objConPlacement": "setRoots"}
+
+
+class TestMPSparseHierarchical(TestMPSparseBuffer):
+    MP_KWARGS = {"commMode": "buffer", "topology": "hierarchical"}
+
+    def test_topology(self):
+        # Only the member roots take part in the exchanges
+        self.assertEqual(self.MP.rootComm != MPI.COMM_NULL, self.MP.memberComm.rank == 0)
+        self.assertEqual(self.MP.nExchangeProcs, gcomm.allreduce(int(self.MP.memberComm.rank == 0)))
+
+
+class TestMPSparseShared(TestMPSparseBuffer):
+    MP_KWARGS = {"commMode": "buffer", "topology": "shared"}
+
+    def test_shared_views(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        self.MP.obj(x)
+        # Every rank, including the member roots, reads the single copy
+        # of its node in the shared memory window
+        for key in ALL_FUNCS:
+            if isinstance(self.MP.funcs[key], np.ndarray) and self.MP.funcs[key].ndim > 0:
+                self.assertFalse(self.MP.funcs[key].flags.writeable)
+                base = self.MP.funcs[key]
+                while isinstance(base, np.ndarray) and base.base is not None:
+                    base = base.base
+                self.assertIsInstance(base, MPI.buffer)
+
+
+class TestMPSparseHierarchicalMultiRank(unittest.TestCase):
+    # The first member of set1 runs on two ranks, so only some of the
+    # ranks of that member take part in the exchanges
+    N_PROCS = 4
+    COMM_SIZES = {"set1": [2, 1], "set2": [1]}
+    MP_KWARGS = {"commMode": "buffer", "topology": "hierarchical"}
+
+    def createMP(self, **kwargs):
+        MP = multiPointSparse(gcomm, **kwargs)
+        for setName in SET_NAMES:
+            MP.addProcessorSet(setName, nMembers=len(self.COMM_SIZES[setName]), memberSizes=self.COMM_SIZES[setName])
+        comm, setComm, setFlags, groupFlags, ptID = MP.createCommunicators()
+
+        # Every rank of a member must return the same functionals
+        def set1_member_obj(x):
+            return {"set1_drag": x["v1"] ** 2 * (ptID + 1), "set1_thickness": np.ones((5, 1)) * (ptID + 1)}
+
+        def set1_member_sens(x, funcs):
+            return {
+                "set1_drag": {"v1": 2 * x["v1"] * (ptID + 1), "v2": 0},
+                "set1_thickness": {"v1": np.zeros((5, 1)), "v2": np.zeros((5, 1))},
+            }
+
+        MP.setProcSetObjFunc("set1", set1_member_obj)
+        MP.setProcSetSensFunc("set1", set1_member_sens)
+        MP.setProcSetObjFunc("set2", set2_obj)
+        MP.setProcSetSensFunc("set2", set2_sens)
+
+        optProb = Optimization("multipoint test", MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        MP.setObjCon(objCon)
+        MP.setOptProb(optProb)
+        return MP
+
+    def test_multi_rank_members(self):
+        MP = self.createMP(**self.MP_KWARGS)
+        self.assertEqual(sorted(gcomm.allgather(MP.memberComm.size)), [1, 1, 2, 2])
+        self.assertEqual(MP.nExchangeProcs, 3)
+
+        # Every rank gets the same results as with the flat topology
+        flatMP = self.createMP(commMode="buffer")
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = MP.obj(x)
+        self.assertFalse(fail)
+        funcsSens, fail = MP.sens(x, funcs)
+        self.assertFalse(fail)
+        flatFuncs, fail = flatMP.obj(x)
+        flatFuncsSens, fail = flatMP.sens(x, flatFuncs)
+        for key in ["set1_drag", "set1_thickness", "set2_drag"] + ALL_OBJCONS:
+            np.testing.assert_allclose(funcs[key], flatFuncs[key])
+        for dv in DVS:
+            np.testing.assert_allclose(funcsSens[OBJECTIVE][dv], flatFuncsSens[OBJECTIVE][dv])
+
+
+class TestMPSparseSharedMultiRank(TestMPSparseHierarchicalMultiRank):
+    MP_KWARGS = {"commMode": "buffer", "topology": "shared"}
+
+
+def sweep_obj(x, ptID):
+    return {"sweep_drag_%d" % ptID: x["v1"] * (ptID + 1)}
+
+
+def sweep_sens(x, funcs, ptID):
+    return {"sweep_drag_%d" % ptID: {"v1": float(ptID + 1), "v2": 0.0}}
+
+
+N_SWEEP = 5
+
+
+def sweepObjCon(funcs, printOK):
+    funcs["total_drag"] = sum(funcs["sweep_drag_%d" % i] for i in range(N_SWEEP)) + funcs["set2_drag"]
+    return funcs
+
+
+class TestMPSparseScheduled(unittest.TestCase):
+    N_PROCS = 3
+    MP_KWARGS = {}
+
+    def setUp(self):
+        # 5 points dynamically scheduled on 2 members
+        self.MP = multiPointSparse(gcomm, **self.MP_KWARGS)
+        self.MP.addProcessorSet("sweep", nMembers=2, memberSizes=1, nPoints=N_SWEEP)
+        self.MP.addProcessorSet("set2", nMembers=1, memberSizes=1)
+        self.MP.createCommunicators()
+        self.MP.setProcSetObjFunc("sweep", sweep_obj)
+        self.MP.setProcSetSensFunc("sweep", sweep_sens)
+        self.MP.setProcSetObjFunc("set2", set2_obj)
+        self.MP.setProcSetSensFunc("set2", set2_sens)
+
+        optProb = Optimization("multipoint scheduled test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        self.MP.setObjCon(sweepObjCon)
+        self.MP.setOptProb(optProb)
+
+    def test_scheduled(self):
+        for i in range(3):
+            x = {"v1": 5.0 + i, "v2": 2.0}
+            funcs, fail = self.MP.obj(x)
+            self.assertFalse(fail)
+            np.testing.assert_allclose(funcs["total_drag"], 15 * x["v1"] + x["v2"] ** 3)
+
+            gcon, fail = self.MP.sens(x, funcs)
+            self.assertFalse(fail)
+            np.testing.assert_allclose(gcon["total_drag"]["v1"], 15.0)
+            np.testing.assert_allclose(gcon["total_drag"]["v2"], 3 * x["v2"] ** 2)
+
+        # Every point was evaluated and tagged with its ID
+        pointKeys = self.MP.pSet["sweep"].pointKeys
+        if pointKeys is not None:
+            self.assertEqual(sorted(pointKeys.keys()), list(range(N_SWEEP)))
+            for ptID in range(N_SWEEP):
+                self.assertEqual(pointKeys[ptID], ["sweep_drag_%d" % ptID])
+
+    def test_sens_on_obj_member(self):
+        # The sens of every point must be evaluated on the member whose
+        # analysis was last run at that point
+        solved = {}
+
+        def state_obj(x, ptID):
+            solved[ptID] = x["v1"]
+            return sweep_obj(x, ptID)
+
+        def state_sens(x, funcs, ptID):
+            funcsSens = sweep_sens(x, funcs, ptID)
+            funcsSens["fail"] = solved.get(ptID) != x["v1"]
+            return funcsSens
+
+        self.MP.setProcSetObjFunc("sweep", state_obj)
+        self.MP.setProcSetSensFunc("sweep", state_sens)
+        for i in range(4):
+            x = {"v1": 5.0 + i, "v2": 2.0}
+            funcs, fail = self.MP.obj(x)
+            gcon, fail = self.MP.sens(x, funcs)
+            self.assertFalse(fail)
+            np.testing.assert_allclose(gcon["total_drag"]["v1"], 15.0)
+
+    def test_replay_sens(self):
+        solved = {}
+
+        def state_obj(x, ptID):
+            solved[ptID] = x["v1"]
+            return sweep_obj(x, ptID)
+
+        def state_sens(x, funcs, ptID):
+            funcsSens = sweep_sens(x, funcs, ptID)
+            funcsSens["fail"] = solved.get(ptID) != x["v1"]
+            return funcsSens
+
+        historyDir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        x = {"v1": 5.0, "v2": 2.0}
+        self.MP_KWARGS = {"historyDir": historyDir}
+        self.setUp()
+        self.MP.setProcSetObjFunc("sweep", state_obj)
+        self.MP.obj(x)
+
+        # Only the functionals are replayed, so the analysis of every
+        # point must be run again before its sens
+        solved.clear()
+        self.MP_KWARGS = {"historyDir": historyDir, "replayHistory": True}
+        self.setUp()
+        self.MP.setProcSetObjFunc("sweep", state_obj)
+        self.MP.setProcSetSensFunc("sweep", state_sens)
+        funcs, fail = self.MP.obj(x)
+        self.assertEqual(solved, {})
+        gcon, fail = self.MP.sens(x, funcs)
+        self.assertFalse(fail)
+        np.testing.assert_allclose(gcon["total_drag"]["v1"], 15.0)
+
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(historyDir)
+
+
+class TestMPSparseStraggler(unittest.TestCase):
+    N_PROCS = 3
+    MP_KWARGS = {}
+
+    def setUp(self):
+        # The first member stalls on its first point until it is told to
+        # stop, so the second member must re-run that point
+        self.MP = multiPointSparse(gcomm, **self.MP_KWARGS)
+        self.MP.addProcessorSet("sweep", nMembers=2, memberSizes=1, nPoints=N_SWEEP, speculative=True)
+        self.MP.addProcessorSet("set2", nMembers=1, memberSizes=1, timeBudget=0.2)
+        self.comm, self.setComm, self.setFlags, self.groupFlags, self.ptID = self.MP.createCommunicators()
+        self.stalled = False
+
+        def stalling_obj(x, ptID):
+            if self.ptID == 0 and not self.stalled:
+                self.stalled = True
+                while not self.MP.stopRequested():
+                    time.sleep(0.01)
+                return {"sweep_drag_%d" % ptID: np.nan}
+            return sweep_obj(x, ptID)
+
+        def slow_obj(x):
+            if x["v1"] > 5.0:
+                time.sleep(0.3)
+            return set2_obj(x)
+
+        self.MP.setProcSetObjFunc("sweep", stalling_obj)
+        self.MP.setProcSetObjFunc("set2", slow_obj)
+
+        optProb = Optimization("multipoint straggler test", self.MP.obj)
+        for dv in DVS:
+            optProb.addVar(dv)
+        optProb.addObj("total_drag")
+        self.MP.setObjCon(sweepObjCon)
+        self.MP.setOptProb(optProb)
+
+    def test_straggler(self):
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+        np.testing.assert_allclose(funcs["total_drag"], 15 * x["v1"] + x["v2"] ** 3)
+        self.assertEqual(len(self.MP.getStragglers()), 0)
+
+        # Exceeding the time budget fails the evaluation
+        x = {"v1": 6.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertTrue(fail)
+        stragglers = self.MP.getStragglers()
+        self.assertEqual(len(stragglers), 1)
+        self.assertEqual(stragglers[0]["setName"], "set2")
+
+    def test_straggler_history(self):
+        historyDir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        self.MP_KWARGS = {"historyDir": historyDir}
+        self.setUp()
+        x = {"v1": 5.0, "v2": 2.0}
+        funcs, fail = self.MP.obj(x)
+        self.assertFalse(fail)
+
+        # The member that lost the point to the speculative re-run must
+        # not log its aborted result
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            xHash = _hashFuncs(x, x.keys())
+            nRecords = 0
+            for member in range(2):
+                reader = LogReader([os.path.join(historyDir, "sweep_%d.mplog" % member)])
+                for ptID in range(N_SWEEP):
+                    record = reader.get("objective", xHash, ptID)
+                    if record is not None:
+                        nRecords += 1
+                        np.testing.assert_allclose(record[0]["sweep_drag_%d" % ptID], x["v1"] * (ptID + 1))
+            self.assertEqual(nRecords, N_SWEEP)
+            shutil.rmtree(historyDir)
+
+
+class TestMPSparseDirectories(unittest.TestCase):
+    N_PROCS = 3
+
+    def setUp(self):
+        self.dir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        self.rootDir = os.path.join(self.dir, "root")
+        self.scratchDir = os.path.join(self.dir, "scratch_%d" % gcomm.rank)
+        self.MP = multiPointSparse(gcomm)
+        self.MP.addProcessorSet("set1", nMembers=2, memberSizes=[1, 2])
+
+    def tearDown(self):
+        self.MP.flushDirectories()
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(self.dir)
+
+    def test_before_communicators(self):
+        ptDirs = self.MP.createDirectories(self.rootDir)
+        for path in ptDirs["set1"]:
+            self.assertTrue(os.path.isdir(path))
+        with self.assertRaises(MPError):
+            self.MP.createDirectories(self.rootDir, self.scratchDir)
+
+    def test_stage_member_sizes(self):
+        # The sizes given to createCommunicators decide the members
+        comm, setComm, setFlags, groupFlags, ptID = self.MP.createCommunicators(memberSizes={"set1": [2, 1]})
+        self.assertEqual(ptID, 0 if gcomm.rank < 2 else 1)
+        ptDirs = self.MP.createDirectories(self.rootDir, self.scratchDir)
+        self.assertEqual(ptDirs["set1"][ptID], os.path.join(self.scratchDir, "set1_member%d" % ptID, "set1_%d" % ptID))
+        self.assertEqual(ptDirs["set1"][1 - ptID], os.path.join(self.rootDir, "set1_%d" % (1 - ptID)))
+        for iMember in range(2):
+            self.assertTrue(os.path.isdir(os.path.join(self.rootDir, "set1_%d" % iMember)))
+
+
+class TestMPSparseOutput(unittest.TestCase):
+    N_PROCS = 3
+
+    def setUp(self):
+        self.logDir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        self.MP = multiPointSparse(gcomm)
+        self.MP.addProcessorSet("set1", nMembers=2, memberSizes=[1, 2])
+
+    def tearDown(self):
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(self.logDir)
+
+    def test_redirect_output(self):
+        comm, setComm, setFlags, groupFlags, ptID = self.MP.createCommunicators()
+        # Test runners may replace sys.stdout, so the original stream
+        # and file descriptor are used
+        stdout = os.fstat(1)
+        self.MP.redirectOutput(self.logDir)
+        print("rank %d" % gcomm.rank, file=sys.__stdout__)
+        if gcomm.rank == 0:
+            # The exit hook makes no collective call
+            self.MP._restoreOutput()
+            self.assertEqual(os.fstat(1).st_ino, stdout.st_ino)
+        self.MP.closeOutput()
+
+        self.assertEqual(os.fstat(1).st_ino, stdout.st_ino)
+        output = readMemberLog(os.path.join(self.logDir, "set1.mplog"))
+        self.assertEqual(output[(ptID, setComm.rank)], "rank %d\n" % gcomm.rank)
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mpi4py import MPI
+from multipoint.directories import DirectoryManager
+
+
+class TestDirectories(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rootDir = os.path.join(self.dir, "root")
+        self.scratchDir = os.path.join(self.dir, "scratch")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_create(self):
+        manager = DirectoryManager(self.rootDir)
+        paths = manager.create(["cruise_0", "cruise_1"])
+        self.assertEqual(paths, [os.path.join(self.rootDir, "cruise_0"), os.path.join(self.rootDir, "cruise_1")])
+        for path in paths:
+            self.assertTrue(os.path.isdir(path))
+
+    def test_flush(self):
+        manager = DirectoryManager(self.rootDir, self.scratchDir)
+        path = manager.stage("cruise_member0", ["cruise_0"])[0]
+        self.assertTrue(path.startswith(self.scratchDir))
+
+        with open(os.path.join(path, "out.txt"), "w") as f:
+            f.write("first")
+        manager.flush(MPI.COMM_SELF, wait=True)
+        with open(os.path.join(self.rootDir, "cruise_0", "out.txt")) as f:
+            self.assertEqual(f.read(), "first")
+
+        # Only changed files are copied again
+        with open(os.path.join(path, "out.txt"), "w") as f:
+            f.write("second")
+        os.makedirs(os.path.join(path, "sub"))
+        with open(os.path.join(path, "sub", "new.txt"), "w") as f:
+            f.write("new")
+        manager.flush(MPI.COMM_SELF, wait=True)
+        with open(os.path.join(self.rootDir, "cruise_0", "out.txt")) as f:
+            self.assertEqual(f.read(), "second")
+        self.assertTrue(os.path.exists(os.path.join(self.rootDir, "cruise_0", "sub", "new.txt")))
+
+
+if __name__ == "__main__":
+    unittest.main()
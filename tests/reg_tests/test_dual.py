@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+from multipoint.dual import seedInputs
+
+
+def func(funcs):
+    a = funcs["a"]
+    b = funcs["b"]
+    out = {}
+    out["f1"] = np.average(a) * b + np.sqrt(b) / (1.0 + a ** 2).sum()
+    out["f2"] = np.exp(a) * np.sin(b) - np.dot(np.atleast_2d(a), np.arange(3.0))
+    out["f3"] = np.concatenate([a[:2] ** 3, np.atleast_1d(np.log(b))]) @ np.eye(3)
+    out["f4"] = np.maximum(a, 2.0 * b) + (-a).max()
+    return out
+
+
+class TestDual(unittest.TestCase):
+    def test_againstComplexStep(self):
+        funcs = {"a": np.array([0.3, 1.2, 2.5]), "b": 1.7}
+        keys = ["a", "b"]
+        dualFuncs, nEntries = seedInputs(funcs, keys)
+        self.assertEqual(nEntries, {"a": 3, "b": 1})
+        out = func(dualFuncs)
+
+        # Complex step reference
+        cFuncs = {"a": funcs["a"].astype("D"), "b": complex(funcs["b"])}
+        seed = 0
+        for key in keys:
+            for i in range(nEntries[key]):
+                if key == "a":
+                    cFuncs[key][i] += 1e-40j
+                else:
+                    cFuncs[key] += 1e-40j
+                con = func(cFuncs)
+                if key == "a":
+                    cFuncs[key][i] -= 1e-40j
+                else:
+                    cFuncs[key] -= 1e-40j
+
+                for oKey in con:
+                    ref = np.imag(np.atleast_1d(con[oKey])).reshape(-1) / 1e-40
+                    np.testing.assert_allclose(out[oKey].deriv.reshape((-1, 4))[:, seed], ref, rtol=1e-12, atol=1e-14)
+                    np.testing.assert_allclose(out[oKey].value, np.real(con[oKey]))
+                seed += 1
+
+    def test_unsupported(self):
+        dualFuncs, nEntries = seedInputs({"a": np.ones(3)}, ["a"])
+        with self.assertRaises(TypeError):
+            np.fft.fft(dualFuncs["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
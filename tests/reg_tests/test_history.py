@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from multipoint.history import LogWriter, LogReader
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, "test.mplog")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        funcs = {"drag": 0.5, "thickness": np.arange(5.0), "fail": False}
+        funcSens = {"drag": {"x": np.arange(3.0).reshape(1, 3)}, "thickness": {"x": np.eye(5, 3)}}
+        log = LogWriter(self.fileName)
+        log.append("objective", "a" * 40, funcs)
+        log.append("sensitivity", "a" * 40, funcSens, fail=True)
+        log.append("objective", "b" * 40, funcs, ptID=3)
+        log.close()
+
+        reader = LogReader([self.fileName, os.path.join(self.dir, "missing.mplog")])
+        values, fail = reader.get("objective", "a" * 40)
+        self.assertFalse(fail)
+        self.assertEqual(set(values.keys()), {"drag", "thickness"})
+        np.testing.assert_equal(values["thickness"], funcs["thickness"])
+        values, fail = reader.get("sensitivity", "a" * 40)
+        self.assertTrue(fail)
+        np.testing.assert_equal(values["thickness"]["x"], funcSens["thickness"]["x"])
+        self.assertIsNone(reader.get("objective", "b" * 40))
+        self.assertIsNotNone(reader.get("objective", "b" * 40, ptID=3))
+
+    def test_truncated(self):
+        log = LogWriter(self.fileName)
+        log.append("objective", "a" * 40, {"drag": 0.5})
+        log.append("objective", "b" * 40, {"drag": 0.6})
+        log.close()
+        # Simulate a job that died while writing the last record
+        os.truncate(self.fileName, os.path.getsize(self.fileName) - 16)
+
+        reader = LogReader([self.fileName])
+        self.assertIsNotNone(reader.get("objective", "a" * 40))
+        self.assertIsNone(reader.get("objective", "b" * 40))
+
+        # A restart drops the torn record before appending new ones
+        log = LogWriter(self.fileName)
+        log.append("objective", "c" * 40, {"drag": 0.7})
+        log.append("objective", "d" * 40, {"drag": np.arange(3.0)}, fail=True)
+        log.close()
+
+        reader = LogReader([self.fileName])
+        self.assertEqual(reader.get("objective", "a" * 40)[0]["drag"], 0.5)
+        self.assertIsNone(reader.get("objective", "b" * 40))
+        self.assertEqual(reader.get("objective", "c" * 40), ({"drag": 0.7}, False))
+        values, fail = reader.get("objective", "d" * 40)
+        np.testing.assert_allclose(values["drag"], np.arange(3.0))
+        self.assertTrue(fail)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from mpi4py import MPI
+from multipoint.memberlog import MemberLog, readMemberLog
+
+gcomm = MPI.COMM_WORLD
+
+
+class TestMemberLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = gcomm.bcast(tempfile.mkdtemp() if gcomm.rank == 0 else None)
+        self.fileName = os.path.join(self.dir, "cruise.mplog")
+
+    def tearDown(self):
+        gcomm.barrier()
+        if gcomm.rank == 0:
+            shutil.rmtree(self.dir)
+
+    def test_write(self):
+        log = MemberLog(gcomm, self.fileName, member=gcomm.rank // 2)
+        log.write("first %d\n" % gcomm.rank)
+        log.flush()
+        # Ranks without output still take part in the flush
+        if gcomm.rank == 0:
+            log.write("second\n")
+        log.close()
+
+        # A reopened log is appended to
+        log = MemberLog(gcomm, self.fileName, member=gcomm.rank // 2)
+        log.write("third\n")
+        log.close()
+
+        output = readMemberLog(self.fileName)
+        self.assertEqual(len(output), gcomm.size)
+        for rank in range(gcomm.size):
+            expected = "first %d\n" % rank + ("second\n" if rank == 0 else "") + "third\n"
+            self.assertEqual(output[(rank // 2, rank)], expected)
+
+    def test_redirect(self):
+        # Test runners may replace sys.stdout, so the original streams
+        # and file descriptors are used
+        log = MemberLog(gcomm, self.fileName, member=0)
+        stdout = os.fstat(1)
+        log.redirect()
+        print("python %d" % gcomm.rank, file=sys.__stdout__)
+        sys.__stdout__.flush()
+        os.write(2, b"fd\n")
+        log.flush()
+        # Output after the last flush is written by close()
+        print("last", file=sys.__stdout__)
+        log.close()
+
+        # The original stdout is restored
+        self.assertEqual(os.fstat(1).st_ino, stdout.st_ino)
+        output = readMemberLog(self.fileName)
+        for rank in range(gcomm.size):
+            self.assertEqual(output[(0, rank)], "python %d\nfd\nlast\n" % rank)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+from multipoint.planner import fitScaling, buildModels, simulateLayout, planMemberSizes
+
+
+class TestPlanner(unittest.TestCase):
+    def test_fitScaling(self):
+        nProcs = [1, 2, 4, 8]
+        times = [2.0 + 8.0 / p for p in nProcs]
+        np.testing.assert_allclose(fitScaling(nProcs, times), (2.0, 8.0))
+        # A single processor count assumes perfect scaling
+        np.testing.assert_allclose(fitScaling([4], [3.0]), (0.0, 12.0))
+
+    def test_plan(self):
+        records = []
+        for nProc in [2, 4]:
+            records.append({"setName": "cruise", "member": 0, "nProc": nProc, "times": {"objective": [12.0 / nProc]}})
+            records.append({"setName": "cruise", "member": 1, "nProc": nProc, "times": {"objective": [4.0 / nProc]}})
+            records.append(
+                {"setName": "maneuver", "member": 0, "nProc": nProc, "times": {"objective": [1.0 + 4.0 / nProc]}}
+            )
+        models = buildModels(records)
+
+        memberSizes = planMemberSizes(models, 12)
+        self.assertEqual(sum(sum(sizes) for sizes in memberSizes.values()), 12)
+        self.assertEqual(memberSizes, {"cruise": [6, 2], "maneuver": [4]})
+
+        # The plan must beat the even split
+        makespan, memberTimes = simulateLayout(models, memberSizes)
+        evenMakespan, evenTimes = simulateLayout(models, {"cruise": [4, 4], "maneuver": [4]})
+        np.testing.assert_allclose(makespan, 2.0)
+        np.testing.assert_allclose(evenMakespan, 3.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from mpi4py import MPI
+from multipoint.transport import NodeShare, encodeJacobians, decodeJacobians
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.funcSens = {
+            "zero": {"v1": 0, "v2": np.zeros((5, 1))},
+            "dense": {"v1": np.arange(12.0).reshape(3, 4), "v2": 3.0},
+            "sparse": {"v1": np.eye(20), "v2": np.zeros(7, "D")},
+            "sparseDict": {"v1": {"coo": [[0], [1], [2.0]], "shape": [2, 2]}},
+        }
+
+    def checkRoundTrip(self, compress):
+        buf = encodeJacobians(self.funcSens, sorted(self.funcSens.keys()), compress)
+        self.assertEqual(buf.nbytes % 16, 0)
+        funcSens = decodeJacobians(buf)
+
+        self.assertEqual(set(funcSens.keys()), set(self.funcSens.keys()))
+        for key in self.funcSens:
+            self.assertEqual(set(funcSens[key].keys()), set(self.funcSens[key].keys()))
+            for dvSet, block in self.funcSens[key].items():
+                if isinstance(block, dict):
+                    self.assertEqual(block, funcSens[key][dvSet])
+                else:
+                    new = np.asarray(funcSens[key][dvSet])
+                    self.assertEqual(new.shape, np.shape(block))
+                    self.assertEqual(new.dtype, np.asarray(block).dtype)
+                    np.testing.assert_array_equal(new, block)
+
+    def test_roundTrip(self):
+        self.checkRoundTrip(False)
+
+    def test_roundTripCompressed(self):
+        self.checkRoundTrip(True)
+
+    def test_sparseIsSmaller(self):
+        dense = encodeJacobians({"a": {"v1": np.random.rand(100, 100)}}, ["a"])
+        sparse = encodeJacobians({"a": {"v1": np.eye(100)}}, ["a"])
+        self.assertLess(sparse.nbytes, dense.nbytes / 10)
+
+    def test_nodeShare(self):
+        nodeComm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+        share = NodeShare(nodeComm)
+        funcs = {"a": np.arange(6.0).reshape(2, 3), "b": 2.0, "fail": False}
+        values, fail = share.share((funcs, True) if nodeComm.rank == 0 else None)
+        self.assertTrue(fail)
+        np.testing.assert_array_equal(values["a"], funcs["a"])
+        self.assertEqual(values["b"], 2.0)
+        self.assertFalse(values["a"].flags.writeable)
+
+        # The window is kept while its views are used and freed after
+        values2, fail = share.share((funcs, False) if nodeComm.rank == 0 else None)
+        self.assertEqual(len(share.windows), 2)
+        del values
+        share.share((None, None) if nodeComm.rank == 0 else None)
+        self.assertEqual(len(share.windows), 1)
+
+        funcSens, fail = share.share((self.funcSens, False) if nodeComm.rank == 0 else None, nested=True)
+        np.testing.assert_array_equal(funcSens["dense"]["v1"], self.funcSens["dense"]["v1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import numpy as np
+from multipoint.utils import _colorColumns, _sparsityPattern
+
+
+class TestUtils(unittest.TestCase):
+    def test_colorColumns(self):
+        # Block diagonal pattern: the blocks can share colors
+        pattern = np.zeros((6, 9), bool)
+        for i in range(3):
+            pattern[2 * i : 2 * i + 2, 3 * i : 3 * i + 3] = True
+        pattern[:, 8] = False
+
+        groups = _colorColumns(pattern)
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(sorted(sum(groups, [])), list(range(8)))
+        for group in groups:
+            self.assertTrue(np.all(np.sum(pattern[:, group], axis=1) <= 1))
+
+    def test_sparsityPattern(self):
+        # The same pattern in all the sparse formats, in storage order
+        rows = np.array([0, 0, 2])
+        cols = np.array([1, 3, 0])
+        jacs = [
+            {"coo": [rows, cols, np.ones(3)], "shape": [3, 4]},
+            {"csr": [np.array([0, 2, 2, 3]), cols, np.ones(3)], "shape": [3, 4]},
+        ]
+        for jac in jacs:
+            pattern = _sparsityPattern(jac)
+            np.testing.assert_array_equal(pattern[0], rows)
+            np.testing.assert_array_equal(pattern[1], cols)
+
+        pattern = _sparsityPattern({"csc": [np.array([0, 1, 2, 2, 3]), np.array([2, 0, 0]), np.ones(3)]})
+        np.testing.assert_array_equal(pattern[0], [2, 0, 0])
+        np.testing.assert_array_equal(pattern[1], [0, 1, 3])
+        self.assertIsNone(_sparsityPattern(np.ones((3, 4))))
+
+
+if __name__ == "__main__":
+    unittest.main()